@@ -0,0 +1,16 @@
+"""
+Streamlit entry point for the dashboard.
+
+Streamlit re-executes its entry script on every interaction. Running this small script
+instead of dashboard.py means a rerun only executes the selected page: dashboard.py (the
+DatabaseManager, validation pipeline and all pages) is imported once per server process,
+from its cached bytecode, and its module-level caches survive between reruns.
+
+Usage:
+    streamlit run app.py
+"""
+import dashboard
+
+dashboard.configure_logging()
+dashboard.configure_page()
+dashboard.main()
@@ -0,0 +1,90 @@
+"""
+Retention job: moves old validation runs to cold storage.
+
+For every run uploaded before the last `--months` calendar months, its exceptions with
+their correction logs and its suspicious-transaction log entries are copied to the
+compressed `*_archive` tables and removed from the hot tables. Rows move in small id
+batches, one short transaction each, so uploads and the dashboard keep working while the
+job runs. The run itself and its user/department summaries stay in place and are marked
+'Archived'. Read notifications older than the cutoff are archived too.
+
+Transaction fingerprints stay in the hot table by default: the duplicate check reads only
+that table, so archiving them would let a file from an archived period be accepted again.
+Pass --archive-fingerprints to move them as well when that is acceptable.
+
+Only one instance runs at a time (MySQL advisory lock), so it is safe to schedule from
+cron on several hosts.
+
+Usage:
+    python archive_old_runs.py --months 12
+    python archive_old_runs.py --months 6 --dry-run
+"""
+import argparse
+import logging
+import sys
+import time
+from datetime import datetime
+
+import dashboard
+
+
+def retention_cutoff(months, today=None):
+    """First day of the oldest of the last `months` calendar months (the current one included)."""
+    today = today or datetime.now()
+    month_index = today.year * 12 + (today.month - 1) - (months - 1)
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive validation runs older than the retention period.")
+    parser.add_argument('--months', type=int, default=12,
+                        help="Keep runs from the last N calendar months in the hot tables. (default: 12)")
+    parser.add_argument('--batch-size', type=int, default=5000, help="Rows moved per transaction. (default: 5000)")
+    parser.add_argument('--archive-fingerprints', action='store_true',
+                        help="Also archive transaction fingerprints. Files from archived periods are then no longer caught as duplicates.")
+    parser.add_argument('--dry-run', action='store_true', help="Only list the runs that would be archived.")
+    args = parser.parse_args(argv)
+    if args.months < 1:
+        parser.error("--months must be at least 1")
+
+    db_manager = dashboard.get_database_manager()
+    cutoff = retention_cutoff(args.months)
+    runs = db_manager.get_runs_to_archive(cutoff)
+    logging.info(f"{len(runs)} run(s) uploaded before {cutoff:%Y-%m-%d} to archive.")
+
+    if args.dry_run:
+        for run in runs.itertuples(index=False):
+            print(f"Run {run.id:>6}  {run.upload_time:%Y-%m-%d}  {run.total_exceptions or 0:>8,} exceptions  {run.filename}")
+        return 0
+
+    lock_conn = db_manager.acquire_named_lock(dashboard.ARCHIVE_LOCK_NAME)
+    if lock_conn is None:
+        logging.warning("Another archive job is running; exiting.")
+        return 1
+
+    started = time.perf_counter()
+    failed = 0
+    totals = {'exception_rows': 0, 'suspicious_rows': 0, 'fingerprint_rows': 0}
+    try:
+        for run in runs.itertuples(index=False):
+            counts = db_manager.archive_run(run.id, batch_size=args.batch_size, include_fingerprints=args.archive_fingerprints)
+            if counts is None:
+                failed += 1
+                continue
+            for key, value in counts.items():
+                totals[key] += value
+            logging.info(f"Archived run {run.id} ({run.filename}): {counts['exception_rows']:,} exceptions, "
+                         f"{counts['suspicious_rows']:,} suspicious entries, {counts['fingerprint_rows']:,} fingerprints.")
+        notifications = db_manager.archive_read_notifications(cutoff, batch_size=args.batch_size)
+    finally:
+        db_manager.release_named_lock(lock_conn, dashboard.ARCHIVE_LOCK_NAME)
+
+    logging.info(f"Done in {time.perf_counter() - started:.1f}s: {len(runs) - failed} run(s) archived, {failed} failed; "
+                 f"{totals['exception_rows']:,} exceptions, {totals['suspicious_rows']:,} suspicious entries, "
+                 f"{totals['fingerprint_rows']:,} fingerprints and {notifications:,} notifications moved.")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s [%(filename)s:%(lineno)d] - %(message)s')
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""
+Headless batch validation for ledger exports.
+
+Runs the same pipeline as the "Upload & Validate" page (DataValidator, duplicate
+fingerprint check, DatabaseManager persistence and Excel report) without the
+Streamlit UI, so month-end files can be processed from cron or a shell.
+
+Usage:
+    python batch_validate.py exports/*.xlsx
+    python batch_validate.py exports/ --workers 2 --date 2024-03-31 --report-dir reports/
+    python batch_validate.py huge_export.xlsx --chunk-size 50000
+"""
+import argparse
+import concurrent.futures
+import glob
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+# Importing the dashboard runs Streamlit in "bare" mode: page config and CSS calls are
+# no-ops, while st.secrets and the st.cache_* decorators keep working.
+import dashboard
+
+SUPPORTED_EXTENSIONS = dashboard.LEDGER_FILE_EXTENSIONS
+
+
+def collect_input_files(paths):
+    """Expands files, directories and glob patterns into a sorted, de-duplicated list of files."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = [os.path.join(path, name) for name in os.listdir(path)]
+        else:
+            candidates = glob.glob(path) or [path]
+        for candidate in candidates:
+            name = os.path.basename(candidate)
+            if os.path.isfile(candidate) and candidate.lower().endswith(SUPPORTED_EXTENSIONS) and not name.startswith('~$'):
+                files.append(os.path.abspath(candidate))
+    return sorted(set(files))
+
+
+def _scoped_chunks(file_path, chunksize, summary):
+    """Streams the file in chunks with Super User scope, counting rows read into summary."""
+    for df_chunk in dashboard.iter_ledger_chunks(file_path, chunksize=chunksize):
+        if 'Created user' not in df_chunk.columns:
+            raise ValueError("file must contain a 'Created user' column")
+        summary['rows'] += len(df_chunk)
+        df_chunk, _ = dashboard.filter_records_for_user(df_chunk, 'Super User', None)
+        yield df_chunk
+
+
+def process_file(file_path, upload_time=None, report_dir=None, chunksize=None):
+    """
+    Validates and persists a single file. Returns a summary dict; never raises so that
+    one bad file does not abort the rest of the batch. With `chunksize`, the file is
+    streamed through the pipeline in chunks of that many rows.
+    """
+    filename = os.path.basename(file_path)
+    summary = {'file': filename, 'status': 'failed', 'rows': 0, 'processed': 0,
+               'exceptions': 0, 'duplicates': 0, 'run_id': None, 'seconds': 0.0, 'error': None}
+    started = time.perf_counter()
+    try:
+        if chunksize:
+            result = dashboard.run_streaming_validation_pipeline(
+                _scoped_chunks(file_path, chunksize, summary), filename, os.path.getsize(file_path), upload_time=upload_time
+            )
+            if result is None:
+                summary['status'] = 'skipped'
+                summary['error'] = "file is empty or could not be parsed"
+                return summary
+        else:
+            df_original = dashboard.read_ledger_file(file_path)
+            summary['rows'] = len(df_original)
+            if df_original.empty:
+                summary['status'] = 'skipped'
+                summary['error'] = "file is empty or could not be parsed"
+                return summary
+            if 'Created user' not in df_original.columns:
+                raise ValueError("file must contain a 'Created user' column")
+
+            # The batch runner acts with Super User scope: every record in the file is processed.
+            df_to_process, _ = dashboard.filter_records_for_user(df_original, 'Super User', None)
+            result = dashboard.run_validation_pipeline(
+                df_to_process, filename, os.path.getsize(file_path), upload_time=upload_time, return_final_df=False
+            )
+
+        if report_dir and result['excel_report']:
+            report_path = os.path.join(report_dir, f"Validation_Report_{os.path.splitext(filename)[0]}.xlsx")
+            with open(report_path, 'wb') as f:
+                f.write(result['excel_report'].getvalue())
+
+        summary.update({
+            'status': 'ok',
+            'processed': result['processed_count'],
+            'exceptions': result['exception_count'],
+            'duplicates': result['ignored_clean_count'],
+            'run_id': result['run_id'],
+        })
+    except Exception as e:
+        summary['error'] = str(e)
+        logging.error(f"Failed to process {filename}: {e}", exc_info=True)
+    finally:
+        summary['seconds'] = time.perf_counter() - started
+    return summary
+
+
+def print_summary(results, elapsed):
+    print()
+    print(f"{'File':<45} {'Status':<8} {'Run':>6} {'Rows':>8} {'Processed':>10} {'Exceptions':>11} {'Dupes':>7} {'Secs':>7}")
+    print("-" * 108)
+    for r in results:
+        print(f"{r['file'][:45]:<45} {r['status']:<8} {str(r['run_id'] or '-'):>6} {r['rows']:>8,} "
+              f"{r['processed']:>10,} {r['exceptions']:>11,} {r['duplicates']:>7,} {r['seconds']:>7.1f}")
+        if r['error']:
+            print(f"    -> {r['error']}")
+    print("-" * 108)
+
+    total_rows = sum(r['rows'] for r in results)
+    ok_count = sum(1 for r in results if r['status'] == 'ok')
+    rows_per_sec = total_rows / elapsed if elapsed > 0 else 0.0
+    files_per_min = len(results) / elapsed * 60 if elapsed > 0 else 0.0
+    print(f"Files: {len(results)} ({ok_count} ok, {len(results) - ok_count} not processed)")
+    print(f"Rows read: {total_rows:,} | Exceptions: {sum(r['exceptions'] for r in results):,} | "
+          f"Duplicates ignored: {sum(r['duplicates'] for r in results):,}")
+    print(f"Wall time: {elapsed:.1f}s | Throughput: {rows_per_sec:,.0f} rows/s, {files_per_min:.1f} files/min")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Validate ledger exports without the Streamlit UI.")
+    parser.add_argument('paths', nargs='+', help="Ledger files (xlsx, xls, csv, parquet), directories or glob patterns to process.")
+    parser.add_argument('--workers', type=int, default=2,
+                        help="Files processed concurrently. Each file already validates on all CPU cores, so keep this small. (default: 2)")
+    parser.add_argument('--date', help="Upload date to record for the runs (YYYY-MM-DD). Defaults to now.")
+    parser.add_argument('--report-dir', help="Also write each Excel validation report to this directory.")
+    parser.add_argument('--chunk-size', type=int,
+                        help="Stream each file through the pipeline in chunks of this many rows to bound memory on very large exports. "
+                             "Supports .xlsx, .csv and .parquet; .xls files fail and must be converted or run without it.")
+    parser.add_argument('--no-notifications', action='store_true',
+                        help="Skip the unresolved-entry notification check after the batch.")
+    args = parser.parse_args(argv)
+
+    upload_time = None
+    if args.date:
+        try:
+            upload_time = datetime.strptime(args.date, "%Y-%m-%d")
+        except ValueError:
+            parser.error("--date must be in YYYY-MM-DD format")
+
+    files = collect_input_files(args.paths)
+    if not files:
+        logging.error(f"No {'/'.join(SUPPORTED_EXTENSIONS)} files found for the given paths.")
+        return 1
+    if args.report_dir:
+        os.makedirs(args.report_dir, exist_ok=True)
+
+    logging.info(f"Processing {len(files)} file(s) with {args.workers} concurrent worker(s).")
+    started = time.perf_counter()
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {executor.submit(process_file, f, upload_time, args.report_dir, args.chunk_size): f for f in files}
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            logging.info(f"{result['file']}: {result['status']} in {result['seconds']:.1f}s")
+            results.append(result)
+
+    # Notifications run once per batch rather than once per file.
+    if not args.no_notifications and any(r['status'] == 'ok' for r in results):
+        dashboard.run_notification_check()
+
+    elapsed = time.perf_counter() - started
+    results.sort(key=lambda r: r['file'])
+    print_summary(results, elapsed)
+    return 0 if all(r['status'] != 'failed' for r in results) else 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s [%(filename)s:%(lineno)d] - %(message)s')
+    sys.exit(main())
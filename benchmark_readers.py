@@ -0,0 +1,90 @@
+"""
+Benchmarks the ledger file readers on real exports.
+
+For every Excel file given, times `read_ledger_file` with each available Excel engine
+(openpyxl, and calamine when python-calamine is installed), with and without column
+pruning, and the same data re-read from CSV and Parquet copies. Reports wall time,
+rows/s and the in-memory size of the resulting DataFrame.
+
+Usage:
+    python benchmark_readers.py exports/*.xlsx --repeat 3
+"""
+import argparse
+import glob
+import importlib.util
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import dashboard
+
+
+def time_read(repeat, *args, **kwargs):
+    """Returns (best seconds, DataFrame from the last run)."""
+    best = None
+    df = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        df = dashboard.read_ledger_file(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, df
+
+
+def benchmark_file(file_path, repeat):
+    rows = []
+    engines = ['openpyxl']
+    if importlib.util.find_spec('python_calamine') is not None:
+        engines.append('calamine')
+
+    for engine in engines:
+        for label, columns, compact in [("all columns", None, False),
+                                        ("all columns, compact", None, True),
+                                        ("working columns, compact", dashboard.LEDGER_WORKING_COLUMNS, True)]:
+            seconds, df = time_read(repeat, file_path, engine=engine, columns=columns, compact=compact)
+            rows.append((f"excel/{engine}", label, seconds, df))
+
+    # Re-read the same data from CSV/Parquet copies to show the gain of skipping Excel parsing.
+    full_df = dashboard.read_ledger_file(file_path, compact=False)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, "export.csv")
+        full_df.to_csv(csv_path, index=False)
+        seconds, df = time_read(repeat, csv_path, columns=dashboard.LEDGER_WORKING_COLUMNS)
+        rows.append(("csv", "working columns, compact", seconds, df))
+
+        if importlib.util.find_spec('pyarrow') is not None:
+            parquet_path = os.path.join(tmp_dir, "export.parquet")
+            full_df.astype({c: str for c in full_df.columns if full_df[c].dtype == object}).to_parquet(parquet_path, index=False)
+            seconds, df = time_read(repeat, parquet_path, columns=dashboard.LEDGER_WORKING_COLUMNS)
+            rows.append(("parquet", "working columns, compact", seconds, df))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare ledger file reader engines.")
+    parser.add_argument('paths', nargs='+', help="Excel exports (files or glob patterns).")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per variant; the best time is reported. (default: 3)")
+    args = parser.parse_args(argv)
+
+    files = sorted({p for pattern in args.paths for p in (glob.glob(pattern) or [pattern])
+                    if p.lower().endswith(('.xlsx', '.xls')) and os.path.isfile(p)})
+    if not files:
+        logging.error("No Excel files found for the given paths.")
+        return 1
+
+    for file_path in files:
+        print(f"\n{os.path.basename(file_path)} ({os.path.getsize(file_path) / 1024 / 1024:.1f} MB)")
+        print(f"{'Reader':<16} {'Variant':<28} {'Seconds':>8} {'Rows/s':>10} {'Cols':>5} {'Memory MB':>10}")
+        print("-" * 82)
+        for reader, label, seconds, df in benchmark_file(file_path, max(1, args.repeat)):
+            memory_mb = df.memory_usage(deep=True).sum() / 1024 / 1024
+            rows_per_sec = len(df) / seconds if seconds else 0.0
+            print(f"{reader:<16} {label:<28} {seconds:>8.2f} {rows_per_sec:>10,.0f} {len(df.columns):>5} {memory_mb:>10.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s [%(filename)s:%(lineno)d] - %(message)s')
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+Benchmarks dashboard start-up: cold import time and the per-interaction rerun overhead.
+
+Cold start runs `python -X importtime -c "import dashboard"` in fresh interpreters and reports
+the total import time, the slowest imports and which heavy modules were loaded. With
+--compare-eager the same is measured with plotly, openpyxl and the mail modules imported up
+front, as dashboard.py used to do, so the saving of the lazy imports can be read off directly.
+
+The rerun overhead compares what Streamlit executes on every interaction before the page
+itself runs: the whole dashboard.py module body (`streamlit run dashboard.py`) against the
+app.py entry script, which only finds dashboard in sys.modules (`streamlit run app.py`).
+
+Importing dashboard connects to the database, so run this where the dashboard can run.
+
+Usage:
+    python benchmark_startup.py --repeat 5 --compare-eager
+"""
+import argparse
+import importlib
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ['plotly.express', 'plotly.graph_objects', 'openpyxl', 'openpyxl.styles', 'smtplib', 'email.mime.multipart']
+EAGER_PRELUDE = "import plotly.express, plotly.graph_objects, plotly.io, openpyxl, openpyxl.styles, smtplib, ssl, email.mime.multipart, email.mime.text, email.mime.image, email.mime.application, sqlite3; "
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(stderr):
+    """Parses `-X importtime` output into [(module, self_us, cumulative_us, depth)]."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        if not self_us.strip().isdigit():
+            continue  # header line
+        stripped = name.lstrip()
+        entries.append((stripped.strip(), int(self_us), int(cumulative_us), (len(name) - len(stripped) - 1) // 2))
+    return entries
+
+
+def measure_cold_import(prelude=""):
+    """Imports dashboard in a fresh interpreter. Returns (wall seconds, importtime entries, heavy modules loaded)."""
+    code = f"{prelude}import sys, dashboard; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules and not type(sys.modules[m]).__name__ == '_LazyModule'))"
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=HERE, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"importing dashboard failed:\n{result.stderr[-2000:]}")
+    loaded = [m for m in result.stdout.strip().splitlines()[-1].split(",") if m] if result.stdout.strip() else []
+    return elapsed, parse_importtime(result.stderr), loaded
+
+
+def report_cold_start(label, prelude, repeat, top):
+    runs = [measure_cold_import(prelude) for _ in range(repeat)]
+    totals_ms = [sum(cumulative for _, _, cumulative, depth in entries if depth == 0) / 1000 for _, entries, _ in runs]
+    walls_ms = [wall * 1000 for wall, _, _ in runs]
+    _, entries, loaded = runs[-1]
+
+    print(f"\n{label}")
+    print(f"  import time (sum of top-level imports): median {statistics.median(totals_ms):,.0f} ms, best {min(totals_ms):,.0f} ms")
+    print(f"  interpreter wall time:                  median {statistics.median(walls_ms):,.0f} ms, best {min(walls_ms):,.0f} ms")
+    print(f"  heavy modules loaded: {', '.join(loaded) or 'none'}")
+    print("  slowest top-level imports (last run):")
+    for name, _, cumulative, _ in sorted((e for e in entries if e[3] == 0), key=lambda e: e[2], reverse=True)[:top]:
+        print(f"    {cumulative / 1000:>9,.1f} ms  {name}")
+    return statistics.median(totals_ms)
+
+
+def report_rerun_overhead(repeat):
+    """Per-interaction overhead of both entry points, measured in this process."""
+    importlib.import_module("dashboard")  # first import (connects, starts caches); not part of the rerun cost
+
+    with open(os.path.join(HERE, "dashboard.py"), "r", encoding="utf-8") as f:
+        dashboard_code = compile(f.read(), "dashboard.py", "exec")  # Streamlit caches the compiled script too
+    app_code = compile("import dashboard\ndashboard.configure_logging()\ndashboard.configure_page()\n", "app.py", "exec")
+
+    def timed_exec(code):
+        samples = []
+        for _ in range(repeat):
+            namespace = {'__name__': '__streamlit_rerun__', '__file__': os.path.join(HERE, "dashboard.py")}
+            started = time.perf_counter()
+            exec(code, namespace)
+            samples.append((time.perf_counter() - started) * 1000)
+        return samples
+
+    full_module = timed_exec(dashboard_code)
+    entry_script = timed_exec(app_code)
+    print("\nPer-rerun overhead (before the selected page runs)")
+    print(f"  streamlit run dashboard.py (whole module body): median {statistics.median(full_module):>8,.2f} ms, best {min(full_module):>8,.2f} ms")
+    print(f"  streamlit run app.py (entry script only):       median {statistics.median(entry_script):>8,.2f} ms, best {min(entry_script):>8,.2f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure dashboard cold-start import time and rerun overhead.")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per measurement; medians and best are reported. (default: 5)")
+    parser.add_argument('--top', type=int, default=10, help="Number of slowest imports to list. (default: 10)")
+    parser.add_argument('--compare-eager', action='store_true',
+                        help="Also measure with plotly/openpyxl/mail imported up front, as before the lazy imports.")
+    parser.add_argument('--skip-rerun', action='store_true', help="Only measure the cold start.")
+    args = parser.parse_args(argv)
+    repeat = max(1, args.repeat)
+
+    lazy_ms = report_cold_start("Cold start: import dashboard", "", repeat, args.top)
+    if args.compare_eager:
+        eager_ms = report_cold_start("Cold start: import dashboard with heavy modules imported eagerly", EAGER_PRELUDE, repeat, args.top)
+        print(f"\nLazy imports save {eager_ms - lazy_ms:,.0f} ms per cold start ({(eager_ms - lazy_ms) / eager_ms * 100:.0f}%).")
+    if not args.skip_rerun:
+        report_rerun_overhead(repeat)
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s [%(filename)s:%(lineno)d] - %(message)s')
+    sys.exit(main())
@@ -4,27 +4,50 @@ import pandas as pd
 import mysql.connector # UPDATED: Replaced sqlite3 with mysql.connector
 from mysql.connector import errorcode # UPDATED: Added for specific MySQL error handling
 import io
-import sqlite3  # <--- MAKE SURE THIS LINE EXISTS
+import sys
 from datetime import datetime
-import plotly.express as px
-import plotly.graph_objects as go
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-from openpyxl.utils import get_column_letter
 import numpy as np
+from pandas.io.parsers import TextParser
 import logging
 import os
-import smtplib
-import ssl
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.mime.application import MIMEApplication # <-- ADD THIS LINE
 import json
 import math
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 import concurrent.futures
 import time
 import hashlib
+import importlib.util
+import pickle
+import tempfile
+import threading
+import atexit
+from collections import deque
+
+
+def _lazy_module(name):
+    """
+    Returns `name` as a module that is only really imported on first attribute access, so
+    the cost of heavy modules (plotly alone is ~0.2s) is paid by the first page that uses
+    them rather than by every cold start.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# Charts are only needed by the analytics pages and emails, mail only when something is sent;
+# openpyxl and email.mime are imported inside the functions that use them.
+px = _lazy_module("plotly.express")
+go = _lazy_module("plotly.graph_objects")
+pio = _lazy_module("plotly.io")
+smtplib = _lazy_module("smtplib")
+ssl = _lazy_module("ssl")
 
 
 # Helper function to serialize objects not recognized by default json.dumps
@@ -86,16 +109,8 @@ def _validate_chunk(validator_instance, df_chunk):
     return exceptions
 
 
-# Page configuration
-st.set_page_config(
-    page_title="Data Validation Dashboard",
-    page_icon="📊",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
-
 # Custom CSS (No changes here, but included for completeness)
-st.markdown("""
+CUSTOM_CSS = """
 <style>
     @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap');
     body {
@@ -164,7 +179,20 @@ st.markdown("""
         background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+
+# Page configuration
+def configure_page():
+    """Page config and CSS; called at the start of every script run, before main()."""
+    st.set_page_config(
+        page_title="Data Validation Dashboard",
+        page_icon="📊",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+
 
 # REMOVED: DB_TIMEOUT is less relevant for MySQL connector which has its own config
 # DB_TIMEOUT = 30
@@ -173,6 +201,100 @@ st.markdown("""
 PLOTLY_FONT = dict(family="Inter, sans-serif", size=12, color="#2d3748")
 PLOTLY_TITLE_FONT = dict(family="Inter, sans-serif", size=16, color="#2d3748")
 
+# Columns listed on the Correction Entries page; original_row_data is fetched only for the selected entry.
+CORRECTION_ENTRY_LIST_COLUMNS = [
+    'id', 'run_id', 'created_user', 'department', 'location', 'crop', 'net_amount',
+    'severity', 'exception_reason', 'narration', 'correction_status',
+]
+# Sort options of the Correction Entries page (label -> column); also the ORDER BY whitelist.
+CORRECTION_ENTRY_SORT_COLUMNS = {
+    'ID': 'id', 'Run ID': 'run_id', 'User': 'created_user', 'Department': 'department',
+    'Net Amount': 'net_amount', 'Severity': 'severity', 'Status': 'correction_status',
+}
+PAGE_SIZE_OPTIONS = [25, 50, 100, 250]
+# Denormalised `exceptions` columns selected by list queries, renamed to the export column
+# names the pages work with. The full record (original_row_data) comes from get_exception_detail.
+EXCEPTION_LIST_COLUMNS = {
+    'id': 'id', 'run_id': 'run_id', 'exception_reason': 'Exception Reasons', 'severity': 'Severity',
+    'department': 'Department.Name', 'sub_department': 'Sub Department.Name', 'created_user': 'Created user',
+    'modified_user': 'Modified user', 'net_amount_exact': 'Net amount', 'location': 'Location.Name',
+    'crop': 'Crop.Name', 'activity': 'Activity.Name', 'function_name': 'Function.Name',
+    'vertical_name': 'FC-Vertical.Name', 'region_name': 'Region.Name', 'zone_name': 'Zone.Name',
+    'business_unit': 'Business Unit.Name', 'account2_code': 'Account2.Code',
+    'sub_ledger_code': 'Sub Ledger.Code', 'account2_name': 'Account2.Name',
+    'sub_ledger_name': 'SubLedger.Name', 'narration': 'Narration',
+}
+# Columns added to `exceptions` after it was first created, in the order they are appended.
+# init_database adds missing ones to both the hot and the archive table so that the archive's
+# `INSERT ... SELECT *` copies stay column-aligned. net_amount is a single-precision FLOAT, so
+# the exact amount is kept alongside it.
+EXCEPTION_ADDED_COLUMNS = {
+    'net_amount_exact': "DECIMAL(18,2) NULL", 'account2_name': "TEXT NULL", 'sub_ledger_name': "TEXT NULL",
+}
+# Fields of a suspicious transaction's original record shown in the review lists; they are
+# extracted in SQL so the JSON document itself is only sent for the record a reviewer opens.
+SUSPICIOUS_LOG_SUMMARY_FIELDS = ['Department.Name', 'Sub Department.Name', 'Location.Name', 'Crop.Name', 'Net amount']
+SUSPICIOUS_LOG_LIST_COLUMNS = ['id', 'run_id', 'created_user', 'status', 'admin_comment', 'reviewed_by', 'reviewed_at', 'user_corrected_at']
+DETAIL_FETCH_BATCH_SIZE = 1000
+# Tables whose rows the retention job moves to a compressed `<table>_archive` copy.
+ARCHIVE_TABLES = ['exceptions', 'correction_logs', 'transaction_fingerprints', 'suspicious_transactions_log', 'notifications']
+ARCHIVE_LOCK_NAME = "validation_dashboard.retention_archive"
+# Held while the one-off data backfills run, so only one process works through them.
+BACKFILL_LOCK_NAME = "validation_dashboard.data_backfill"
+# Order in which delete_run clears a run's rows: (table, dependents) as taken by _remove_rows.
+# The run row goes last, after its children are gone, so its cascade has nothing left to do.
+RUN_DELETE_STEPS = [
+    ('exceptions', [('exception_reason_links', 'exception_id', False), ('correction_logs', 'exception_id', False)]),
+    ('suspicious_transactions_log', ()),
+    ('transaction_fingerprints', ()),
+    ('department_summary', ()),
+    ('user_performance', ()),
+    ('correction_status', ()),
+    ('exceptions_archive', [('correction_logs_archive', 'exception_id', False)]),
+    ('suspicious_transactions_log_archive', ()),
+    ('transaction_fingerprints_archive', ()),
+]
+RUN_DELETE_BATCH_SIZE = 2000
+
+# --- Password hashing ---
+# bcrypt is deliberately slow (~0.3s per hash or check). All hashing goes through a small
+# thread pool (bcrypt releases the GIL), so a burst of logins occupies at most
+# PASSWORD_HASH_WORKERS cores and the rest of the dashboard stays responsive. Requests beyond
+# PASSWORD_HASH_MAX_PENDING are turned away instead of queueing without bound.
+PASSWORD_HASH_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+PASSWORD_HASH_MAX_PENDING = 32
+PASSWORD_HASH_TIMEOUT_SECONDS = 15
+_password_pool = concurrent.futures.ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_password_slots = threading.BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+
+
+class PasswordHashingBusy(Exception):
+    """Raised when the password pool is saturated; the caller should ask the user to retry."""
+
+
+def _run_password_task(func, *args):
+    if not _password_slots.acquire(blocking=False):
+        raise PasswordHashingBusy()
+    try:
+        future = _password_pool.submit(func, *args)
+    except BaseException:
+        _password_slots.release()
+        raise
+    future.add_done_callback(lambda _: _password_slots.release())
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT_SECONDS)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise PasswordHashingBusy()
+
+
+def hash_password(password):
+    return _run_password_task(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+
+def verify_password(password, hashed_password):
+    return _run_password_task(bcrypt.checkpw, password.encode('utf-8'), hashed_password.encode('utf-8'))
+
 
 class DatabaseManager:
     def __init__(self, db_creds=st.secrets["mysql"]):
@@ -195,6 +317,7 @@ class DatabaseManager:
     def init_database(self):
         """Initializes and updates all tables for the application."""
         conn = self._get_connection()
+        rebuild_closure = False
         try:
             table_options = "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"
             with conn.cursor() as cursor:
@@ -248,6 +371,7 @@ class DatabaseManager:
                         `is_accepted` BOOLEAN NOT NULL DEFAULT FALSE,
                         FOREIGN KEY (`run_id`) REFERENCES `validation_runs`(`id`) ON DELETE CASCADE
                     ) {table_options}''')
+                self._add_missing_columns(cursor, 'exceptions', EXCEPTION_ADDED_COLUMNS)
                 cursor.execute(f'''CREATE TABLE IF NOT EXISTS `department_summary` (`id` INT PRIMARY KEY AUTO_INCREMENT, `run_id` INT, `department` TEXT, `total_records` INT, `exception_records` INT, `exception_rate` FLOAT, FOREIGN KEY (`run_id`) REFERENCES `validation_runs`(`id`) ON DELETE CASCADE) {table_options}''')
                 cursor.execute(f'''CREATE TABLE IF NOT EXISTS `user_performance` (`id` INT PRIMARY KEY AUTO_INCREMENT, `run_id` INT, `user` TEXT, `total_records` INT, `exception_records` INT, `exception_rate` FLOAT, FOREIGN KEY (`run_id`) REFERENCES `validation_runs`(`id`) ON DELETE CASCADE) {table_options}''')
                 cursor.execute(f'''CREATE TABLE IF NOT EXISTS `correction_status` (`id` INT PRIMARY KEY AUTO_INCREMENT, `run_id` INT NOT NULL, `username` VARCHAR(255) NOT NULL, `status` ENUM('Yes', 'No', 'Pending') NOT NULL, `update_time` TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (`run_id`) REFERENCES `validation_runs`(`id`) ON DELETE CASCADE, UNIQUE KEY `unique_run_user` (`run_id`, `username`)) {table_options}''')
@@ -334,6 +458,80 @@ class DatabaseManager:
                         `accepted_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     ) {table_options}''')
 
+                # Exception reasons, normalised: one dictionary row per distinct reason and one
+                # link row per (exception, reason). run_id and created_user are copied onto the
+                # link so per-run/per-user reason counts are answered from its indexes alone.
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS `exception_reasons` (
+                        `id` INT PRIMARY KEY AUTO_INCREMENT,
+                        `reason` VARCHAR(255) NOT NULL,
+                        UNIQUE KEY `uq_exception_reason` (`reason`)
+                    ) {table_options}''')
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS `exception_reason_links` (
+                        `exception_id` INT NOT NULL,
+                        `reason_id` INT NOT NULL,
+                        `run_id` INT,
+                        `created_user` VARCHAR(255),
+                        PRIMARY KEY (`exception_id`, `reason_id`),
+                        KEY `idx_reason_links_run` (`run_id`, `reason_id`),
+                        KEY `idx_reason_links_user` (`created_user`, `run_id`),
+                        FOREIGN KEY (`exception_id`) REFERENCES `exceptions`(`id`) ON DELETE CASCADE,
+                        FOREIGN KEY (`reason_id`) REFERENCES `exception_reasons`(`id`)
+                    ) {table_options}''')
+
+                # Cold storage for the retention job (archive_old_runs.py): same columns as the hot
+                # tables, no foreign keys, compressed rows. archived_runs records what was moved.
+                for table in ARCHIVE_TABLES:
+                    cursor.execute("SHOW TABLES LIKE %s", (f"{table}_archive",))
+                    if cursor.fetchone() is None:
+                        cursor.execute(f"CREATE TABLE `{table}_archive` LIKE `{table}`")
+                        try:
+                            cursor.execute(f"ALTER TABLE `{table}_archive` ROW_FORMAT=COMPRESSED KEY_BLOCK_SIZE=8")
+                        except mysql.connector.Error as err:
+                            logging.warning(f"Could not compress {table}_archive, keeping the default row format: {err}")
+                    elif table == 'exceptions':
+                        self._add_missing_columns(cursor, 'exceptions_archive', EXCEPTION_ADDED_COLUMNS)
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS `archived_runs` (
+                        `run_id` INT PRIMARY KEY,
+                        `archived_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        `exception_rows` INT NOT NULL DEFAULT 0,
+                        `suspicious_rows` INT NOT NULL DEFAULT 0,
+                        `fingerprint_rows` INT NOT NULL DEFAULT 0
+                    ) {table_options}''')
+
+                # Reporting hierarchy as a closure table: one row per (ancestor, descendant),
+                # including each user as their own ancestor at depth 0.
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS `user_hierarchy_closure` (
+                        `ancestor` VARCHAR(255) NOT NULL,
+                        `descendant` VARCHAR(255) NOT NULL,
+                        `depth` INT NOT NULL,
+                        PRIMARY KEY (`ancestor`, `descendant`),
+                        KEY `idx_closure_descendant` (`descendant`)
+                    ) {table_options}''')
+
+                # Outbound mail queue: fully built messages waiting for the EmailDispatcher.
+                # next_attempt_at doubles as the retry time and as the lease of a claimed message.
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS `email_outbox` (
+                        `id` INT PRIMARY KEY AUTO_INCREMENT,
+                        `job_id` VARCHAR(64),
+                        `recipients` TEXT NOT NULL,
+                        `subject` VARCHAR(998),
+                        `message` LONGBLOB NOT NULL,
+                        `status` ENUM('Pending', 'Sending', 'Sent', 'Failed') NOT NULL DEFAULT 'Pending',
+                        `attempts` INT NOT NULL DEFAULT 0,
+                        `next_attempt_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        `last_error` TEXT,
+                        `created_by` VARCHAR(255),
+                        `created_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                        `sent_at` TIMESTAMP NULL,
+                        KEY `idx_outbox_due` (`status`, `next_attempt_at`),
+                        KEY `idx_outbox_job` (`job_id`, `status`)
+                    ) {table_options}''')
+
                 # --- Populate default roles and Super User (No changes here) ---
                 default_roles = ["User", "Manager", "Management", "Super User"]
                 for role in default_roles:
@@ -344,25 +542,147 @@ class DatabaseManager:
                     super_user = os.environ.get("SUPER_USER_USERNAME")
                     super_pass = os.environ.get("SUPER_USER_PASSWORD")
                     if super_user and super_pass:
-                        hashed_password = bcrypt.hashpw(super_pass.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+                        hashed_password = hash_password(super_pass)
                         cursor.execute("INSERT INTO `users` (username, full_name, hashed_password, role) VALUES (%s, %s, %s, %s)",(super_user, 'Super User Account', hashed_password, 'Super User'))
                         conn.commit()
                         logging.info(f"Successfully created initial 'Super User' account for '{super_user}'.")
+
+                cursor.execute("SELECT COUNT(*) FROM `user_hierarchy_closure`")
+                rebuild_closure = cursor.fetchone()[0] == 0
         except mysql.connector.Error as err:
             logging.error(f"Database initialization error (MySQL): {err}", exc_info=True); conn.rollback()
         finally:
             if conn: conn.close()
+        if rebuild_closure:
+            self.rebuild_hierarchy_closure()
+        self.start_backfills()
+
+    def _backfills(self):
+        return [self.backfill_exception_list_columns, self.backfill_exception_reason_links]
+
+    def start_backfills(self):
+        """
+        Runs the one-off data backfills on a daemon thread, so a large `exceptions` table does
+        not hold up the first page load. Each backfill only touches rows that still need it and
+        resumes where it stopped; the advisory lock keeps other processes from duplicating the work.
+        """
+        def _run():
+            lock_conn = self.acquire_named_lock(BACKFILL_LOCK_NAME)
+            if lock_conn is None:
+                logging.info("Data backfills are running in another process; skipping.")
+                return
+            try:
+                for backfill in self._backfills():
+                    try:
+                        backfill()
+                    except Exception as e:
+                        logging.error(f"Data backfill {backfill.__name__} failed: {e}", exc_info=True)
+            finally:
+                self.release_named_lock(lock_conn, BACKFILL_LOCK_NAME)
+        threading.Thread(target=_run, name="data-backfill", daemon=True).start()
+
+    def _add_missing_columns(self, cursor, table, columns):
+        """Appends the `columns` (name -> definition) that `table` lacks, in order. Returns the names added."""
+        cursor.execute(
+            "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+            (table,)
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        added = [name for name in columns if name not in existing]
+        for name in added:
+            cursor.execute(f"ALTER TABLE `{table}` ADD COLUMN `{name}` {columns[name]}")
+            logging.info(f"Added column {table}.{name}.")
+        return added
+
+    # --- Reporting hierarchy ---
+
+    def rebuild_hierarchy_closure(self):
+        """
+        Recomputes user_hierarchy_closure from users.reports_to and users.mapped_to_management.
+        Called after every change to a mapping, role or user; the users table is small, so a
+        full rebuild in one transaction is cheap and copes with cycles and dangling mappings.
+        """
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT username, reports_to, mapped_to_management FROM `users`")
+                parents = {}
+                for username, reports_to, mapped_to_management in cursor.fetchall():
+                    parents[username] = {p for p in (reports_to, mapped_to_management) if p and p != username}
+
+                closure_rows = []
+                for username in parents:
+                    # Breadth-first walk up the hierarchy; depth is the shortest path length.
+                    depths = {username: 0}
+                    frontier = [username]
+                    while frontier:
+                        next_frontier = []
+                        for node in frontier:
+                            for parent in parents.get(node, ()):
+                                if parent in parents and parent not in depths:
+                                    depths[parent] = depths[node] + 1
+                                    next_frontier.append(parent)
+                        frontier = next_frontier
+                    closure_rows.extend((ancestor, username, depth) for ancestor, depth in depths.items())
+
+                conn.autocommit = False
+                cursor.execute("DELETE FROM `user_hierarchy_closure`")
+                if closure_rows:
+                    cursor.executemany("INSERT INTO `user_hierarchy_closure` (ancestor, descendant, depth) VALUES (%s, %s, %s)", closure_rows)
+            conn.commit()
+            logging.info(f"Rebuilt user hierarchy closure: {len(closure_rows)} rows for {len(parents)} users.")
+            return True
+        except mysql.connector.Error as err:
+            logging.error(f"Error rebuilding user hierarchy closure: {err}", exc_info=True)
+            conn.rollback()
+            return False
+        finally:
+            if conn: conn.close()
+
+    def get_team_members(self, username):
+        """Everyone below `username` in the reporting hierarchy, at any depth."""
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT descendant FROM `user_hierarchy_closure` WHERE ancestor = %s AND depth > 0 ORDER BY depth, descendant",
+                    (username,)
+                )
+                return [row[0] for row in cursor.fetchall()]
+        except mysql.connector.Error as err:
+            logging.error(f"Error in get_team_members for {username}: {err}", exc_info=True); return []
+        finally:
+            if conn: conn.close()
+
+    def _visibility_filter(self, column, user_role, username):
+        """
+        SQL condition limiting a username column to the rows user_role/username may see: their
+        own for 'User', their whole reporting tree for 'Manager' (one indexed lookup in
+        user_hierarchy_closure) and no restriction otherwise. Returns (sql, params); sql is
+        empty when nothing needs filtering.
+        """
+        if user_role == 'User' and username:
+            return f"{column} = %s", [username]
+        if user_role == 'Manager' and username:
+            return f"{column} IN (SELECT descendant FROM `user_hierarchy_closure` WHERE ancestor = %s)", [username]
+        return "", []
 
     # --- User Management Methods ---
     def add_user(self, username, password, role, full_name=None, email=None, mobile_number=None, reports_to=None):
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        try:
+            hashed_password = hash_password(password)
+        except PasswordHashingBusy:
+            return "The server is busy, please try again in a moment."
         conn = self._get_connection()
         try:
             with conn.cursor() as cursor:
                 sql = "INSERT INTO `users` (username, full_name, email, mobile_number, hashed_password, role, reports_to) VALUES (%s, %s, %s, %s, %s, %s, %s)"
                 val = (username, full_name, email, mobile_number, hashed_password, role, reports_to)
                 cursor.execute(sql, val)
-            conn.commit(); return True
+            conn.commit()
+            self.rebuild_hierarchy_closure()
+            if reports_to: invalidate_user_context(reports_to)
+            return True
         except mysql.connector.Error as err:
             if err.errno == errorcode.ER_DUP_ENTRY: return "Username already exists."
             logging.error(f"Error in add_user: {err}", exc_info=True); return f"An error occurred: {err}"
@@ -488,16 +808,21 @@ class DatabaseManager:
             query = "SELECT * FROM clarifications WHERE status = 'Submitted' "
             params = []
             if user_role == 'Manager':
-                if not (managed_users and username): return pd.DataFrame()
-                team = managed_users + [username]
-                placeholders = ','.join(['%s'] * len(team))
-                query += f" AND username IN ({placeholders})"
-                params.extend(team)
+                if not username: return pd.DataFrame()
+                scope_sql, scope_params = self._visibility_filter('username', user_role, username)
+                query += f" AND {scope_sql}"
+                params.extend(scope_params)
             elif user_role == 'Management':
-                if not management_map: return pd.DataFrame()
-                placeholders = ','.join(['%s'] * len(management_map))
-                query += f" AND username IN (SELECT username FROM users WHERE reports_to IN ({placeholders}))"
-                params.extend(management_map)
+                if management_map:
+                    placeholders = ','.join(['%s'] * len(management_map))
+                    query += f" AND username IN (SELECT username FROM users WHERE reports_to IN ({placeholders}))"
+                    params.extend(management_map)
+                elif username:
+                    # Managers mapped to this Management user and everyone below them
+                    query += " AND username IN (SELECT descendant FROM `user_hierarchy_closure` WHERE ancestor = %s AND depth > 0)"
+                    params.append(username)
+                else:
+                    return pd.DataFrame()
 
             query += " ORDER BY submitted_at DESC"
             return pd.read_sql_query(query, conn, params=params)
@@ -597,7 +922,9 @@ class DatabaseManager:
             disabled_pages_str = ",".join(disabled_pages_list) if disabled_pages_list else ""
             with conn.cursor() as cursor:
                 cursor.execute("UPDATE role_permissions SET can_upload = %s, disabled_pages = %s WHERE role = %s", (can_upload, disabled_pages_str, role))
-            conn.commit(); return True
+            conn.commit()
+            invalidate_user_context()
+            return True
         except mysql.connector.Error as err:
             logging.error(f"Error in update_role_permissions: {err}", exc_info=True); return False
         finally:
@@ -609,7 +936,9 @@ class DatabaseManager:
             disabled_pages_str = ",".join(disabled_pages_list) if disabled_pages_list else ""
             with conn.cursor() as cursor:
                 cursor.execute("UPDATE users SET can_upload = %s, disabled_pages = %s WHERE username = %s", (can_upload, disabled_pages_str, username))
-            conn.commit(); return True
+            conn.commit()
+            invalidate_user_context(username)
+            return True
         except mysql.connector.Error as err:
             logging.error(f"Error in update_user_permissions: {err}", exc_info=True); return False
         finally:
@@ -635,6 +964,8 @@ class DatabaseManager:
             with conn.cursor() as cursor:
                 cursor.execute("UPDATE `users` SET role = %s WHERE username = %s", (new_role, username))
             conn.commit()
+            self.rebuild_hierarchy_closure()
+            invalidate_user_context()  # also changes who can see this user's data
         except mysql.connector.Error as err:
             logging.error(f"Error in update_user_role: {err}", exc_info=True)
         finally:
@@ -665,6 +996,7 @@ class DatabaseManager:
                 sql = "UPDATE users SET disabled = %s WHERE username = %s"
                 cursor.execute(sql, (disabled, username))
             conn.commit()
+            invalidate_user_context(username)
             return True
         except mysql.connector.Error as err:
             logging.error(f"Error setting disabled status for {username}: {err}", exc_info=True)
@@ -685,6 +1017,8 @@ class DatabaseManager:
                 sql = "DELETE FROM users WHERE username = %s"
                 cursor.execute(sql, (username,))
             conn.commit()
+            self.rebuild_hierarchy_closure()
+            invalidate_user_context()
             return True
         except mysql.connector.Error as err:
             logging.error(f"Error deleting user {username}: {err}", exc_info=True)
@@ -699,6 +1033,8 @@ class DatabaseManager:
             with conn.cursor() as cursor:
                 cursor.execute("UPDATE `users` SET reports_to = %s WHERE username = %s", (manager, username))
             conn.commit()
+            self.rebuild_hierarchy_closure()
+            invalidate_user_context()  # both the previous and the new manager's teams change
         except mysql.connector.Error as err:
             logging.error(f"Error in update_user_mapping: {err}", exc_info=True)
         finally:
@@ -711,20 +1047,29 @@ class DatabaseManager:
             with conn.cursor() as cursor:
                 cursor.execute("UPDATE `users` SET mapped_to_management = %s WHERE username = %s AND role = 'Manager'", (management_user, manager_username))
             conn.commit()
+            self.rebuild_hierarchy_closure()
+            invalidate_user_context()
         except mysql.connector.Error as err:
             logging.error(f"Error in update_manager_to_management_mapping: {err}", exc_info=True)
         finally:
             if conn: conn.close()
 
     def update_user_password(self, username, new_password):
-        hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        """Returns True on success. Sessions signed with the old password stop being accepted."""
+        try:
+            hashed_password = hash_password(new_password)
+        except PasswordHashingBusy:
+            logging.warning(f"Password change for {username} rejected: password hashing pool is busy.")
+            return False
         conn = self._get_connection()
         try:
             with conn.cursor() as cursor:
                 cursor.execute("UPDATE `users` SET hashed_password = %s WHERE username = %s", (hashed_password, username))
             conn.commit()
+            return True
         except mysql.connector.Error as err:
             logging.error(f"Error in update_user_password: {err}", exc_info=True)
+            return False
         finally:
             if conn: conn.close()
 
@@ -744,6 +1089,18 @@ class DatabaseManager:
         finally:
             if conn: conn.close()
 
+    def update_validation_run_totals(self, run_id, total_records, total_exceptions):
+        """Sets the final counts on a run that was created before its rows were streamed in."""
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('''UPDATE `validation_runs` SET total_records = %s, total_exceptions = %s WHERE id = %s''', (total_records, total_exceptions, run_id))
+            conn.commit()
+        except mysql.connector.Error as err:
+            logging.error(f"Error updating totals for run_id {run_id}: {err}", exc_info=True); conn.rollback()
+        finally:
+            if conn: conn.close()
+
     def save_excel_report(self, run_id, excel_data):
         if not excel_data: return
         conn = self._get_connection()
@@ -756,21 +1113,167 @@ class DatabaseManager:
         finally:
             if conn: conn.close()
 
-    def delete_run(self, run_id):
+    def delete_run(self, run_id, batch_size=RUN_DELETE_BATCH_SIZE, progress=None):
+        """
+        Deletes a run with everything attached to it, hot and archived, in id batches of
+        `batch_size` per child table (one short transaction each) and then the run row itself.
+        Unlike one cascading DELETE, no table stays locked for the whole run, so uploads keep
+        working meanwhile. `progress(deleted_rows, total_rows, table)` is called after every batch.
+        """
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                # Marked first so the retention job leaves the run alone.
+                cursor.execute("UPDATE `validation_runs` SET status = 'Deleting' WHERE id = %s", (run_id,))
+                totals = {}
+                for table, _ in RUN_DELETE_STEPS:
+                    cursor.execute(f"SELECT COUNT(*) FROM `{table}` WHERE run_id = %s", (run_id,))
+                    totals[table] = cursor.fetchone()[0]
+        except mysql.connector.Error as err:
+            logging.error(f"Error preparing deletion of run ID {run_id}: {err}", exc_info=True)
+            return False
+        finally:
+            if conn: conn.close()
+
+        total_rows = sum(totals.values())
+        deleted_rows = 0
+        if progress: progress(0, total_rows, None)
+
+        def on_batch(table, count):
+            nonlocal deleted_rows
+            deleted_rows += count
+            if progress: progress(deleted_rows, total_rows, table)
+
+        try:
+            for table, dependents in RUN_DELETE_STEPS:
+                if totals[table]:
+                    self._remove_rows(table, "run_id = %s", (run_id,), batch_size, dependents=dependents, archive=False,
+                                      on_batch=lambda count, table=table: on_batch(table, count))
+        except mysql.connector.Error as err:
+            logging.error(f"Error deleting rows of run ID {run_id}: {err}", exc_info=True)
+            return False
+
         conn = self._get_connection()
         try:
             with conn.cursor() as cursor:
-                cursor.execute("DELETE FROM `validation_runs` WHERE id = %s", (run_id,)); conn.commit(); return True
+                cursor.execute("DELETE FROM `archived_runs` WHERE run_id = %s", (run_id,))
+                cursor.execute("DELETE FROM `validation_runs` WHERE id = %s", (run_id,))
+            conn.commit()
+            return True
         except mysql.connector.Error as err:
             logging.error(f"Error deleting run ID {run_id}: {err}", exc_info=True); conn.rollback(); return False
         finally:
             if conn: conn.close()
 
+    # --- Retention / archival ---
+
+    def get_runs_to_archive(self, cutoff):
+        """Runs uploaded before `cutoff` that have not been archived yet, oldest first."""
+        conn = self._get_connection()
+        try:
+            query = """
+                SELECT id, filename, upload_time, total_records, total_exceptions FROM `validation_runs`
+                WHERE upload_time < %s AND (status IS NULL OR status NOT IN ('Archived', 'Deleting')) ORDER BY id
+            """
+            return pd.read_sql_query(query, conn, params=(cutoff,))
+        except mysql.connector.Error as err:
+            logging.error(f"Error in get_runs_to_archive: {err}", exc_info=True)
+            return pd.DataFrame()
+        finally:
+            if conn: conn.close()
+
+    def _remove_rows(self, table, where_sql, params, batch_size=5000, dependents=(), archive=True, on_batch=None):
+        """
+        Moves the rows of `table` matching where_sql to `<table>_archive` (or just deletes them
+        when archive is False) in id batches, one short transaction per batch, so no long-lived
+        locks are taken on the hot table. `dependents` are (child_table, fk_column, keep_copy)
+        tuples: child rows are deleted before their parents and, when archiving, copied to
+        `<child_table>_archive` first if keep_copy is set. `on_batch(rows)` is called after each
+        committed batch. Returns the number of rows removed.
+        """
+        moved = 0
+        conn = self._get_connection()
+        try:
+            conn.autocommit = False
+            with conn.cursor() as cursor:
+                while True:
+                    cursor.execute(f"SELECT id FROM `{table}` WHERE {where_sql} ORDER BY id LIMIT %s", (*params, batch_size))
+                    ids = tuple(row[0] for row in cursor.fetchall())
+                    if not ids:
+                        break
+                    placeholders = ','.join(['%s'] * len(ids))
+                    for child_table, fk_column, keep_copy in dependents:
+                        if archive and keep_copy:
+                            cursor.execute(f"INSERT IGNORE INTO `{child_table}_archive` SELECT * FROM `{child_table}` WHERE `{fk_column}` IN ({placeholders})", ids)
+                        cursor.execute(f"DELETE FROM `{child_table}` WHERE `{fk_column}` IN ({placeholders})", ids)
+                    if archive:
+                        # INSERT IGNORE keeps a re-run after an interrupted batch idempotent.
+                        cursor.execute(f"INSERT IGNORE INTO `{table}_archive` SELECT * FROM `{table}` WHERE id IN ({placeholders})", ids)
+                    cursor.execute(f"DELETE FROM `{table}` WHERE id IN ({placeholders})", ids)
+                    conn.commit()
+                    moved += len(ids)
+                    if on_batch: on_batch(len(ids))
+            return moved
+        except mysql.connector.Error:
+            conn.rollback()
+            raise
+        finally:
+            if conn: conn.close()
+
+    def archive_run(self, run_id, batch_size=5000, include_fingerprints=False):
+        """
+        Moves a run's exceptions (with their correction logs), suspicious-transaction log and,
+        with include_fingerprints, its fingerprints to the archive tables. Fingerprints stay hot by
+        default because get_historical_fingerprints reads only the hot table. The run and its
+        summaries stay and are marked 'Archived'. Returns the moved row counts, or None on error.
+        """
+        try:
+            counts = {
+                'exception_rows': self._remove_rows(
+                    'exceptions', "run_id = %s", (run_id,), batch_size,
+                    dependents=[('exception_reason_links', 'exception_id', False), ('correction_logs', 'exception_id', True)]
+                ),
+                'suspicious_rows': self._remove_rows('suspicious_transactions_log', "run_id = %s", (run_id,), batch_size),
+                'fingerprint_rows': self._remove_rows('transaction_fingerprints', "run_id = %s", (run_id,), batch_size) if include_fingerprints else 0,
+            }
+        except mysql.connector.Error as err:
+            logging.error(f"Error archiving run {run_id}: {err}", exc_info=True)
+            return None
+
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """INSERT INTO `archived_runs` (run_id, exception_rows, suspicious_rows, fingerprint_rows) VALUES (%s, %s, %s, %s)
+                       ON DUPLICATE KEY UPDATE archived_at = CURRENT_TIMESTAMP, exception_rows = exception_rows + VALUES(exception_rows),
+                       suspicious_rows = suspicious_rows + VALUES(suspicious_rows), fingerprint_rows = fingerprint_rows + VALUES(fingerprint_rows)""",
+                    (run_id, counts['exception_rows'], counts['suspicious_rows'], counts['fingerprint_rows'])
+                )
+                cursor.execute("UPDATE `validation_runs` SET status = 'Archived' WHERE id = %s", (run_id,))
+            conn.commit()
+            return counts
+        except mysql.connector.Error as err:
+            logging.error(f"Error recording archived run {run_id}: {err}", exc_info=True)
+            return None
+        finally:
+            if conn: conn.close()
+
+    def archive_read_notifications(self, cutoff, batch_size=5000):
+        """Moves notifications that were read and created before `cutoff` to notifications_archive."""
+        try:
+            return self._remove_rows('notifications', "is_read = TRUE AND created_at < %s", (cutoff,), batch_size)
+        except mysql.connector.Error as err:
+            logging.error(f"Error archiving notifications: {err}", exc_info=True)
+            return 0
+
     def save_exceptions(self, run_id, exceptions_df):
         conn = self._get_connection()
         if exceptions_df.empty: return
         try:
+            conn.autocommit = False
             with conn.cursor() as cursor:
+                cursor.execute("SELECT COALESCE(MAX(id), 0) FROM `exceptions` WHERE run_id = %s", (run_id,))
+                last_existing_id = cursor.fetchone()[0]
                 data_to_insert = []
                 for _, row_series in exceptions_df.iterrows():
                     original_row_data_dict = row_series.to_dict()
@@ -787,7 +1290,9 @@ class DatabaseManager:
                         row_series.get('Business Unit.Name', ''), row_series.get('Account2.Code', ''),
                         row_series.get('Sub Ledger.Code', ''),
                         row_series.get('Narration', ''), # This is new
-                        serialized_row_data
+                        serialized_row_data,
+                        self._exact_net_amount(row_series.get('Net amount')),
+                        self._record_name(row_series.get('Account2.Name')), self._record_name(row_series.get('SubLedger.Name')),
                     ))
                 if data_to_insert:
                     cursor.executemany('''
@@ -795,15 +1300,184 @@ class DatabaseManager:
                             run_id, department, sub_department, created_user, modified_user,
                             exception_reason, severity, net_amount, location, crop, activity,
                             function_name, vertical_name, region_name, zone_name, business_unit,
-                            account2_code, sub_ledger_code, narration, original_row_data
-                        ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                            account2_code, sub_ledger_code, narration, original_row_data,
+                            net_amount_exact, account2_name, sub_ledger_name
+                        ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
                     ''', data_to_insert)
+                    # Chunks of one run are saved one after another, so the new rows are those above the previous maximum.
+                    cursor.execute(
+                        "SELECT id, run_id, created_user, exception_reason FROM `exceptions` WHERE run_id = %s AND id > %s",
+                        (run_id, last_existing_id)
+                    )
+                    self._link_exception_reasons(cursor, cursor.fetchall())
             conn.commit()
         except mysql.connector.Error as err:
             logging.error(f"Error in save_exceptions (MySQL): {err}", exc_info=True); conn.rollback(); raise
         finally:
             if conn: conn.close()
 
+    @staticmethod
+    def _exact_net_amount(value):
+        """The amount as a Decimal rounded to cents for the DECIMAL(18,2) column; None when missing or not a number."""
+        if value is None or isinstance(value, bool):
+            return None
+        try:
+            amount = Decimal(str(value).strip().replace(',', ''))
+        except InvalidOperation:
+            return None
+        return amount.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP) if amount.is_finite() else None
+
+    @staticmethod
+    def _record_name(value):
+        return None if value is None or (not isinstance(value, str) and pd.isna(value)) or str(value).strip() == '' else str(value)
+
+    def backfill_exception_list_columns(self, batch_size=5000):
+        """
+        Fills net_amount_exact, account2_name and sub_ledger_name for exceptions saved before
+        those columns existed, from their original_row_data, in id order and batches. Falls
+        back to the FLOAT net_amount when the record has no usable amount.
+        """
+        conn = self._get_connection()
+        total_rows = 0
+        try:
+            last_id = 0
+            conn.autocommit = False
+            with conn.cursor() as cursor:
+                while True:
+                    cursor.execute(
+                        "SELECT id, net_amount, original_row_data FROM `exceptions` "
+                        "WHERE id > %s AND net_amount_exact IS NULL AND net_amount IS NOT NULL ORDER BY id LIMIT %s",
+                        (last_id, batch_size)
+                    )
+                    batch = cursor.fetchall()
+                    if not batch:
+                        break
+                    updates = []
+                    for exception_id, net_amount, original_row_data in batch:
+                        try:
+                            record = json.loads(original_row_data) if original_row_data else {}
+                        except (TypeError, ValueError):
+                            record = {}
+                        exact_amount = self._exact_net_amount(record.get('Net amount'))
+                        if exact_amount is None:
+                            exact_amount = self._exact_net_amount(round(float(net_amount), 2))
+                        updates.append((exact_amount, self._record_name(record.get('Account2.Name')),
+                                        self._record_name(record.get('SubLedger.Name')), exception_id))
+                    cursor.executemany(
+                        "UPDATE `exceptions` SET net_amount_exact = %s, account2_name = COALESCE(account2_name, %s), "
+                        "sub_ledger_name = COALESCE(sub_ledger_name, %s) WHERE id = %s",
+                        updates
+                    )
+                    conn.commit()
+                    total_rows += len(updates)
+                    last_id = batch[-1][0]
+            logging.info(f"Backfilled exact amounts and names for {total_rows} exceptions.")
+            return total_rows
+        except mysql.connector.Error as err:
+            logging.error(f"Error backfilling exception list columns: {err}", exc_info=True)
+            conn.rollback()
+            return total_rows
+        finally:
+            if conn: conn.close()
+
+    @staticmethod
+    def split_exception_reasons(exception_reason):
+        """The individual reasons of a '; '-joined exception_reason string."""
+        if exception_reason is None:
+            return []
+        return list(dict.fromkeys(r.strip()[:255] for r in str(exception_reason).split('; ') if r.strip()))
+
+    def _link_exception_reasons(self, cursor, exception_rows):
+        """
+        Writes exception_reason_links for (id, run_id, created_user, exception_reason) rows,
+        adding unseen reasons to the exception_reasons dictionary. Runs on the caller's cursor
+        so the links commit together with the exceptions.
+        """
+        rows = [(row[0], row[1], row[2], self.split_exception_reasons(row[3])) for row in exception_rows]
+        reasons = sorted({reason for *_, row_reasons in rows for reason in row_reasons})
+        if not reasons:
+            return 0
+        cursor.executemany("INSERT IGNORE INTO `exception_reasons` (reason) VALUES (%s)", [(r,) for r in reasons])
+        reason_ids = {}
+        for start in range(0, len(reasons), DETAIL_FETCH_BATCH_SIZE):
+            batch = reasons[start:start + DETAIL_FETCH_BATCH_SIZE]
+            cursor.execute(f"SELECT reason, id FROM `exception_reasons` WHERE reason IN ({','.join(['%s'] * len(batch))})", tuple(batch))
+            reason_ids.update({reason.lower(): reason_id for reason, reason_id in cursor.fetchall()})
+        links = [
+            (exception_id, reason_ids[reason.lower()], run_id, created_user)
+            for exception_id, run_id, created_user, row_reasons in rows
+            for reason in row_reasons
+        ]
+        cursor.executemany(
+            "INSERT IGNORE INTO `exception_reason_links` (exception_id, reason_id, run_id, created_user) VALUES (%s, %s, %s, %s)",
+            links
+        )
+        return len(links)
+
+    def backfill_exception_reason_links(self, batch_size=5000):
+        """Links the reasons of exceptions that have no reason links yet (saved before the reason tables existed), in id order and batches."""
+        conn = self._get_connection()
+        total_links = 0
+        try:
+            last_id = 0
+            with conn.cursor() as cursor:
+                while True:
+                    cursor.execute(
+                        "SELECT e.id, e.run_id, e.created_user, e.exception_reason FROM `exceptions` e WHERE e.id > %s "
+                        "AND NOT EXISTS (SELECT 1 FROM `exception_reason_links` l WHERE l.exception_id = e.id) ORDER BY e.id LIMIT %s",
+                        (last_id, batch_size)
+                    )
+                    batch = cursor.fetchall()
+                    if not batch:
+                        break
+                    total_links += self._link_exception_reasons(cursor, batch)
+                    last_id = batch[-1][0]
+            logging.info(f"Backfilled {total_links} exception reason links.")
+            return total_links
+        except mysql.connector.Error as err:
+            logging.error(f"Error backfilling exception reason links: {err}", exc_info=True)
+            return total_links
+        finally:
+            if conn: conn.close()
+
+    def get_exception_reason_counts(self, run_ids, users=None, user_role=None, username=None, include_accepted=True, by_user=False):
+        """
+        Occurrences of each exception reason in the given runs as a DataFrame (reason, count),
+        most frequent first. `users` limits it to those creators, user_role/username apply the
+        usual visibility scope, and include_accepted=False skips accepted exceptions. With
+        by_user, counts are per creator instead: (user, reason, count).
+        """
+        empty_columns = ['user', 'reason', 'count'] if by_user else ['reason', 'count']
+        if not run_ids:
+            return pd.DataFrame(columns=empty_columns)
+        conn = self._get_connection()
+        try:
+            user_column = "l.created_user AS `user`, " if by_user else ""
+            query = f"SELECT {user_column}r.reason, COUNT(*) AS `count` FROM `exception_reason_links` l JOIN `exception_reasons` r ON r.id = l.reason_id"
+            if not include_accepted:
+                query += " JOIN `exceptions` e ON e.id = l.exception_id AND e.is_accepted = FALSE"
+            query += f" WHERE l.run_id IN ({','.join(['%s'] * len(run_ids))})"
+            params = [int(run_id) for run_id in run_ids]
+            if users is not None:
+                if not users:
+                    return pd.DataFrame(columns=empty_columns)
+                query += f" AND l.created_user IN ({','.join(['%s'] * len(users))})"
+                params.extend(users)
+            scope_sql, scope_params = self._visibility_filter('l.created_user', user_role, username)
+            if scope_sql:
+                query += f" AND {scope_sql}"
+                params.extend(scope_params)
+            if by_user:
+                query += " GROUP BY l.created_user, r.id, r.reason ORDER BY l.created_user, `count` DESC, r.reason"
+            else:
+                query += " GROUP BY r.id, r.reason ORDER BY `count` DESC, r.reason"
+            return pd.read_sql_query(query, conn, params=tuple(params))
+        except mysql.connector.Error as err:
+            logging.error(f"Error in get_exception_reason_counts: {err}", exc_info=True)
+            return pd.DataFrame(columns=empty_columns)
+        finally:
+            if conn: conn.close()
+
     def save_transaction_fingerprints(self, run_id, fingerprints_to_save):
         """Saves a list of unique transaction fingerprints to the new historical table."""
         if not fingerprints_to_save:
@@ -830,7 +1504,10 @@ class DatabaseManager:
         conn = self._get_connection()
         try:
             with conn.cursor() as cursor:
-                data_to_insert = [(run_id, dept, stats['total_records'], stats['exception_records'], stats['exception_rate']) for dept, stats in department_statistics.items()]
+                data_to_insert = [
+                    (run_id, dept, int(stats['total_records']), int(stats['exception_records']), round(float(stats['exception_rate']), 2))
+                    for dept, stats in department_statistics.items()
+                ]
                 if data_to_insert:
                     cursor.executemany('''INSERT INTO `department_summary` (run_id, department, total_records, exception_records, exception_rate) VALUES (%s, %s, %s, %s, %s)''', data_to_insert)
                 conn.commit()
@@ -844,59 +1521,40 @@ class DatabaseManager:
             if 'Created user' not in df.columns:
                 logging.error(f"Run ID {run_id}: 'Created user' column not in source file. Cannot save user performance.")
                 return
-    
-            # --- FIX: Standardize user names to prevent case-sensitivity and whitespace issues ---
-            df_copy = df.copy()
-            exceptions_df_copy = exceptions_df.copy()
-            df_copy['Created user'] = df_copy['Created user'].fillna('').astype(str).str.strip()
-            exceptions_df_copy['Created user'] = exceptions_df_copy['Created user'].fillna('').astype(str).str.strip()
-    
-            # --- FIX: Group by standardized user names ---
-            total_records_by_user = df_copy[df_copy['Created user'] != ''].groupby('Created user').size().reset_index(name='total_records')
-    
-            if exceptions_df_copy.empty or 'Created user' not in exceptions_df_copy.columns:
-                exception_records_by_user = pd.DataFrame(columns=['Created user', 'exception_records'])
-            else:
-                exception_records_by_user = exceptions_df_copy[exceptions_df_copy['Created user'] != ''].groupby('Created user').size().reset_index(name='exception_records')
-    
-            # --- FIX: Use a robust 'outer' merge to combine the data ---
-            if total_records_by_user.empty and exception_records_by_user.empty:
-                logging.warning(f"Run ID {run_id}: No user data found to save for performance.")
-                return
-            
-            user_stats = pd.merge(total_records_by_user, exception_records_by_user, on='Created user', how='outer')
-            
-            user_stats['total_records'] = user_stats['total_records'].fillna(0).astype(int)
-            user_stats['exception_records'] = user_stats['exception_records'].fillna(0).astype(int)
-    
-            user_stats['exception_rate'] = (user_stats['exception_records'] / user_stats['total_records'].replace(0, pd.NA) * 100).fillna(0).round(2)
-    
-            if user_stats.empty:
-                logging.error(f"Run ID {run_id}: Final user_stats DataFrame is empty. Aborting save.")
-                return
-                
-            conn = self._get_connection()
-            try:
-                with conn.cursor() as cursor:
-                    data_to_insert_perf = [
-                        (run_id, row['Created user'], row['total_records'], row['exception_records'], row['exception_rate'])
-                        for _, row in user_stats.iterrows()
-                    ]
-                    if data_to_insert_perf:
-                        cursor.executemany(
-                            '''INSERT INTO `user_performance` (run_id, `user`, total_records, exception_records, exception_rate) VALUES (%s,%s,%s,%s,%s)''',
-                            data_to_insert_perf
-                        )
-                        conn.commit()
-            except mysql.connector.Error as err:
-                 logging.error(f"DB ERROR in save_user_performance for run ID {run_id}: {err}", exc_info=True)
-                 conn.rollback()
-            finally:
-                if conn: conn.close()
-    
+            self.save_user_performance_stats(run_id, compute_user_stats(df, exceptions_df))
         except Exception as e:
             logging.error(f"LOGIC ERROR in save_user_performance for run ID {run_id}: {e}", exc_info=True)
 
+    def save_user_performance_stats(self, run_id, user_stats):
+        """Inserts pre-aggregated per-user counts (see compute_user_stats / merge_user_stats)."""
+        if user_stats.empty:
+            logging.warning(f"Run ID {run_id}: No user data found to save for performance.")
+            return
+
+        total_records = user_stats['total_records'].fillna(0).to_numpy(dtype=np.int64)
+        exception_records = user_stats['exception_records'].fillna(0).to_numpy(dtype=np.int64)
+        exception_rates = np.round(np.divide(exception_records * 100.0, total_records, out=np.zeros(len(total_records)), where=total_records > 0), 2)
+
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                # Built column-wise (no per-row Series); executemany sends it as one multi-row INSERT.
+                data_to_insert_perf = list(zip(
+                    [run_id] * len(user_stats), user_stats['Created user'].astype(str).tolist(),
+                    total_records.tolist(), exception_records.tolist(), exception_rates.tolist()
+                ))
+                if data_to_insert_perf:
+                    cursor.executemany(
+                        '''INSERT INTO `user_performance` (run_id, `user`, total_records, exception_records, exception_rate) VALUES (%s,%s,%s,%s,%s)''',
+                        data_to_insert_perf
+                    )
+                    conn.commit()
+        except mysql.connector.Error as err:
+             logging.error(f"DB ERROR in save_user_performance for run ID {run_id}: {err}", exc_info=True)
+             conn.rollback()
+        finally:
+            if conn: conn.close()
+
     def get_validation_history(self, user_role=None, username=None, managed_users=None):
         conn = self._get_connection()
         try:
@@ -904,25 +1562,16 @@ class DatabaseManager:
             params = ()
             
             # --- UPDATED HIERARCHICAL LOGIC ---
-            if user_role == 'User' and username:
-                # User sees only runs where they have performance records
-                query = '''
-                    SELECT vr.* FROM `validation_runs` vr 
-                    JOIN (SELECT DISTINCT run_id FROM `user_performance` WHERE `user` = %s) up 
-                    ON vr.id = up.run_id
-                '''
-                params = (username,)
-            elif user_role == 'Manager' and managed_users is not None and username is not None:
-                # Manager sees runs involving themselves or their team
-                team_members = managed_users + [username]
-                if not team_members: return pd.DataFrame() # Return empty if team is empty
-                placeholders = ','.join(['%s'] * len(team_members))
+            # User sees runs where they have performance records; Manager sees runs involving
+            # themselves or anyone in their reporting tree.
+            scope_sql, scope_params = self._visibility_filter('`user`', user_role, username)
+            if scope_sql:
                 query = f'''
                     SELECT vr.* FROM `validation_runs` vr 
-                    JOIN (SELECT DISTINCT run_id FROM `user_performance` WHERE `user` IN ({placeholders})) up 
+                    JOIN (SELECT DISTINCT run_id FROM `user_performance` WHERE {scope_sql}) up 
                     ON vr.id = up.run_id
                 '''
-                params = tuple(team_members)
+                params = tuple(scope_params)
             # For 'Management' and 'Super User', the original query fetching all runs is used.
             
             query += ' ORDER BY upload_time DESC'
@@ -946,18 +1595,11 @@ class DatabaseManager:
                 # Management and Super User have universal access
                 if user_role in ['Management', 'Super User']:
                     has_access = True
-                elif user_role == 'User' and username:
-                    # Check if the user participated in this specific run
-                    cursor.execute("SELECT 1 FROM `user_performance` WHERE run_id = %s AND `user` = %s", (run_id, username))
-                    if cursor.fetchone(): has_access = True
-                elif user_role == 'Manager' and username and managed_users is not None:
-                    # Check if the manager or anyone on their team participated
-                    team_members = managed_users + [username]
-                    if team_members:
-                        placeholders = ','.join(['%s'] * len(team_members))
-                        query = f"SELECT 1 FROM `user_performance` WHERE run_id = %s AND `user` IN ({placeholders})"
-                        params = (run_id,) + tuple(team_members)
-                        cursor.execute(query, params)
+                else:
+                    # Check if the user (or, for a Manager, anyone in their tree) participated in this run
+                    scope_sql, scope_params = self._visibility_filter('`user`', user_role, username)
+                    if scope_sql:
+                        cursor.execute(f"SELECT 1 FROM `user_performance` WHERE run_id = %s AND {scope_sql} LIMIT 1", (run_id, *scope_params))
                         if cursor.fetchone(): has_access = True
 
                 if not has_access:
@@ -975,30 +1617,35 @@ class DatabaseManager:
             if conn.is_connected():
                 conn.close()
 
-    def get_exceptions_by_run(self, run_id):
+    def _exception_list_columns(self, include_row_data):
+        if include_row_data:
+            return "id, run_id, exception_reason, severity, original_row_data"
+        # Rows the backfill has not reached yet fall back to the FLOAT amount.
+        return ", ".join(
+            "COALESCE(`net_amount_exact`, `net_amount`) AS `net_amount_exact`" if c == 'net_amount_exact' else f"`{c}`"
+            for c in EXCEPTION_LIST_COLUMNS
+        )
+
+    def _exception_list_df(self, raw_exceptions_df, include_row_data):
+        if include_row_data:
+            return self._exception_records_df(raw_exceptions_df)
+        if raw_exceptions_df.empty:
+            return pd.DataFrame()
+        # Blank denormalised values were null in the original record
+        df = raw_exceptions_df.rename(columns=EXCEPTION_LIST_COLUMNS).replace('', np.nan)
+        df['Net amount'] = pd.to_numeric(df['Net amount'], errors='coerce')
+        return df
+
+    def get_exceptions_by_run(self, run_id, include_row_data=False):
+        """
+        Unaccepted exceptions of one run with the denormalised list columns. With
+        include_row_data, each record is expanded from original_row_data instead.
+        """
         conn = self._get_connection()
         try:
-            query = "SELECT id, run_id, exception_reason, severity, original_row_data FROM `exceptions` WHERE run_id = %s AND is_accepted = FALSE"
+            query = f"SELECT {self._exception_list_columns(include_row_data)} FROM `exceptions` WHERE run_id = %s AND is_accepted = FALSE"
             raw_exceptions_df = pd.read_sql_query(query, conn, params=(run_id,))
-
-            if raw_exceptions_df.empty:
-                return pd.DataFrame()
-
-            processed_records = []
-            for _, db_row in raw_exceptions_df.iterrows():
-                try:
-                    # JSON type from DB can be directly loaded if it's a string, or used if it's already a dict
-                    record = db_row['original_row_data'] if isinstance(db_row['original_row_data'], dict) else json.loads(db_row['original_row_data'])
-                except (json.JSONDecodeError, TypeError):
-                    record = {}
-
-                record['id'] = db_row['id']
-                record['run_id'] = db_row['run_id']
-                record['Exception Reasons'] = db_row['exception_reason']
-                record['Severity'] = db_row['severity']
-                processed_records.append(record)
-
-            return pd.DataFrame(processed_records) if processed_records else pd.DataFrame()
+            return self._exception_list_df(raw_exceptions_df, include_row_data)
 
         except Exception as e:
             st.error(f"An error occurred while retrieving exception details for run {run_id}: {e}")
@@ -1007,8 +1654,79 @@ class DatabaseManager:
         finally:
             conn.close()
 
-    def add_or_update_correction_status(self, run_id, username, status):
-        """Inserts or updates a user's correction status for a specific run using MySQL's syntax."""
+    def get_exceptions_for_runs(self, run_ids, user_role=None, username=None, include_row_data=False):
+        """
+        Unaccepted exceptions of several runs in one query, limited in SQL to the rows
+        user_role/username may see. Same shape as get_exceptions_by_run.
+        """
+        if not run_ids:
+            return pd.DataFrame()
+        conn = self._get_connection()
+        try:
+            placeholders = ','.join(['%s'] * len(run_ids))
+            query = f"SELECT {self._exception_list_columns(include_row_data)} FROM `exceptions` WHERE run_id IN ({placeholders}) AND is_accepted = FALSE"
+            params = [int(run_id) for run_id in run_ids]
+            scope_sql, scope_params = self._visibility_filter('created_user', user_role, username)
+            if scope_sql:
+                query += f" AND {scope_sql}"
+                params.extend(scope_params)
+            query += " ORDER BY run_id DESC, id"
+            raw_exceptions_df = pd.read_sql_query(query, conn, params=tuple(params))
+            return self._exception_list_df(raw_exceptions_df, include_row_data)
+        except Exception as e:
+            st.error(f"An error occurred while retrieving exception details: {e}")
+            logging.error(f"Error in get_exceptions_for_runs for {len(run_ids)} runs: {e}", exc_info=True)
+            return pd.DataFrame()
+        finally:
+            conn.close()
+
+    def get_exception_data_version(self, run_ids):
+        """
+        Cheap fingerprint of the exceptions of `run_ids` (row count, highest id, accepted count).
+        It changes whenever exceptions are added, accepted, archived or deleted, so it can key
+        caches of anything derived from them.
+        """
+        if not run_ids:
+            return ""
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                placeholders = ','.join(['%s'] * len(run_ids))
+                cursor.execute(f"""
+                    SELECT COUNT(*), COALESCE(MAX(id), 0), COALESCE(SUM(is_accepted), 0)
+                    FROM `exceptions` WHERE run_id IN ({placeholders})
+                """, tuple(int(run_id) for run_id in run_ids))
+                return "-".join(str(int(value)) for value in cursor.fetchone())
+        except mysql.connector.Error as err:
+            logging.error(f"Error in get_exception_data_version: {err}", exc_info=True)
+            return f"error-{time.time()}"  # never matches a cached entry
+        finally:
+            if conn: conn.close()
+
+    @staticmethod
+    def _exception_records_df(raw_exceptions_df):
+        """Expands original_row_data of raw exception rows into one record per exception."""
+        if raw_exceptions_df.empty:
+            return pd.DataFrame()
+
+        processed_records = []
+        for db_row in raw_exceptions_df.itertuples(index=False):
+            try:
+                # JSON type from DB can be directly loaded if it's a string, or used if it's already a dict
+                record = db_row.original_row_data if isinstance(db_row.original_row_data, dict) else json.loads(db_row.original_row_data)
+            except (json.JSONDecodeError, TypeError):
+                record = {}
+
+            record['id'] = db_row.id
+            record['run_id'] = db_row.run_id
+            record['Exception Reasons'] = db_row.exception_reason
+            record['Severity'] = db_row.severity
+            processed_records.append(record)
+
+        return pd.DataFrame(processed_records) if processed_records else pd.DataFrame()
+
+    def add_or_update_correction_status(self, run_id, username, status):
+        """Inserts or updates a user's correction status for a specific run using MySQL's syntax."""
         conn = self._get_connection()
         try:
             with conn.cursor() as cursor:
@@ -1054,19 +1772,15 @@ class DatabaseManager:
         conn = self._get_connection()
         try:
             # Base query always excludes accepted entries
-            query = "SELECT * FROM `exceptions` WHERE is_accepted = FALSE"
+            columns = ", ".join(f"`{c}`" for c in CORRECTION_ENTRY_LIST_COLUMNS)
+            query = f"SELECT {columns} FROM `exceptions` WHERE is_accepted = FALSE"
             params = []
 
             # Hierarchical access control
-            if user_role == 'User' and username:
-                query += " AND created_user = %s"
-                params.append(username)
-            elif user_role == 'Manager' and managed_users is not None and username is not None:
-                team_members = managed_users + [username]
-                if not team_members: return pd.DataFrame()
-                placeholders = ','.join(['%s'] * len(team_members))
-                query += f" AND created_user IN ({placeholders})"
-                params.extend(team_members)
+            scope_sql, scope_params = self._visibility_filter('created_user', user_role, username)
+            if scope_sql:
+                query += f" AND {scope_sql}"
+                params.extend(scope_params)
             # For Management/Super User, no additional user filter is needed.
 
             # Narration text filter
@@ -1155,19 +1869,15 @@ class DatabaseManager:
         conn = self._get_connection()
         try:
             # --- MODIFIED --- Query now also excludes entries where correction_status is 'Yes'
-            query = "SELECT * FROM `exceptions` WHERE is_accepted = FALSE AND correction_status != 'Yes'"
+            columns = ", ".join(f"`{c}`" for c in CORRECTION_ENTRY_LIST_COLUMNS)
+            query = f"SELECT {columns} FROM `exceptions` WHERE is_accepted = FALSE AND correction_status != 'Yes'"
             params = []
 
             # Hierarchical access control
-            if user_role == 'User' and username:
-                query += " AND created_user = %s"
-                params.append(username)
-            elif user_role == 'Manager' and managed_users is not None and username is not None:
-                team_members = managed_users + [username]
-                if not team_members: return pd.DataFrame()
-                placeholders = ','.join(['%s'] * len(team_members))
-                query += f" AND created_user IN ({placeholders})"
-                params.extend(team_members)
+            scope_sql, scope_params = self._visibility_filter('created_user', user_role, username)
+            if scope_sql:
+                query += f" AND {scope_sql}"
+                params.extend(scope_params)
 
             # --- NEW --- Add optional filters from the UI
             if narration_filter:
@@ -1189,6 +1899,122 @@ class DatabaseManager:
         finally:
             if conn: conn.close()
 
+    def _correction_entries_filter(self, user_role, username, narration_filter=None, filter_user=None, filter_run_id=None):
+        """WHERE clause and params shared by the paged Correction Entries queries."""
+        clauses = ["is_accepted = FALSE", "correction_status != 'Yes'"]
+        params = []
+        scope_sql, scope_params = self._visibility_filter('created_user', user_role, username)
+        if scope_sql:
+            clauses.append(scope_sql)
+            params.extend(scope_params)
+        if narration_filter:
+            clauses.append("narration LIKE %s")
+            params.append(f"%{narration_filter}%")
+        if filter_user:
+            clauses.append("created_user = %s")
+            params.append(filter_user)
+        if filter_run_id:
+            clauses.append("run_id = %s")
+            params.append(int(filter_run_id))
+        return " AND ".join(clauses), params
+
+    def get_correction_entry_filter_options(self, user_role, username=None):
+        """Distinct users and run IDs among the open correction entries in scope, for the page filters."""
+        conn = self._get_connection()
+        try:
+            where_sql, params = self._correction_entries_filter(user_role, username)
+            with conn.cursor() as cursor:
+                cursor.execute(f"SELECT DISTINCT created_user FROM `exceptions` WHERE {where_sql} AND created_user IS NOT NULL ORDER BY created_user", tuple(params))
+                users = [row[0] for row in cursor.fetchall()]
+                cursor.execute(f"SELECT DISTINCT run_id FROM `exceptions` WHERE {where_sql} ORDER BY run_id", tuple(params))
+                run_ids = [row[0] for row in cursor.fetchall()]
+            return users, run_ids
+        except mysql.connector.Error as err:
+            logging.error(f"Error in get_correction_entry_filter_options: {err}", exc_info=True)
+            return [], []
+        finally:
+            if conn: conn.close()
+
+    def count_correction_entries(self, user_role, username=None, narration_filter=None, filter_user=None, filter_run_id=None):
+        """Number of open correction entries matching the filters."""
+        conn = self._get_connection()
+        try:
+            where_sql, params = self._correction_entries_filter(user_role, username, narration_filter, filter_user, filter_run_id)
+            with conn.cursor() as cursor:
+                cursor.execute(f"SELECT COUNT(*) FROM `exceptions` WHERE {where_sql}", tuple(params))
+                return cursor.fetchone()[0]
+        except mysql.connector.Error as err:
+            logging.error(f"Error in count_correction_entries: {err}", exc_info=True)
+            return 0
+        finally:
+            if conn: conn.close()
+
+    def get_correction_entries_page(self, user_role, username=None, narration_filter=None, filter_user=None, filter_run_id=None,
+                                    sort_by='id', descending=True, offset=0, limit=50):
+        """
+        One page of open correction entries, sorted and filtered in SQL. Only the list columns are
+        selected; use get_exception_detail for the original records.
+        """
+        if sort_by not in CORRECTION_ENTRY_SORT_COLUMNS.values():
+            sort_by = 'id'
+        direction = "DESC" if descending else "ASC"
+        conn = self._get_connection()
+        try:
+            where_sql, params = self._correction_entries_filter(user_role, username, narration_filter, filter_user, filter_run_id)
+            columns = ", ".join(f"`{c}`" for c in CORRECTION_ENTRY_LIST_COLUMNS)
+            # id breaks ties so that pages do not overlap when the sort column has duplicates
+            query = (f"SELECT {columns} FROM `exceptions` WHERE {where_sql} "
+                     f"ORDER BY `{sort_by}` {direction}, id {direction} LIMIT %s OFFSET %s")
+            params.extend([int(limit), int(offset)])
+            return pd.read_sql_query(query, conn, params=tuple(params))
+        except mysql.connector.Error as err:
+            logging.error(f"Error in get_correction_entries_page: {err}", exc_info=True)
+            return pd.DataFrame(columns=CORRECTION_ENTRY_LIST_COLUMNS)
+        finally:
+            if conn: conn.close()
+
+    def get_correction_entry_ids(self, user_role, username=None, narration_filter=None, filter_user=None, filter_run_id=None):
+        """IDs of every open correction entry matching the filters (all pages), for bulk actions."""
+        conn = self._get_connection()
+        try:
+            where_sql, params = self._correction_entries_filter(user_role, username, narration_filter, filter_user, filter_run_id)
+            with conn.cursor() as cursor:
+                cursor.execute(f"SELECT id FROM `exceptions` WHERE {where_sql}", tuple(params))
+                return [row[0] for row in cursor.fetchall()]
+        except mysql.connector.Error as err:
+            logging.error(f"Error in get_correction_entry_ids: {err}", exc_info=True)
+            return []
+        finally:
+            if conn: conn.close()
+
+    def get_exception_detail(self, exception_ids):
+        """
+        Original uploaded records of the given exceptions as {id: dict}, fetched in batches.
+        IDs that do not exist or whose data cannot be parsed are left out.
+        """
+        ids = list(dict.fromkeys(int(i) for i in exception_ids))
+        details = {}
+        if not ids:
+            return details
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                for start in range(0, len(ids), DETAIL_FETCH_BATCH_SIZE):
+                    batch = ids[start:start + DETAIL_FETCH_BATCH_SIZE]
+                    placeholders = ','.join(['%s'] * len(batch))
+                    cursor.execute(f"SELECT id, original_row_data FROM `exceptions` WHERE id IN ({placeholders})", tuple(batch))
+                    for exception_id, row_data in cursor.fetchall():
+                        try:
+                            details[exception_id] = row_data if isinstance(row_data, dict) else json.loads(row_data)
+                        except (json.JSONDecodeError, TypeError):
+                            logging.warning(f"original_row_data of exception {exception_id} could not be parsed.")
+            return details
+        except mysql.connector.Error as err:
+            logging.error(f"Error in get_exception_detail for {len(ids)} ids: {err}", exc_info=True)
+            return details
+        finally:
+            if conn: conn.close()
+
 
     def update_exception_status(self, exception_id, new_status, action_by, user_role):
         """
@@ -1325,6 +2151,7 @@ class DatabaseManager:
                 logging.info(f"Executing SQL: {sql} with params: {params}")
                 cursor.execute(sql, params)
             conn.commit()
+            invalidate_user_context(username)
             logging.info(f"Successfully committed notification for '{username}' to the database.")
             return True
         except mysql.connector.Error as err:
@@ -1415,6 +2242,7 @@ class DatabaseManager:
                 """
                 cursor.execute(sql, (username, waived_until, waived_by))
             conn.commit()
+            invalidate_user_context(username)
             return True
         except mysql.connector.Error as err:
             logging.error(f"Error in grant_waiver for {username}: {err}", exc_info=True)
@@ -1442,6 +2270,7 @@ class DatabaseManager:
             with conn.cursor() as cursor:
                 cursor.execute("DELETE FROM clarification_waivers WHERE id = %s", (waiver_id,))
             conn.commit()
+            invalidate_user_context()
             return True
         except mysql.connector.Error as err:
             logging.error(f"Error in revoke_waiver for id {waiver_id}: {err}", exc_info=True)
@@ -1449,8 +2278,8 @@ class DatabaseManager:
         finally:
             if conn: conn.close()
 
-    def get_correction_summary(self, run_ids, accessible_users=None):
-        """Fetches a summary of correction statuses for given runs and users."""
+    def get_correction_summary(self, run_ids, accessible_users=None, user_role=None, username=None):
+        """Fetches a summary of correction statuses for given runs and users (or a role's scope)."""
         if not run_ids: return pd.DataFrame()
         conn = self._get_connection()
         try:
@@ -1464,6 +2293,10 @@ class DatabaseManager:
                 user_placeholders = ','.join(['%s'] * len(accessible_users))
                 perf_query += f" AND `user` IN ({user_placeholders})"
                 params.extend(accessible_users)
+            scope_sql, scope_params = self._visibility_filter('`user`', user_role, username)
+            if scope_sql:
+                perf_query += f" AND {scope_sql}"
+                params.extend(scope_params)
             
             all_participants_df = pd.read_sql_query(perf_query, conn, params=params)
     
@@ -1533,31 +2366,19 @@ class DatabaseManager:
             if conn: conn.close()
     # --- NEW --- Methods for Suspicious Transaction System
     
-    @st.cache_data(ttl=3600)
-    def load_suspense_immunity_list(_self):
-        """Loads and caches the list of account/sub-ledger combinations exempt from suspicious checks."""
-        immunity_file = "reference_data/do not check suspense.xlsx"
-        try:
-            if not os.path.exists(immunity_file):
-                logging.warning(f"Immunity file '{immunity_file}' not found. No transactions will be exempt.")
-                return set()
-            
-            df = pd.read_excel(immunity_file)
-            required_cols = ["Account2.Code", "Sub Ledger.Code"]
-            if not all(col in df.columns for col in required_cols):
-                logging.error(f"Immunity file '{immunity_file}' is missing required columns: {required_cols}")
-                return set()
-
-            df.dropna(subset=required_cols, inplace=True)
-            immunity_set = set(
-                df["Account2.Code"].astype(str).str.strip() + "_" + df["Sub Ledger.Code"].astype(str).str.strip()
-            )
-            logging.info(f"Loaded {len(immunity_set)} immunity combinations from '{immunity_file}'.")
-            return immunity_set
-        except Exception as e:
-            st.error(f"Failed to load suspense immunity file: {e}")
-            logging.error(f"Error loading suspense immunity file: {e}", exc_info=True)
+    def load_suspense_immunity_list(self):
+        """Returns the account/sub-ledger combinations exempt from suspicious checks (from the reference snapshot)."""
+        entry, immunity_file = get_reference_table("suspense_immunity")
+        if entry['status'] == 'missing':
+            logging.warning(f"Immunity file '{immunity_file}' not found. No transactions will be exempt.")
+            return set()
+        if entry['status'] == 'missing_columns':
+            logging.error(f"Immunity file '{immunity_file}' is missing required columns: {REFERENCE_TABLE_FILES['suspense_immunity'][1]}")
             return set()
+        if entry['status'] == 'error':
+            st.error(f"Failed to load suspense immunity file: {entry['detail']}")
+            return set()
+        return set(entry['data'])
 
     def get_rule_options(self, rule_column):
         conn = self._get_connection()
@@ -1652,12 +2473,50 @@ class DatabaseManager:
             if conn and conn.is_connected():
                 conn.close()
             
-    def get_suspicious_transactions_for_admin(self):
+    def _suspicious_log_list_query(self, where_sql, order_sql):
+        """Review-list query: log columns plus the summary fields pulled out of the JSON record."""
+        fields = ", ".join(
+            f"JSON_UNQUOTE(JSON_EXTRACT(original_row_data, '$.\"{field}\"')) AS `{field}`"
+            for field in SUSPICIOUS_LOG_SUMMARY_FIELDS
+        )
+        columns = ", ".join(SUSPICIOUS_LOG_LIST_COLUMNS)
+        return f"SELECT {columns}, {fields} FROM suspicious_transactions_log WHERE {where_sql} ORDER BY {order_sql}"
+
+    def _process_summary_log_df(self, df):
+        if df.empty:
+            return pd.DataFrame()
+        # JSON nulls come back from JSON_UNQUOTE as the string 'null'
+        df[SUSPICIOUS_LOG_SUMMARY_FIELDS] = df[SUSPICIOUS_LOG_SUMMARY_FIELDS].replace('null', None)
+        df['Net amount'] = pd.to_numeric(df['Net amount'], errors='coerce')
+        return df
+
+    def get_suspicious_transaction_detail(self, log_ids):
+        """Original records of the given suspicious-transaction log entries as {id: dict}."""
+        ids = list(dict.fromkeys(int(i) for i in log_ids))
+        if not ids:
+            return {}
         conn = self._get_connection()
         try:
-            query = "SELECT * FROM suspicious_transactions_log WHERE status = 'Pending Admin Review' ORDER BY id DESC"
-            df = pd.read_sql_query(query, conn)
-            return self._process_log_df(df)
+            placeholders = ','.join(['%s'] * len(ids))
+            with conn.cursor() as cursor:
+                cursor.execute(f"SELECT id, original_row_data FROM suspicious_transactions_log WHERE id IN ({placeholders})", tuple(ids))
+                rows = cursor.fetchall()
+            return {log_id: (data if isinstance(data, dict) else json.loads(data)) for log_id, data in rows if data is not None}
+        except (mysql.connector.Error, json.JSONDecodeError, TypeError) as err:
+            logging.error(f"Error in get_suspicious_transaction_detail: {err}", exc_info=True)
+            return {}
+        finally:
+            if conn: conn.close()
+
+    def get_suspicious_transactions_for_admin(self, user_role=None, username=None):
+        conn = self._get_connection()
+        try:
+            where_sql = "status = 'Pending Admin Review'"
+            scope_sql, params = self._visibility_filter('created_user', user_role, username)
+            if scope_sql:
+                where_sql += f" AND {scope_sql}"
+            df = pd.read_sql_query(self._suspicious_log_list_query(where_sql, "id DESC"), conn, params=tuple(params))
+            return self._process_summary_log_df(df)
         finally:
             if conn: conn.close()
 
@@ -1706,6 +2565,203 @@ class DatabaseManager:
         finally:
             if conn: conn.close()
 
+    def save_global_settings(self, values):
+        """Inserts or updates several global_settings keys at once."""
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.executemany(
+                    "INSERT INTO global_settings (setting_key, setting_value) VALUES (%s, %s) "
+                    "ON DUPLICATE KEY UPDATE setting_value = VALUES(setting_value)",
+                    [(key, str(value)) for key, value in values.items()]
+                )
+            conn.commit()
+            return True
+        except mysql.connector.Error as err:
+            logging.error(f"Error saving global settings {list(values)}: {err}", exc_info=True)
+            return False
+        finally:
+            if conn: conn.close()
+
+    # --- Outbound email queue ---
+
+    def enqueue_emails(self, emails, created_by=None, job_id=None):
+        """
+        Queues built messages for the EmailDispatcher. `emails` is a list of
+        (envelope recipients, subject, message bytes). Returns the number queued.
+        """
+        if not emails:
+            return 0
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.executemany(
+                    "INSERT INTO `email_outbox` (job_id, recipients, subject, message, created_by) VALUES (%s, %s, %s, %s, %s)",
+                    [(job_id, json.dumps(list(recipients)), subject[:998], message, created_by) for recipients, subject, message in emails]
+                )
+            conn.commit()
+            return len(emails)
+        except mysql.connector.Error as err:
+            logging.error(f"Error queueing {len(emails)} email(s): {err}", exc_info=True); conn.rollback()
+            return 0
+        finally:
+            if conn: conn.close()
+
+    def claim_due_emails(self, limit, lease_seconds):
+        """
+        Claims up to `limit` due messages for this worker and leases them for lease_seconds;
+        a message whose worker died becomes due again when its lease runs out. SKIP LOCKED
+        lets several server instances drain the queue without sending anything twice.
+        """
+        conn = self._get_connection()
+        try:
+            conn.autocommit = False
+            with conn.cursor(dictionary=True) as cursor:
+                cursor.execute("""
+                    SELECT id, recipients, message, attempts FROM `email_outbox`
+                    WHERE status IN ('Pending', 'Sending') AND next_attempt_at <= NOW()
+                    ORDER BY next_attempt_at, id LIMIT %s FOR UPDATE SKIP LOCKED
+                """, (limit,))
+                rows = cursor.fetchall()
+                if rows:
+                    placeholders = ','.join(['%s'] * len(rows))
+                    cursor.execute(
+                        f"UPDATE `email_outbox` SET status = 'Sending', attempts = attempts + 1, "
+                        f"next_attempt_at = NOW() + INTERVAL %s SECOND WHERE id IN ({placeholders})",
+                        (lease_seconds, *[row['id'] for row in rows])
+                    )
+            conn.commit()
+            for row in rows:
+                row['recipients'] = json.loads(row['recipients'])
+                row['attempts'] += 1
+            return rows
+        except mysql.connector.Error as err:
+            logging.error(f"Error claiming queued emails: {err}", exc_info=True); conn.rollback()
+            return []
+        finally:
+            if conn: conn.close()
+
+    def mark_emails_sent(self, email_ids):
+        if not email_ids:
+            return
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                placeholders = ','.join(['%s'] * len(email_ids))
+                # The message body is not needed once delivered; only the audit row is kept.
+                cursor.execute(
+                    f"UPDATE `email_outbox` SET status = 'Sent', sent_at = NOW(), last_error = NULL, message = '' WHERE id IN ({placeholders})",
+                    tuple(email_ids)
+                )
+            conn.commit()
+        except mysql.connector.Error as err:
+            logging.error(f"Error marking emails {email_ids} as sent: {err}", exc_info=True)
+        finally:
+            if conn: conn.close()
+
+    def mark_email_failed(self, email_id, error, retry_in_seconds=None):
+        """Records a failed attempt; retries after retry_in_seconds, or gives up when it is None."""
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                if retry_in_seconds is None:
+                    cursor.execute("UPDATE `email_outbox` SET status = 'Failed', last_error = %s WHERE id = %s", (str(error)[:2000], email_id))
+                else:
+                    cursor.execute(
+                        "UPDATE `email_outbox` SET status = 'Pending', last_error = %s, next_attempt_at = NOW() + INTERVAL %s SECOND WHERE id = %s",
+                        (str(error)[:2000], retry_in_seconds, email_id)
+                    )
+            conn.commit()
+        except mysql.connector.Error as err:
+            logging.error(f"Error recording failure of email {email_id}: {err}", exc_info=True)
+        finally:
+            if conn: conn.close()
+
+    def retry_failed_emails(self):
+        """Puts every message that gave up back in the queue. Returns how many."""
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE `email_outbox` SET status = 'Pending', attempts = 0, next_attempt_at = NOW() WHERE status = 'Failed'")
+                count = cursor.rowcount
+            conn.commit()
+            return count
+        except mysql.connector.Error as err:
+            logging.error(f"Error re-queueing failed emails: {err}", exc_info=True)
+            return 0
+        finally:
+            if conn: conn.close()
+
+    def purge_sent_emails(self, older_than_days):
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM `email_outbox` WHERE status = 'Sent' AND sent_at < NOW() - INTERVAL %s DAY", (older_than_days,))
+            conn.commit()
+        except mysql.connector.Error as err:
+            logging.error(f"Error purging sent emails: {err}", exc_info=True)
+        finally:
+            if conn: conn.close()
+
+    def get_email_outbox_status(self, job_id=None):
+        """Message counts per status ({'Pending': n, ...}), for one job or the whole queue."""
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                if job_id:
+                    cursor.execute("SELECT status, COUNT(*) FROM `email_outbox` WHERE job_id = %s GROUP BY status", (job_id,))
+                else:
+                    cursor.execute("SELECT status, COUNT(*) FROM `email_outbox` GROUP BY status")
+                return {status: count for status, count in cursor.fetchall()}
+        except mysql.connector.Error as err:
+            logging.error(f"Error in get_email_outbox_status: {err}", exc_info=True)
+            return {}
+        finally:
+            if conn: conn.close()
+
+    def get_failed_emails(self, limit=20):
+        conn = self._get_connection()
+        try:
+            query = """
+                SELECT id, subject, recipients, attempts, last_error, created_by, created_at FROM `email_outbox`
+                WHERE status = 'Failed' ORDER BY id DESC LIMIT %s
+            """
+            return pd.read_sql_query(query, conn, params=(limit,))
+        except mysql.connector.Error as err:
+            logging.error(f"Error in get_failed_emails: {err}", exc_info=True)
+            return pd.DataFrame()
+        finally:
+            if conn: conn.close()
+
+    def acquire_named_lock(self, lock_name, timeout=0):
+        """
+        Takes a MySQL advisory lock (GET_LOCK), which is shared by every server instance using
+        this database. Returns the connection holding the lock, or None if another session
+        already holds it. Pass the connection to release_named_lock when done.
+        """
+        conn = self._get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT GET_LOCK(%s, %s)", (lock_name, timeout))
+                if cursor.fetchone()[0] == 1:
+                    return conn
+        except mysql.connector.Error as err:
+            logging.error(f"Error acquiring lock '{lock_name}': {err}", exc_info=True)
+        if conn and conn.is_connected():
+            conn.close()
+        return None
+
+    def release_named_lock(self, conn, lock_name):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (lock_name,))
+                cursor.fetchone()
+        except mysql.connector.Error as err:
+            logging.error(f"Error releasing lock '{lock_name}': {err}", exc_info=True)
+        finally:
+            if conn and conn.is_connected():
+                conn.close()
+
     # --- NEW --- Methods for the Enhanced Clarification Workflow
     
     def create_entry_clarification(self, username, trigger_details):
@@ -1732,15 +2788,10 @@ class DatabaseManager:
             params = []
             
             # Add role-based filtering
-            if user_role == 'User' and username:
-                query += " WHERE username = %s"
-                params.append(username)
-            elif user_role == 'Manager' and managed_users is not None and username is not None:
-                team_members = managed_users + [username]
-                if not team_members: return pd.DataFrame()
-                placeholders = ','.join(['%s'] * len(team_members))
-                query += f" WHERE username IN ({placeholders})"
-                params.extend(team_members)
+            scope_sql, scope_params = self._visibility_filter('username', user_role, username)
+            if scope_sql:
+                query += f" WHERE {scope_sql}"
+                params.extend(scope_params)
             
             # Order by status priority and then by creation date
             query += " ORDER BY FIELD(status, 'Pending User Action', 'Submitted', 'Replied', 'Accepted'), created_at DESC"
@@ -1843,6 +2894,102 @@ class DatabaseManager:
             return False # Assume no open clarification on error
         finally:
             if conn: conn.close()
+
+    def get_unresolved_run_streaks(self, min_streak=3, lookback_runs=10):
+        """
+        Finds, in one query, the users whose most recent runs with exceptions are unresolved
+        at least `min_streak` times in a row. Only users who receive automatic notifications
+        and have no open clarification are considered; each user's last `lookback_runs` runs
+        with exceptions are ranked newest first and the streak stops at the first run whose
+        entries are all corrected or accepted.
+        Returns a DataFrame of (username, run_id) rows, one per run in each qualifying streak.
+        """
+        conn = self._get_connection()
+        try:
+            query = """
+                WITH eligible_users AS (
+                    SELECT u.username FROM users u
+                    WHERE (u.receive_auto_notifications IS NULL OR u.receive_auto_notifications <> 0)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM entry_clarifications c
+                          WHERE c.username = u.username AND c.status != 'Accepted'
+                      )
+                ),
+                user_runs AS (
+                    SELECT DISTINCT e.username, up.run_id
+                    FROM user_performance up
+                    JOIN eligible_users e ON up.user = e.username
+                    WHERE up.exception_records > 0
+                ),
+                recent_runs AS (
+                    SELECT username, run_id,
+                           ROW_NUMBER() OVER (PARTITION BY username ORDER BY run_id DESC) AS run_rank
+                    FROM user_runs
+                ),
+                unresolved_runs AS (
+                    SELECT DISTINCT r.username, r.run_id
+                    FROM recent_runs r
+                    JOIN exceptions ex ON ex.run_id = r.run_id AND ex.created_user = r.username
+                    WHERE r.run_rank <= %s
+                      AND ex.correction_status IN ('Pending', 'No')
+                      AND ex.is_accepted = FALSE
+                ),
+                ranked AS (
+                    SELECT r.username, r.run_id,
+                           SUM(CASE WHEN ur.run_id IS NULL THEN 1 ELSE 0 END)
+                               OVER (PARTITION BY r.username ORDER BY r.run_rank ROWS UNBOUNDED PRECEDING) AS resolved_so_far
+                    FROM recent_runs r
+                    LEFT JOIN unresolved_runs ur ON ur.username = r.username AND ur.run_id = r.run_id
+                    WHERE r.run_rank <= %s
+                ),
+                streaks AS (
+                    SELECT username, run_id, COUNT(*) OVER (PARTITION BY username) AS streak_length
+                    FROM ranked
+                    WHERE resolved_so_far = 0
+                )
+                SELECT username, run_id FROM streaks
+                WHERE streak_length >= %s
+                ORDER BY username, run_id
+            """
+            return pd.read_sql_query(query, conn, params=(lookback_runs, lookback_runs, min_streak))
+        except mysql.connector.Error as err:
+            logging.error(f"Error finding unresolved run streaks: {err}", exc_info=True)
+            return None
+        finally:
+            if conn and conn.is_connected():
+                conn.close()
+
+    def create_clarification_requests(self, requests):
+        """
+        Creates entry clarifications and their 'Clarification Required' notifications in bulk.
+        `requests` is a list of (username, trigger_details, notification_message); everything is
+        written in one transaction. Returns the number of clarifications created.
+        """
+        if not requests:
+            return 0
+        conn = self._get_connection()
+        try:
+            conn.autocommit = False
+            with conn.cursor() as cursor:
+                cursor.executemany(
+                    "INSERT INTO entry_clarifications (username, trigger_details) VALUES (%s, %s)",
+                    [(username, trigger_details) for username, trigger_details, _ in requests]
+                )
+                cursor.executemany(
+                    "INSERT INTO notifications (username, notification_type, message) VALUES (%s, %s, %s)",
+                    [(username, 'Clarification Required', message) for username, _, message in requests]
+                )
+            conn.commit()
+            for username, _, _ in requests:
+                invalidate_user_context(username)
+            return len(requests)
+        except mysql.connector.Error as err:
+            logging.error(f"Error creating clarification requests: {err}", exc_info=True)
+            conn.rollback()
+            return 0
+        finally:
+            if conn and conn.is_connected():
+                conn.close()
             
     def get_suspicious_transactions_for_user(self, username):
         conn = self._get_connection()
@@ -1855,14 +3002,17 @@ class DatabaseManager:
 
 
     # START of new function to be inserted
-    def get_rejected_transactions(self):
+    def get_rejected_transactions(self, user_role=None, username=None):
         """Fetches all transactions that are pending user correction or have been corrected."""
         conn = self._get_connection()
         try:
             # Fetches items that have been rejected or that the user has already corrected.
-            query = "SELECT * FROM suspicious_transactions_log WHERE status IN ('Rejected', 'User Corrected') ORDER BY reviewed_at DESC"
-            df = pd.read_sql_query(query, conn)
-            return self._process_log_df(df)
+            where_sql = "status IN ('Rejected', 'User Corrected')"
+            scope_sql, params = self._visibility_filter('created_user', user_role, username)
+            if scope_sql:
+                where_sql += f" AND {scope_sql}"
+            df = pd.read_sql_query(self._suspicious_log_list_query(where_sql, "reviewed_at DESC"), conn, params=tuple(params))
+            return self._process_summary_log_df(df)
         finally:
             if conn: conn.close()
 # END of new function
@@ -1919,24 +3069,28 @@ class DatabaseManager:
             if conn and conn.is_connected():
                 conn.close()
             
-    def get_accepted_exception_fingerprints(self):
+    def get_accepted_exception_fingerprints_since(self, last_seen_id=0):
         """
-        Fetches all combined_hash values for exceptions that have been marked as 'accepted'.
-        Used to prevent re-flagging the exact same accepted issue in future uploads.
+        Fetches the accepted exception fingerprints added after `last_seen_id`, in id order.
+        Returns (rows, max_id) where rows is a list of (id, combined_hash) and max_id is the
+        highest id currently in the table (below last_seen_id if the table was reset).
+        Returns (None, None) on failure.
         """
         conn = self._get_connection()
         try:
-            query = "SELECT combined_hash FROM accepted_exception_fingerprints"
-            df_fingerprints = pd.read_sql_query(query, conn)
-
-            if df_fingerprints.empty:
-                return set()
-
-            return set(df_fingerprints['combined_hash'])
-
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT COALESCE(MAX(id), 0) FROM accepted_exception_fingerprints")
+                max_id = cursor.fetchone()[0]
+                if max_id <= last_seen_id:
+                    return [], max_id
+                cursor.execute(
+                    "SELECT id, combined_hash FROM accepted_exception_fingerprints WHERE id > %s ORDER BY id",
+                    (last_seen_id,)
+                )
+                return cursor.fetchall(), max_id
         except mysql.connector.Error as e:
-            logging.error(f"Error fetching accepted exception fingerprints: {e}", exc_info=True)
-            return set() # Return an empty set on failure
+            logging.error(f"Error fetching new accepted exception fingerprints: {e}", exc_info=True)
+            return None, None
         finally:
             if conn and conn.is_connected():
                 conn.close()
@@ -2018,85 +3172,354 @@ def check_and_trigger_notifications():
         logging.info("Automatic notification service is globally disabled. Skipping check.")
         return
 
-    # 2. Get all users who have notifications enabled
-    all_users_df = db_manager.get_all_users()
-    if all_users_df.empty:
+    # 2. Find every eligible user with 3+ consecutive unresolved runs in a single query
+    streaks_df = db_manager.get_unresolved_run_streaks(min_streak=3, lookback_runs=10)
+    if streaks_df is None or streaks_df.empty:
         return
-    
-    # Filter for users who are set to receive notifications (NULL is treated as True)
-    eligible_users = all_users_df[all_users_df['receive_auto_notifications'] != False]['username'].tolist()
 
-    conn = db_manager._get_connection()
-    try:
-        for user in eligible_users:
-            # 3. Check if user already has an open clarification request
-            if db_manager.has_open_clarification(user):
-                logging.info(f"Skipping user {user}, they already have an open clarification request.")
-                continue
+    # 3. Trigger the clarification workflow for all of them at once
+    requests = []
+    for user, run_ids in streaks_df.groupby('username', sort=True)['run_id']:
+        failed_run_ids = sorted(int(run_id) for run_id in run_ids)
+        logging.warning(f"Condition met for user {user}. Triggering clarification request.")
+        trigger_details = f"For unresolved entries in runs: {', '.join(map(str, failed_run_ids))}"
+        message = f"You have unresolved entries for {len(failed_run_ids)} consecutive runs. Please provide a clarification in the Clarification Center."
+        requests.append((user, trigger_details, message))
 
-            # 4. Check the "3 consecutive runs" condition
-            # Get the user's most recent runs where they had exceptions
-            perf_query = """
-                SELECT DISTINCT run_id FROM user_performance 
-                WHERE user = %s AND exception_records > 0 
-                ORDER BY run_id DESC LIMIT 10
-            """
-            user_runs_df = pd.read_sql_query(perf_query, conn, params=(user,))
-            
-            if len(user_runs_df) < 3:
-                continue # Not enough runs to meet the condition
+    created = db_manager.create_clarification_requests(requests)
+    logging.info(f"Created {created} clarification request(s).")
 
-            consecutive_unresolved_count = 0
-            failed_run_ids = []
 
-            for run_id in user_runs_df['run_id']:
-                with conn.cursor() as cursor:
-                    # Check if this run has any unresolved entries for this user
-                    exc_query = """
-                        SELECT 1 FROM exceptions 
-                        WHERE run_id = %s AND created_user = %s 
-                        AND correction_status IN ('Pending', 'No') 
-                        AND is_accepted = FALSE LIMIT 1
-                    """
-                    cursor.execute(exc_query, (run_id, user))
-                    if cursor.fetchone():
-                        # This run is unresolved
-                        consecutive_unresolved_count += 1
-                        failed_run_ids.append(run_id)
-                    else:
-                        # The chain of unresolved runs is broken
-                        break
-            
-            # 5. If condition is met, trigger the actions
-            if consecutive_unresolved_count >= 3:
-                logging.warning(f"Condition met for user {user}. Triggering clarification request.")
-                trigger_details = f"For unresolved entries in runs: {', '.join(map(str, sorted(failed_run_ids)))}"
-                
-                # Create the clarification record
-                clarification_id = db_manager.create_entry_clarification(user, trigger_details)
-                
-                if clarification_id:
-                    # Send a notification to the user's dashboard
-                    message = f"You have unresolved entries for {consecutive_unresolved_count} consecutive runs. Please provide a clarification in the Clarification Center."
-                    db_manager.create_notification(user, 'Clarification Required', message)
+NOTIFICATION_CHECK_LOCK_NAME = "validation_dashboard.notification_check"
+NOTIFICATION_CHECK_INTERVAL_SECONDS = 15 * 60
+
 
+def run_notification_check():
+    """
+    Runs check_and_trigger_notifications under a database-wide single-flight lock, so only
+    one server instance (or batch job) runs it at a time, and records when it ran, how long
+    it took and whether it failed in global_settings. Returns False if another instance
+    was already running it.
+    """
+    db_manager = get_database_manager()
+    lock_conn = db_manager.acquire_named_lock(NOTIFICATION_CHECK_LOCK_NAME)
+    if lock_conn is None:
+        logging.info("Notification check is already running elsewhere. Skipping.")
+        return False
+
+    started_at = datetime.now()
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        check_and_trigger_notifications()
     except Exception as e:
-        logging.error(f"An error occurred during check_and_trigger_notifications: {e}", exc_info=True)
+        status = f"failed: {e}"
+        logging.error(f"Notification check failed: {e}", exc_info=True)
     finally:
-        if conn and conn.is_connected():
-            conn.close()
+        duration = time.perf_counter() - started
+        db_manager.save_global_settings({
+            'notification_check_last_run_at': started_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'notification_check_last_duration_seconds': f"{duration:.2f}",
+            'notification_check_last_status': status,
+        })
+        db_manager.release_named_lock(lock_conn, NOTIFICATION_CHECK_LOCK_NAME)
+    logging.info(f"Notification check finished in {duration:.2f}s ({status}).")
+    return True
+
+
+class NotificationScheduler:
+    """
+    Runs the notification check on a background thread: shortly after uploads and every
+    `interval_seconds`. Requests arriving while a check is waiting or running are coalesced
+    into a single follow-up check, so a burst of uploads triggers it once.
+    """
+
+    def __init__(self, interval_seconds=NOTIFICATION_CHECK_INTERVAL_SECONDS, delay_seconds=5):
+        self.interval_seconds = interval_seconds
+        self.delay_seconds = delay_seconds
+        self.next_run_at = None
+        self._wake = threading.Event()
+        self._thread = None
+
+    def request_run(self):
+        """Asks for a check soon; returns immediately."""
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            self.next_run_at = datetime.fromtimestamp(time.time() + self.interval_seconds)
+            if self._wake.wait(self.interval_seconds):
+                time.sleep(self.delay_seconds)  # let uploads landing together share one check
+            self._wake.clear()
+            try:
+                run_notification_check()
+            except Exception as e:
+                logging.error(f"Notification scheduler error: {e}", exc_info=True)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="notification-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+
+class RunDeletionQueue:
+    """
+    Deletes validation runs on a background thread, one after another, so the Data Management
+    page returns immediately and several runs can be queued at once. Progress per run is kept
+    in `jobs` for the page to display.
+    """
+
+    def __init__(self, batch_size=RUN_DELETE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.jobs = {}  # run_id -> {'label', 'state', 'deleted', 'total', 'table', 'requested_by', 'finished_at'}
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def submit(self, runs, requested_by):
+        """Queues {run_id: label} for deletion; runs already queued or being deleted are skipped."""
+        with self._lock:
+            for run_id, label in runs.items():
+                if self.jobs.get(run_id, {}).get('state') in ('Queued', 'Deleting'):
+                    continue
+                self.jobs[run_id] = {'label': label, 'state': 'Queued', 'deleted': 0, 'total': None, 'table': None,
+                                     'requested_by': requested_by, 'finished_at': None}
+                self._pending.append(run_id)
+        self._wake.set()
+        return self.start()
+
+    def snapshot(self):
+        with self._lock:
+            return {run_id: dict(job) for run_id, job in self.jobs.items()}
+
+    def active_run_ids(self):
+        with self._lock:
+            return {run_id for run_id, job in self.jobs.items() if job['state'] in ('Queued', 'Deleting')}
+
+    def clear_finished(self):
+        with self._lock:
+            self.jobs = {run_id: job for run_id, job in self.jobs.items() if job['state'] in ('Queued', 'Deleting')}
+
+    def _update(self, run_id, **fields):
+        with self._lock:
+            self.jobs[run_id].update(fields)
+
+    def _loop(self):
+        while True:
+            self._wake.wait()
+            with self._lock:
+                run_id = self._pending.pop(0) if self._pending else None
+                if not self._pending:
+                    self._wake.clear()
+            if run_id is None:
+                continue
+            self._update(run_id, state='Deleting')
+            try:
+                ok = db_manager.delete_run(
+                    run_id, batch_size=self.batch_size,
+                    progress=lambda deleted, total, table: self._update(run_id, deleted=deleted, total=total, table=table)
+                )
+            except Exception as e:
+                logging.error(f"Run deletion worker error for run {run_id}: {e}", exc_info=True)
+                ok = False
+            self._update(run_id, state='Deleted' if ok else 'Failed', finished_at=datetime.now())
+            if ok:
+                logging.info(f"Run {run_id} deleted (requested by {self.jobs[run_id]['requested_by']}).")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="run-deletion", daemon=True)
+            self._thread.start()
+        return self
+
+
+EMAIL_BATCH_SIZE = 50
+EMAIL_POLL_SECONDS = 30
+EMAIL_LEASE_SECONDS = 300
+# Wait before the 2nd, 3rd, ... attempt; a message that still fails after the last one is marked Failed.
+EMAIL_RETRY_DELAYS_SECONDS = [60, 300, 900, 3600]
+EMAIL_SENT_RETENTION_DAYS = 30
+
+
+class EmailDispatcher:
+    """
+    Sends the messages queued in email_outbox on a background thread: right after something
+    is queued and every `poll_seconds`. Each batch of up to `batch_size` messages goes over
+    one authenticated SMTP session; failed messages are retried with backoff.
+    """
+
+    def __init__(self, poll_seconds=EMAIL_POLL_SECONDS, batch_size=EMAIL_BATCH_SIZE):
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self.last_batch_at = None
+        self._last_purge = 0.0
+        self._wake = threading.Event()
+        self._thread = None
+
+    def request_send(self):
+        """Asks for the queue to be drained soon; returns immediately."""
+        self._wake.set()
+
+    @staticmethod
+    def _retry_delay(attempts, error):
+        """Seconds until the next attempt, or None when the message should not be retried."""
+        permanent = isinstance(error, smtplib.SMTPRecipientsRefused) or (
+            isinstance(error, smtplib.SMTPResponseException)
+            and not isinstance(error, smtplib.SMTPAuthenticationError)  # a credentials fix should not lose mail
+            and 500 <= error.smtp_code < 600
+        )
+        if permanent or attempts > len(EMAIL_RETRY_DELAYS_SECONDS):
+            return None
+        return EMAIL_RETRY_DELAYS_SECONDS[attempts - 1]
+
+    def send_due_emails(self):
+        """Sends one batch of due messages. Returns how many were claimed."""
+        batch = db_manager.claim_due_emails(self.batch_size, EMAIL_LEASE_SECONDS)
+        if not batch:
+            return 0
+        self.last_batch_at = datetime.now()
+        sent_ids = []
+        server = None
+        try:
+            for index, email in enumerate(batch):
+                if server is None:
+                    try:
+                        server, sender_email = open_smtp_connection()
+                    except Exception as e:
+                        logging.warning(f"Could not open an SMTP session, {len(batch) - index} email(s) will be retried: {e}")
+                        for pending in batch[index:]:
+                            db_manager.mark_email_failed(pending['id'], e, self._retry_delay(pending['attempts'], e))
+                        break
+                try:
+                    server.sendmail(sender_email, email['recipients'], bytes(email['message']))
+                    sent_ids.append(email['id'])
+                except Exception as e:
+                    retry_in = self._retry_delay(email['attempts'], e)
+                    logging.warning(f"Email {email['id']} attempt {email['attempts']} failed: {e}"
+                                    + (f"; retrying in {retry_in}s." if retry_in is not None else "; giving up."))
+                    db_manager.mark_email_failed(email['id'], e, retry_in)
+                    if not isinstance(e, smtplib.SMTPResponseException):
+                        # Connection-level trouble: start a fresh session for the next message.
+                        try: server.close()
+                        except Exception: pass
+                        server = None
+        finally:
+            db_manager.mark_emails_sent(sent_ids)
+            if server is not None:
+                try: server.quit()
+                except Exception: pass
+        if sent_ids:
+            logging.info(f"Sent {len(sent_ids)} of {len(batch)} queued email(s) over one SMTP session.")
+        return len(batch)
+
+    def _loop(self):
+        while True:
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+            try:
+                while self.send_due_emails() == self.batch_size:
+                    pass
+                if time.time() - self._last_purge > 3600:
+                    db_manager.purge_sent_emails(EMAIL_SENT_RETENTION_DAYS)
+                    self._last_purge = time.time()
+            except Exception as e:
+                logging.error(f"Email dispatcher error: {e}", exc_info=True)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="email-dispatcher", daemon=True)
+            self._thread.start()
+        return self
 
 
 @st.cache_resource
 def get_database_manager():
     return DatabaseManager()
 
+
+@st.cache_resource
+def get_notification_scheduler():
+    return NotificationScheduler().start()
+
+
+@st.cache_resource
+def get_run_deletion_queue():
+    return RunDeletionQueue()
+
+
+@st.cache_resource
+def get_email_dispatcher():
+    return EmailDispatcher().start()
+
 db_manager = get_database_manager()
 
+# --- Per-user session context ---
+# Team, permissions, unread notifications and waiver status are loaded once per session and
+# reused across reruns. A context is reloaded after USER_CONTEXT_TTL_SECONDS, or sooner when
+# a DatabaseManager write bumps the user's (or everyone's) generation in this process.
+USER_CONTEXT_TTL_SECONDS = 60
+
+
+class UserContextGenerations:
+    """Per-user (and '*' for everyone) counters that are bumped to mark cached contexts stale."""
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def bump(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def get(self, username):
+        return (self._counters.get('*', 0), self._counters.get(username, 0))
+
+
+@st.cache_resource
+def get_user_context_generations():
+    return UserContextGenerations()
+
+
+def invalidate_user_context(username=None):
+    """Marks cached session contexts stale: one user's, or every user's when username is None."""
+    get_user_context_generations().bump(username if username is not None else '*')
+
+
+def _user_context_generation(username):
+    return get_user_context_generations().get(username)
+
+
+def load_user_context(username, user_role):
+    generation = _user_context_generation(username)
+    is_super_user = user_role == "Super User"
+    return {
+        'username': username,
+        'role': user_role,
+        'generation': generation,
+        'loaded_at': time.time(),
+        'managed_users': db_manager.get_team_members(username) if user_role == "Manager" else [],
+        'permissions': {"can_upload": True, "disabled_pages": []} if is_super_user else db_manager.get_user_permissions(username),
+        'notifications': db_manager.get_notifications_for_user(username),
+        'has_waiver': False if is_super_user else db_manager.check_waiver_status(username),
+    }
+
+
+def get_user_context(username, user_role):
+    """Returns the session's cached user context, reloading it if stale."""
+    context = st.session_state.get('user_context')
+    if (context is None or context['username'] != username or context['role'] != user_role
+            or context['generation'] != _user_context_generation(username)
+            or time.time() - context['loaded_at'] > USER_CONTEXT_TTL_SECONDS):
+        context = load_user_context(username, user_role)
+        st.session_state['user_context'] = context
+    return context
+
 # ==============================================================================
 # ADD THE FULLY UPDATED check_password() FUNCTION HERE
 # ==============================================================================
-def run_user_session_checks(username):
+def run_user_session_checks(username, user_context):
     """
     Runs checks when a user session starts, e.g., for pending clarifications.
     Stores results in the session state for the UI to use.
@@ -2107,7 +3530,7 @@ def run_user_session_checks(username):
         return
 
     # First, check if the user has a waiver from the Super User
-    has_waiver = db_manager.check_waiver_status(username)
+    has_waiver = user_context['has_waiver']
     if has_waiver:
         st.session_state['clarification_required'] = False
         # Optional: Show an info message that a waiver is active
@@ -2125,12 +3548,100 @@ def run_user_session_checks(username):
             st.session_state['clarification_required'] = False
 
 
-# Fully updated check_password function using cookies
+# --- Login throttling ---
+# Failed logins are counted per username and per client IP over a sliding window; once a
+# limit is reached further attempts are refused before any database lookup or bcrypt work.
+# A signed-in session is kept in st.session_state, so reruns never re-verify the password.
+# Behind the reverse proxy every connection comes from the proxy's address, so the per-IP
+# limit only applies when `[auth] client_ip_header` names the header the proxy sets with the
+# client's address (e.g. "X-Forwarded-For", whose last entry the proxy appends). Its limit is
+# `[auth] max_failures_per_ip`.
+LOGIN_FAILURE_WINDOW_SECONDS = 15 * 60
+LOGIN_MAX_FAILURES_PER_USER = 5
+LOGIN_MAX_FAILURES_PER_IP = 30
+
+
+class LoginThrottle:
+    """Sliding-window failure counter for usernames and client IPs."""
+
+    def __init__(self, window_seconds=LOGIN_FAILURE_WINDOW_SECONDS, max_user_failures=LOGIN_MAX_FAILURES_PER_USER,
+                 max_ip_failures=LOGIN_MAX_FAILURES_PER_IP):
+        self.window_seconds = window_seconds
+        self.max_user_failures = max_user_failures
+        self.max_ip_failures = max_ip_failures
+        self._failures = {}  # (kind, key) -> deque of failure times, at most `limit` long
+        self._lock = threading.Lock()
+
+    def _limits(self, username, client_ip):
+        yield ('user', (username or '').strip().lower()), self.max_user_failures
+        if client_ip:
+            yield ('ip', client_ip), self.max_ip_failures
+
+    def retry_after(self, username, client_ip):
+        """Seconds until this username/IP may try again; 0 when a login attempt is allowed."""
+        now = time.time()
+        wait = 0
+        with self._lock:
+            for key, limit in self._limits(username, client_ip):
+                failures = self._failures.get(key)
+                if failures and len(failures) >= limit:
+                    wait = max(wait, failures[-limit] + self.window_seconds - now)
+        return max(0, wait)
+
+    def record_failure(self, username, client_ip):
+        now = time.time()
+        with self._lock:
+            for key, limit in self._limits(username, client_ip):
+                self._failures.setdefault(key, deque(maxlen=limit)).append(now)
+            if len(self._failures) > 10000:
+                cutoff = now - self.window_seconds
+                self._failures = {key: times for key, times in self._failures.items() if times[-1] > cutoff}
+
+    def record_success(self, username):
+        with self._lock:
+            self._failures.pop(('user', (username or '').strip().lower()), None)
+
+
+@st.cache_resource
+def get_login_throttle():
+    return LoginThrottle(max_ip_failures=int(st.secrets.get("auth", {}).get("max_failures_per_ip", LOGIN_MAX_FAILURES_PER_IP)))
+
+
+def get_client_ip():
+    """The client address from the trusted proxy header, or None (no per-IP limit) when none is configured."""
+    header = st.secrets.get("auth", {}).get("client_ip_header")
+    if not header:
+        return None
+    try:
+        value = st.context.headers.get(header)
+    except Exception:
+        return None
+    if not value:
+        return None
+    # Only the last entry was added by our proxy; earlier ones are whatever the client sent.
+    return value.split(',')[-1].strip() or None
+
+
+def start_user_session(user_data):
+    """Sets the session state of an authenticated user."""
+    st.session_state["authentication_status"] = True
+    st.session_state["username_actual"] = user_data['username']
+    st.session_state["full_name"] = user_data['full_name']
+    st.session_state["role"] = user_data['role']
+    st.session_state["user_context"] = load_user_context(user_data['username'], user_data['role'])
+    st.session_state["managed_users"] = st.session_state["user_context"]['managed_users']
+
+
+def logout():
+    """Ends the current session only."""
+    for key in list(st.session_state.keys()):
+        del st.session_state[key]
+
 
 def check_password():
     """
     Returns `True` if the user is authenticated, `False` otherwise.
-    This function uses st.session_state for modern, reliable session management.
+    A session authenticates once with the login form; later reruns only look at st.session_state.
     """
     db_manager = get_database_manager()
 
@@ -2144,133 +3655,392 @@ def check_password():
     password_input = st.text_input("Password", type="password", key="login_password")
 
     if st.button("Log in", key="login_button"):
-        user_data = db_manager.get_user(username_input)
+        throttle = get_login_throttle()
+        client_ip = get_client_ip()
+        wait_seconds = throttle.retry_after(username_input, client_ip)
+        if wait_seconds:
+            st.error(f"🔒 Too many failed login attempts. Please try again in {math.ceil(wait_seconds / 60)} minute(s).")
+            return False
+
+        user_data = db_manager.get_user(username_input) if username_input and password_input else None
 
-        # NEW: Check for disabled status first
         if user_data and user_data.get('disabled'):
             st.error("❌ Your account has been disabled. Please contact an administrator.")
             st.session_state["authentication_status"] = False
-        
+            return False
+
+        try:
+            password_ok = bool(user_data) and verify_password(password_input, user_data['hashed_password'])
+        except PasswordHashingBusy:
+            st.warning("⏳ The server is busy signing other users in. Please try again in a few seconds.")
+            return False
+
         # This logic correctly handles both "user not found" and "password incorrect"
-        if user_data and bcrypt.checkpw(password_input.encode('utf-8'), user_data['hashed_password'].encode('utf-8')):
-            # --- On successful login, set all necessary session state variables ---
-            st.session_state["authentication_status"] = True
-            st.session_state["username_actual"] = user_data['username']
-            st.session_state["full_name"] = user_data['full_name']
-            st.session_state["role"] = user_data['role']
-            st.session_state["managed_users"] = db_manager.get_managed_users(user_data['username']) if user_data['role'] == "Manager" else []
-            
+        if password_ok:
+            throttle.record_success(username_input)
+            start_user_session(user_data)
+
             # Rerun the script to immediately reflect the logged-in state
             st.rerun()
         else:
+            throttle.record_failure(username_input, client_ip)
             st.error("😕 User not known or password incorrect.")
             st.session_state["authentication_status"] = False
 
     # If the code reaches this point, the user is not yet authenticated.
     return False
 
-@st.cache_data
-def load_ledger_validation_mapping(base_ref_path="reference_data"):
-    """Loads the combined ledger/sub-ledger mapping for VALIDATION purposes."""
-    mapping_file = os.path.join(base_ref_path, "Ledgersubledger mapping.xlsx")
-    LEDGER_CODE_COL = "Account2.Code"
-    SUBLEDGER_CODE_COL = "Sub Ledger.Code"
-    
-    try:
-        if not os.path.exists(mapping_file):
-            st.error(f"VALIDATION Error: Ledger mapping file not found at '{mapping_file}'. Ledger combination validation will not work.")
-            return None
+# --- Compiled reference data snapshot ---
+# All reference workbooks are parsed once into a single pickle under reference_data/.compiled/.
+# The snapshot is keyed by each source file's mtime/size (with a SHA-256 fallback), so it is
+# rebuilt only when a workbook actually changes and otherwise loads in milliseconds.
+REFERENCE_LIST_FILES = {
+    "FC_Crop": ("FC-field crop.xlsx", "Crop.Name"),
+    "VC_Crop": ("VC-Veg Crop.xlsx", "Crop.Name"),
+    "SBFC_Region": ("SBFC-Region.xlsx", "Region.Name"),
+    "SBVC_Region": ("SBVC-Region.xlsx", "Region.Name"),
+    "SaleFC_Zone": ("SaleFC-Zone.xlsx", "Zone.Name"),
+    "SaleVC_Zone": ("SaleVC-Zone.xlsx", "Zone.Name"),
+    "FC_BU": ("FC-BU.xlsx", "Business Unit.Name"),
+    "VC_BU": ("VC-BU.xlsx", "Business Unit.Name"),
+    "Fruit_Crop": ("Fruit Crop.xlsx", "Crop.Name"),
+    "Common_Crop": ("Common crop.xlsx", "Crop.Name"),
+    "ProductionFC_Zone": ("ProductionFC-Zone.xlsx", "Zone.Name"),
+    "ProductionVC_Zone": ("ProductionVC-Zone.xlsx", "Zone.Name"),
+    "SalesActivity": ("SalesActivity.xlsx", "Activity.Name"),
+    "MarketingActivity": ("MarketingActivity.xlsx", "Activity.Name"),
+    "RS_BU": ("RS-BU.xlsx", "Business Unit.Name"),
+    "SaleRS_Zone": ("SaleRS-Zone.xlsx", "Zone.Name"),
+    "SBRS_Region": ("SBRS-Region.xlsx", "Region.Name"),
+    "Root Stock_Crop": ("Root Stock Crop.xlsx", "Crop.Name"),
+    "Region_Excluded_Accounts": ("Region.Name excluded.xlsx", "Account.Code"),
+    "Zone_Excluded_Accounts": ("Zone.Name excluded.xlsx", "Account.Code"),
+}
+# name -> (file, required columns)
+REFERENCE_TABLE_FILES = {
+    "ledger_mapping": ("Ledgersubledger mapping.xlsx", ["Account2.Code", "Sub Ledger.Code"]),
+    "account_names": ("account_mapping.xlsx", ["Account2.Code", "Account2.Name"]),
+    "subledger_names": ("subledger_mapping.xlsx", ["Sub Ledger.Code", "SubLedger.Name"]),
+    "sub_departments": ("SubDepartment.xlsx", ["Sub Department.Name"]),
+    "suspense_immunity": ("do not check suspense.xlsx", ["Account2.Code", "Sub Ledger.Code"]),
+}
+REFERENCE_SNAPSHOT_DIR = ".compiled"
+REFERENCE_SNAPSHOT_FILENAME = "reference_snapshot.pkl"
+REFERENCE_SNAPSHOT_FORMAT = 1
+
+_reference_snapshots = {}
+_reference_snapshot_lock = threading.Lock()
+
+
+def _reference_source_files():
+    return sorted({f for f, _ in REFERENCE_LIST_FILES.values()} | {f for f, _ in REFERENCE_TABLE_FILES.values()})
+
+
+def _reference_source_signature(base_ref_path):
+    """filename -> (mtime_ns, size), or None for files that do not exist."""
+    signature = {}
+    for filename in _reference_source_files():
+        try:
+            stat = os.stat(os.path.join(base_ref_path, filename))
+            signature[filename] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature[filename] = None
+    return signature
 
-        mapping_df = pd.read_excel(mapping_file)
-        required_cols = [LEDGER_CODE_COL, SUBLEDGER_CODE_COL]
-        if not all(col in mapping_df.columns for col in required_cols):
-            st.error(f"VALIDATION Error: Mapping file '{mapping_file}' is missing required columns. It needs: {required_cols}")
-            return None
 
-        for col in required_cols:
-            mapping_df[col] = mapping_df[col].astype(str).str.strip()
+def _file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-        return mapping_df
 
+def _compile_reference_table(file_path, required_cols, transform):
+    """Parses one workbook into {'status', 'data', 'detail'}; status is ok/missing/missing_columns/error."""
+    if not os.path.exists(file_path):
+        return {'status': 'missing', 'data': None, 'detail': ''}
+    try:
+        df = pd.read_excel(file_path, engine='openpyxl')
+        if not all(col in df.columns for col in required_cols):
+            return {'status': 'missing_columns', 'data': None, 'detail': ''}
+        return {'status': 'ok', 'data': transform(df), 'detail': ''}
     except Exception as e:
-        st.error(f"Failed to read or process validation mapping file {mapping_file}: {str(e)}")
-        return None
+        logging.error(f"Error compiling reference file '{file_path}': {e}", exc_info=True)
+        return {'status': 'error', 'data': None, 'detail': str(e)}
 
-@st.cache_data
-def load_account_name_mapping(base_ref_path="reference_data"):
-    """Loads the account code-to-name mapping for DISPLAY purposes."""
-    mapping_file = os.path.join(base_ref_path, "account_mapping.xlsx")
-    CODE_COL = "Account2.Code"
-    NAME_COL = "Account2.Name"
 
-    try:
-        if not os.path.exists(mapping_file):
-            st.warning(f"DISPLAY Warning: Account name mapping file not found at '{mapping_file}'. Ledger names may not display correctly.")
-            return None
-        
-        mapping_df = pd.read_excel(mapping_file)
-        required_cols = [CODE_COL, NAME_COL]
-        if not all(col in mapping_df.columns for col in required_cols):
-            st.warning(f"DISPLAY Warning: Account name mapping file '{mapping_file}' is missing required columns. It needs: {required_cols}. Names may not display.")
-            return None
-        
-        mapping_df[CODE_COL] = mapping_df[CODE_COL].astype(str).str.strip()
-        mapping_df[NAME_COL] = mapping_df[NAME_COL].astype(str).str.strip()
+def _strip_columns(df, cols):
+    for col in cols:
+        df[col] = df[col].astype(str).str.strip()
+    return df
 
-        return mapping_df[required_cols].drop_duplicates(subset=[CODE_COL]).reset_index(drop=True)
 
-    except Exception as e:
-        st.error(f"Failed to read or process account name mapping file {mapping_file}: {str(e)}")
+def _suspense_immunity_keys(df):
+    df = df.dropna(subset=["Account2.Code", "Sub Ledger.Code"])
+    return set(df["Account2.Code"].astype(str).str.strip() + "_" + df["Sub Ledger.Code"].astype(str).str.strip())
+
+
+def compile_reference_data(base_ref_path="reference_data"):
+    """Parses every reference workbook and returns the snapshot dict (without writing it)."""
+    lists = {}
+    for key, (filename, col_name) in REFERENCE_LIST_FILES.items():
+        lists[key] = _compile_reference_table(
+            os.path.join(base_ref_path, filename), [col_name],
+            lambda df, col=col_name: df[col].dropna().astype(str).str.strip().unique().tolist()
+        )
+
+    table_transforms = {
+        "ledger_mapping": lambda df: _strip_columns(df, ["Account2.Code", "Sub Ledger.Code"]),
+        "account_names": lambda df: _strip_columns(df, ["Account2.Code", "Account2.Name"])[["Account2.Code", "Account2.Name"]].drop_duplicates(subset=["Account2.Code"]).reset_index(drop=True),
+        "subledger_names": lambda df: _strip_columns(df, ["Sub Ledger.Code", "SubLedger.Name"])[["Sub Ledger.Code", "SubLedger.Name"]].drop_duplicates(subset=["Sub Ledger.Code"]).reset_index(drop=True),
+        "sub_departments": lambda df: sorted(df["Sub Department.Name"].dropna().astype(str).str.strip().unique().tolist()),
+        "suspense_immunity": _suspense_immunity_keys,
+    }
+    tables = {
+        name: _compile_reference_table(os.path.join(base_ref_path, filename), required_cols, table_transforms[name])
+        for name, (filename, required_cols) in REFERENCE_TABLE_FILES.items()
+    }
+
+    hashes = {}
+    for filename in _reference_source_files():
+        file_path = os.path.join(base_ref_path, filename)
+        hashes[filename] = _file_sha256(file_path) if os.path.exists(file_path) else None
+    version = hashlib.sha256(json.dumps(hashes, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+    return {
+        'format': REFERENCE_SNAPSHOT_FORMAT,
+        'signature': _reference_source_signature(base_ref_path),
+        'hashes': hashes,
+        'version': version,
+        'compiled_at': datetime.now(),
+        'lists': lists,
+        'tables': tables,
+    }
+
+
+def _write_reference_snapshot(snapshot_path, snapshot):
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, snapshot_path)  # atomic, so readers never see a half-written file
+
+
+def load_reference_snapshot(base_ref_path="reference_data"):
+    """
+    Returns the compiled reference data for base_ref_path. Served from memory while the
+    source workbooks are unchanged, otherwise from the on-disk snapshot, and recompiled only
+    when a workbook's content differs from what the snapshot was built from.
+    """
+    abs_path = os.path.abspath(base_ref_path)
+    signature = _reference_source_signature(abs_path)
+    snapshot = _reference_snapshots.get(abs_path)
+    if snapshot is not None and snapshot['signature'] == signature:
+        return snapshot
+
+    with _reference_snapshot_lock:
+        snapshot_path = os.path.join(abs_path, REFERENCE_SNAPSHOT_DIR, REFERENCE_SNAPSHOT_FILENAME)
+        snapshot = None
+        try:
+            with open(snapshot_path, 'rb') as f:
+                snapshot = pickle.load(f)
+            if snapshot.get('format') != REFERENCE_SNAPSHOT_FORMAT:
+                snapshot = None
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable reference snapshot '{snapshot_path}': {e}")
+            snapshot = None
+
+        if snapshot is not None and snapshot['signature'] != signature:
+            # Touched but not edited (copied, re-saved unchanged): compare content hashes.
+            changed = [name for name, sig in signature.items() if sig != snapshot['signature'].get(name)]
+            unchanged = all(
+                (_file_sha256(os.path.join(abs_path, name)) if signature[name] else None) == snapshot['hashes'].get(name)
+                for name in changed
+            )
+            if unchanged:
+                snapshot['signature'] = signature
+                try:
+                    _write_reference_snapshot(snapshot_path, snapshot)
+                except OSError as e:
+                    logging.warning(f"Could not refresh reference snapshot '{snapshot_path}': {e}")
+            else:
+                logging.info(f"Reference data changed ({', '.join(changed)}); recompiling snapshot.")
+                snapshot = None
+
+        if snapshot is None:
+            started = time.perf_counter()
+            snapshot = compile_reference_data(abs_path)
+            try:
+                _write_reference_snapshot(snapshot_path, snapshot)
+            except OSError as e:
+                logging.warning(f"Could not write reference snapshot '{snapshot_path}': {e}")
+            logging.info(f"Compiled reference data snapshot {snapshot['version']} in {time.perf_counter() - started:.2f}s.")
+
+        _reference_snapshots[abs_path] = snapshot
+        return snapshot
+
+
+def get_reference_table(name, base_ref_path="reference_data"):
+    """Returns (entry, file_path) for one compiled reference table; see _compile_reference_table."""
+    filename = REFERENCE_TABLE_FILES[name][0]
+    return get_reference_registry(base_ref_path).current()['tables'][name], os.path.join(base_ref_path, filename)
+
+
+class ReferenceDataRegistry:
+    """
+    Versioned holder of the compiled reference data for one directory.
+
+    A daemon thread polls the source workbooks every `poll_interval` seconds; when one
+    changes, the snapshot is recompiled off the request path and swapped in with a single
+    reference assignment, so readers always see one complete version and pay no reload
+    cost. Listeners (e.g. the validation worker pool) are called with each new version.
+    """
+
+    def __init__(self, base_ref_path="reference_data", poll_interval=5):
+        self.base_ref_path = base_ref_path
+        self.poll_interval = poll_interval
+        self._snapshot = load_reference_snapshot(base_ref_path)
+        self._listeners = []
+        self._thread = None
+
+    @property
+    def version(self):
+        return self._snapshot['version']
+
+    def current(self):
+        """The active snapshot. Without a watcher thread (e.g. in worker processes) this re-checks the files."""
+        if self._thread is None:
+            self._snapshot = load_reference_snapshot(self.base_ref_path)
+        return self._snapshot
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def reload(self):
+        """Checks the source workbooks now; returns True if a new version was swapped in."""
+        snapshot = load_reference_snapshot(self.base_ref_path)
+        if snapshot['version'] == self._snapshot['version']:
+            self._snapshot = snapshot  # same content, refreshed mtimes
+            return False
+        previous_version, self._snapshot = self._snapshot['version'], snapshot
+        logging.info(f"Reference data for '{self.base_ref_path}' switched from version {previous_version} to {snapshot['version']}.")
+        for callback in list(self._listeners):
+            try:
+                callback(snapshot)
+            except Exception as e:
+                logging.error(f"Reference data listener failed: {e}", exc_info=True)
+        return True
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        def _watch():
+            while True:
+                time.sleep(self.poll_interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    logging.error(f"Reference data watcher error: {e}", exc_info=True)
+        self._thread = threading.Thread(target=_watch, name="reference-data-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+
+_IN_VALIDATION_WORKER = False
+
+
+class ReferenceRegistryStore:
+    """One ReferenceDataRegistry per directory for the whole process; the watcher thread runs only in the main process."""
+
+    def __init__(self):
+        self._registries = {}
+        self._lock = threading.Lock()
+
+    def get(self, base_ref_path="reference_data"):
+        abs_path = os.path.abspath(base_ref_path)
+        registry = self._registries.get(abs_path)
+        if registry is None:
+            with self._lock:
+                registry = self._registries.get(abs_path)
+                if registry is None:
+                    registry = ReferenceDataRegistry(base_ref_path)
+                    if not _IN_VALIDATION_WORKER:
+                        registry.add_listener(lambda snapshot: get_validation_pool(base_ref_path, prewarm=True))
+                        registry.start()
+                    self._registries[abs_path] = registry
+        return registry
+
+
+@st.cache_resource
+def get_reference_registry_store():
+    return ReferenceRegistryStore()
+
+
+def get_reference_registry(base_ref_path="reference_data"):
+    return get_reference_registry_store().get(base_ref_path)
+
+
+def load_ledger_validation_mapping(base_ref_path="reference_data"):
+    """Loads the combined ledger/sub-ledger mapping for VALIDATION purposes."""
+    entry, mapping_file = get_reference_table("ledger_mapping", base_ref_path)
+    required_cols = REFERENCE_TABLE_FILES["ledger_mapping"][1]
+    if entry['status'] == 'missing':
+        st.error(f"VALIDATION Error: Ledger mapping file not found at '{mapping_file}'. Ledger combination validation will not work.")
+        return None
+    if entry['status'] == 'missing_columns':
+        st.error(f"VALIDATION Error: Mapping file '{mapping_file}' is missing required columns. It needs: {required_cols}")
+        return None
+    if entry['status'] == 'error':
+        st.error(f"Failed to read or process validation mapping file {mapping_file}: {entry['detail']}")
+        return None
+    return entry['data'].copy()
+
+def load_account_name_mapping(base_ref_path="reference_data"):
+    """Loads the account code-to-name mapping for DISPLAY purposes."""
+    entry, mapping_file = get_reference_table("account_names", base_ref_path)
+    required_cols = REFERENCE_TABLE_FILES["account_names"][1]
+    if entry['status'] == 'missing':
+        st.warning(f"DISPLAY Warning: Account name mapping file not found at '{mapping_file}'. Ledger names may not display correctly.")
+        return None
+    if entry['status'] == 'missing_columns':
+        st.warning(f"DISPLAY Warning: Account name mapping file '{mapping_file}' is missing required columns. It needs: {required_cols}. Names may not display.")
+        return None
+    if entry['status'] == 'error':
+        st.error(f"Failed to read or process account name mapping file {mapping_file}: {entry['detail']}")
         return None
+    return entry['data'].copy()
     
-@st.cache_data
 def load_sub_departments(base_ref_path="reference_data"):
     """Loads the canonical list of Sub Department names."""
-    sub_dept_file = os.path.join(base_ref_path, "SubDepartment.xlsx")
-    try:
-        if not os.path.exists(sub_dept_file):
-            st.error(f"Sub Department reference file not found at '{sub_dept_file}'. The rule control page will not function correctly.")
-            return []
-        
-        df = pd.read_excel(sub_dept_file)
-        # Assuming the column name is 'Sub Department.Name' as in the main data
-        if "Sub Department.Name" not in df.columns:
-            st.error(f"The file '{sub_dept_file}' must contain a column named 'Sub Department.Name'.")
-            return []
-        
-        sub_depts = df["Sub Department.Name"].dropna().astype(str).str.strip().unique().tolist()
-        return sorted(sub_depts)
-        
-    except Exception as e:
-        st.error(f"Failed to read or process sub-department file {sub_dept_file}: {str(e)}")
+    entry, sub_dept_file = get_reference_table("sub_departments", base_ref_path)
+    if entry['status'] == 'missing':
+        st.error(f"Sub Department reference file not found at '{sub_dept_file}'. The rule control page will not function correctly.")
         return []
+    if entry['status'] == 'missing_columns':
+        st.error(f"The file '{sub_dept_file}' must contain a column named 'Sub Department.Name'.")
+        return []
+    if entry['status'] == 'error':
+        st.error(f"Failed to read or process sub-department file {sub_dept_file}: {entry['detail']}")
+        return []
+    return list(entry['data'])
 
-@st.cache_data
 def load_subledger_name_mapping(base_ref_path="reference_data"):
     """Loads the sub-ledger code-to-name mapping for DISPLAY purposes."""
-    mapping_file = os.path.join(base_ref_path, "subledger_mapping.xlsx")
-    CODE_COL = "Sub Ledger.Code"
-    NAME_COL = "SubLedger.Name"
-
-    try:
-        if not os.path.exists(mapping_file):
-            st.warning(f"DISPLAY Warning: Sub-ledger name mapping file not found at '{mapping_file}'. Sub-ledger names may not display correctly.")
-            return None
-        
-        mapping_df = pd.read_excel(mapping_file)
-        required_cols = [CODE_COL, NAME_COL]
-        if not all(col in mapping_df.columns for col in required_cols):
-            st.warning(f"DISPLAY Warning: Sub-ledger name mapping file '{mapping_file}' is missing required columns. It needs: {required_cols}. Names may not display.")
-            return None
-
-        mapping_df[CODE_COL] = mapping_df[CODE_COL].astype(str).str.strip()
-        mapping_df[NAME_COL] = mapping_df[NAME_COL].astype(str).str.strip()
-
-        return mapping_df[required_cols].drop_duplicates(subset=[CODE_COL]).reset_index(drop=True)
-
-    except Exception as e:
-        st.error(f"Failed to read or process sub-ledger name mapping file {mapping_file}: {str(e)}")
+    entry, mapping_file = get_reference_table("subledger_names", base_ref_path)
+    required_cols = REFERENCE_TABLE_FILES["subledger_names"][1]
+    if entry['status'] == 'missing':
+        st.warning(f"DISPLAY Warning: Sub-ledger name mapping file not found at '{mapping_file}'. Sub-ledger names may not display correctly.")
         return None
+    if entry['status'] == 'missing_columns':
+        st.warning(f"DISPLAY Warning: Sub-ledger name mapping file '{mapping_file}' is missing required columns. It needs: {required_cols}. Names may not display.")
+        return None
+    if entry['status'] == 'error':
+        st.error(f"Failed to read or process sub-ledger name mapping file {mapping_file}: {entry['detail']}")
+        return None
+    return entry['data'].copy()
 
 
 class DataValidator:
@@ -2350,61 +4120,26 @@ class DataValidator:
         }
 
     def _load_reference_data(self):
-        loaded_ref_files = {}
-        ref_file_mappings = {
-            "FC_Crop": ("FC-field crop.xlsx", "Crop.Name"),
-            "VC_Crop": ("VC-Veg Crop.xlsx", "Crop.Name"),
-            "SBFC_Region": ("SBFC-Region.xlsx", "Region.Name"),
-            "SBVC_Region": ("SBVC-Region.xlsx", "Region.Name"),
-            "SaleFC_Zone": ("SaleFC-Zone.xlsx", "Zone.Name"),
-            "SaleVC_Zone": ("SaleVC-Zone.xlsx", "Zone.Name"),
-            "FC_BU": ("FC-BU.xlsx", "Business Unit.Name"),
-            "VC_BU": ("VC-BU.xlsx", "Business Unit.Name"),
-            "Fruit_Crop": ("Fruit Crop.xlsx", "Crop.Name"),
-            "Common_Crop": ("Common crop.xlsx", "Crop.Name"),
-            "ProductionFC_Zone": ("ProductionFC-Zone.xlsx", "Zone.Name"),
-            "ProductionVC_Zone": ("ProductionVC-Zone.xlsx", "Zone.Name"),
-            "SalesActivity": ("SalesActivity.xlsx", "Activity.Name"),
-            "MarketingActivity": ("MarketingActivity.xlsx", "Activity.Name"),
-            "RS_BU": ("RS-BU.xlsx", "Business Unit.Name"),
-            "SaleRS_Zone": ("SaleRS-Zone.xlsx", "Zone.Name"),
-            "SBRS_Region": ("SBRS-Region.xlsx", "Region.Name"),
-            "Root Stock_Crop": ("Root Stock Crop.xlsx", "Crop.Name"),
-            "Region_Excluded_Accounts": ("Region.Name excluded.xlsx", "Account.Code"),
-            "Zone_Excluded_Accounts": ("Zone.Name excluded.xlsx", "Account.Code"),
-        }
-
         if not os.path.isdir(self.base_ref_path):
             st.error(f"Reference data directory not found: '{self.base_ref_path}'. Please create it and add reference Excel files. Validations will be highly inaccurate.")
             logging.critical(f"Reference data directory not found: '{self.base_ref_path}'. Cannot load reference data.")
-            return {key: [] for key in ref_file_mappings.keys()}
+            return {key: [] for key in REFERENCE_LIST_FILES.keys()}
 
+        snapshot = get_reference_registry(self.base_ref_path).current()
+        self.reference_version = snapshot['version']
+        loaded_ref_files = {}
         all_files_loaded_successfully = True
-        for key, (filename, col_name) in ref_file_mappings.items():
-            try:
-                file_path = os.path.join(self.base_ref_path, filename)
-                if os.path.exists(file_path):
-                    df_ref = pd.read_excel(file_path, engine='openpyxl')
-                    if col_name in df_ref.columns:
-                        if key in ["Region_Excluded_Accounts", "Zone_Excluded_Accounts"]:
-                             loaded_ref_files[key] = df_ref[col_name].dropna().astype(str).str.strip().unique().tolist()
-                        else:
-                             loaded_ref_files[key] = df_ref[col_name].dropna().astype(str).str.strip().unique().tolist()
-                        logging.info(f"Loaded {len(loaded_ref_files[key])} items for '{key}' from '{filename}'.")
-                    else:
-                        st.warning(f"Column '{col_name}' not found in reference file '{filename}'. '{key}' will be empty.")
-                        logging.warning(f"Column '{col_name}' not found in '{file_path}' for key '{key}'.")
-                        loaded_ref_files[key] = []
-                        all_files_loaded_successfully = False
-                else:
-                    st.warning(f"Reference file '{filename}' not found in '{self.base_ref_path}'. Validations for '{key}' may be inaccurate.")
-                    logging.warning(f"Reference file '{filename}' not found for key '{key}' at path '{file_path}'.")
-                    loaded_ref_files[key] = []
-                    all_files_loaded_successfully = False
-            except Exception as e:
-                st.error(f"Error loading reference file '{filename}' for '{key}': {e}")
-                logging.error(f"Error loading reference file '{filename}' for key '{key}': {e}", exc_info=True)
-                loaded_ref_files[key] = []
+        for key, (filename, col_name) in REFERENCE_LIST_FILES.items():
+            entry = snapshot['lists'][key]
+            loaded_ref_files[key] = entry['data'] if entry['status'] == 'ok' else []
+            if entry['status'] == 'missing':
+                st.warning(f"Reference file '{filename}' not found in '{self.base_ref_path}'. Validations for '{key}' may be inaccurate.")
+                all_files_loaded_successfully = False
+            elif entry['status'] == 'missing_columns':
+                st.warning(f"Column '{col_name}' not found in reference file '{filename}'. '{key}' will be empty.")
+                all_files_loaded_successfully = False
+            elif entry['status'] == 'error':
+                st.error(f"Error loading reference file '{filename}' for '{key}': {entry['detail']}")
                 all_files_loaded_successfully = False
 
         if not all_files_loaded_successfully:
@@ -2412,8 +4147,6 @@ class DataValidator:
         elif not any(loaded_ref_files.values()):
             st.error("All reference data lists are empty after attempting to load files. This indicates a problem with file contents or loading logic. Validations will be highly inaccurate.")
             logging.critical("All loaded reference file lists are empty. Check file contents and parsing logic.")
-        else:
-            logging.info("Reference data loading process completed.")
         return loaded_ref_files
 
     def is_not_blank(self, value):
@@ -2766,10 +4499,13 @@ class DataValidator:
         exceptions = []
         
         null_like_values = [pd.NA, "N/A", "NaN", "null", "NONE", "", " ", "-", "\u00A0", None, 0, "0"]
+        # Normalize into a new frame with assign() so the caller's DataFrame is left untouched
+        # and does not need to be copied before validation.
         if 'Sub Department.Name' in df.columns:
-            df['Sub Department.Name'] = df['Sub Department.Name'].replace(null_like_values, "").astype(str).str.strip()
+            sub_departments = df['Sub Department.Name'].astype(object).replace(null_like_values, "").astype(str).str.strip()
         else:
-            df['Sub Department.Name'] = ""
+            sub_departments = ""
+        df = df.assign(**{'Sub Department.Name': sub_departments})
 
         input_columns = df.columns.tolist()
         
@@ -2782,32 +4518,38 @@ class DataValidator:
         num_workers = os.cpu_count() or 4
         logging.info(f"Starting parallel validation with {num_workers} workers.")
         
-        # OPTIMIZATION: Split the DataFrame into chunks for each worker.
-        df_chunks = np.array_split(df, num_workers)
-
-        global db_manager 
-        accepted_fingerprints_for_validator = db_manager.get_accepted_exception_fingerprints()
-
-        # OPTIMIZATION: Use ProcessPoolExecutor to run validation in parallel.
-        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
-            # Submit each chunk to the _validate_chunk function
-            futures = [
-                executor.submit(
-                    _validate_chunk, 
-                    # NEW: Create a new DataValidator instance for each worker
-                    DataValidator(base_ref_path=self.base_ref_path, accepted_exception_fingerprints_set=accepted_fingerprints_for_validator), 
-                    chunk
-                ) 
-                for chunk in df_chunks
-            ]
-            
-            # Collect the results as they are completed
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    exceptions.extend(future.result())
-                except Exception as e:
-                    logging.error(f"A validation chunk failed: {e}", exc_info=True)
-                    st.error(f"An error occurred during parallel processing: {e}")
+        # OPTIMIZATION: Split the DataFrame into chunks for each worker. iloc slices are used
+        # because np.array_split no longer returns DataFrames with current pandas.
+        chunk_size = max(1, math.ceil(len(df) / num_workers))
+        df_chunks = [df.iloc[start:start + chunk_size] for start in range(0, len(df), chunk_size)]
+
+        # OPTIMIZATION: Validate on the persistent worker pool; each worker already holds a
+        # DataValidator for the current reference data version and the accepted fingerprints
+        # known when the pool started, so only fingerprints accepted since then are sent.
+        # The registry may replace (shut down) the pool between fetching and submitting; chunks
+        # already queued on the old pool still run, so the rest is submitted once to the new pool.
+        futures = []
+        for attempt in range(2):
+            executor = get_validation_pool(self.base_ref_path)
+            new_accepted_fingerprints = get_accepted_fingerprint_cache().hashes_since(executor.accepted_fingerprint_count)
+            try:
+                for chunk in df_chunks[len(futures):]:
+                    futures.append(executor.submit(_validate_chunk_in_worker, chunk, new_accepted_fingerprints))
+                break
+            except RuntimeError:
+                if attempt:
+                    raise
+                logging.info("Validation pool was replaced while submitting chunks; retrying on the new pool.")
+
+        # Collect the results as they are completed
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                exceptions.extend(future.result())
+            except Exception as e:
+                logging.error(f"A validation chunk failed: {e}", exc_info=True)
+                st.error(f"An error occurred during parallel processing: {e}")
+                if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                    reset_validation_pool()
 
         # --- Post-processing after parallel execution ---
         
@@ -2831,27 +4573,151 @@ class DataValidator:
             exceptions_df_output = pd.DataFrame(columns=output_columns_with_exceptions)
         
         # Calculate department statistics after all exceptions have been found
-        department_stats = {}
-        if 'Department.Name' in df.columns:
-            # Get total records per department from the original dataframe
-            total_records_by_dept = df.groupby('Department.Name').size().to_dict()
-            
-            # Get exception records per department from the exceptions dataframe
-            exception_records_by_dept = {}
-            if not exceptions_df_output.empty and 'Department.Name' in exceptions_df_output.columns:
-                exception_records_by_dept = exceptions_df_output.groupby('Department.Name').size().to_dict()
-
-            for dept, total_records in total_records_by_dept.items():
-                exception_records = exception_records_by_dept.get(dept, 0)
-                department_stats[dept] = {
-                    'total_records': total_records,
-                    'exception_records': exception_records,
-                    'exception_rate': (exception_records / total_records * 100) if total_records > 0 else 0
-                }
+        department_stats = compute_department_stats(df, exceptions_df_output)
 
         return exceptions_df_output, department_stats
 
 
+class AcceptedFingerprintCache:
+    """
+    In-process copy of the accepted_exception_fingerprints table. The first refresh loads
+    the whole table; later refreshes fetch only rows with id > last_seen_id, so an upload
+    costs one indexed query plus the acceptances made since the previous upload.
+
+    Lock order: the validation pool's lock is taken before this cache's lock, never after;
+    refresh() therefore resets the pool only once it has released its own lock.
+    """
+
+    def __init__(self):
+        self.fingerprints = set()
+        self._hashes = []  # combined hashes in id order, used to send deltas to workers
+        self.last_seen_id = 0
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Pulls new acceptances from the database; returns the (live) fingerprint set."""
+        table_was_reset = False
+        try:
+            with self._lock:
+                rows, max_id = db_manager.get_accepted_exception_fingerprints_since(self.last_seen_id)
+                if rows is None:
+                    return self.fingerprints  # keep serving what we have until the database is back
+                if max_id < self.last_seen_id:
+                    logging.info("accepted_exception_fingerprints was reset; reloading the fingerprint cache.")
+                    self.fingerprints, self._hashes, self.last_seen_id = set(), [], 0
+                    table_was_reset = True
+                    rows, max_id = db_manager.get_accepted_exception_fingerprints_since(0)
+                    if rows is None:
+                        return self.fingerprints
+                for fingerprint_id, combined_hash in rows:
+                    if combined_hash not in self.fingerprints:
+                        self.fingerprints.add(combined_hash)
+                        self._hashes.append(combined_hash)
+                    self.last_seen_id = fingerprint_id
+                if rows:
+                    logging.info(f"Accepted fingerprint cache: {len(rows)} new, {len(self.fingerprints)} total (last id {self.last_seen_id}).")
+                self.loaded = True
+                return self.fingerprints
+        finally:
+            if table_was_reset:
+                reset_validation_pool()  # workers still hold the removed fingerprints
+
+    def ensure_loaded(self):
+        return self.fingerprints if self.loaded else self.refresh()
+
+    def hashes_since(self, count):
+        """Fingerprints added after the first `count` ones, in the order they were accepted."""
+        with self._lock:
+            return self._hashes[count:]
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._hashes)
+
+
+@st.cache_resource
+def get_accepted_fingerprint_cache():
+    return AcceptedFingerprintCache()
+
+
+# --- Persistent validation worker pool ---
+# Workers build their DataValidator once, from the reference data version the pool was
+# created for. When the registry swaps in a new version the pool is replaced (chunks
+# already running finish on the old one), so uploads never reload reference data.
+# Accepted fingerprints known at pool start are handed to the workers once; each chunk
+# then carries only the ones accepted since (pool.accepted_fingerprint_count).
+_worker_validator = None
+
+
+def _init_validation_worker(base_ref_path, accepted_exception_fingerprints):
+    global _IN_VALIDATION_WORKER, _worker_validator
+    _IN_VALIDATION_WORKER = True
+    _worker_validator = DataValidator(base_ref_path=base_ref_path, accepted_exception_fingerprints_set=set(accepted_exception_fingerprints))
+
+
+def _warm_validation_worker():
+    return os.getpid()
+
+
+def _validate_chunk_in_worker(df_chunk, new_accepted_fingerprints):
+    if new_accepted_fingerprints:
+        _worker_validator.accepted_exception_fingerprints.update(new_accepted_fingerprints)
+    return _validate_chunk(_worker_validator, df_chunk)
+
+
+class ValidationPoolManager:
+    """Owns the process's validation ProcessPoolExecutor and replaces it per reference data version."""
+
+    def __init__(self):
+        self._pool = None
+        self._key = None
+        self._lock = threading.Lock()
+
+    def get(self, base_ref_path="reference_data", prewarm=False):
+        key = (os.path.abspath(base_ref_path), get_reference_registry(base_ref_path).version)
+        with self._lock:
+            if self._pool is None or self._key != key:
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False)
+                num_workers = os.cpu_count() or 4
+                fingerprint_cache = get_accepted_fingerprint_cache()
+                fingerprint_cache.ensure_loaded()
+                accepted_fingerprints = fingerprint_cache.snapshot()
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=num_workers, initializer=_init_validation_worker,
+                    initargs=(base_ref_path, accepted_fingerprints)
+                )
+                self._pool.accepted_fingerprint_count = len(accepted_fingerprints)
+                self._key = key
+                logging.info(f"Started validation pool with {num_workers} workers for reference data version {key[1]}.")
+                if prewarm:
+                    for _ in range(num_workers):
+                        self._pool.submit(_warm_validation_worker)
+            return self._pool
+
+    def reset(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+            self._pool, self._key = None, None
+
+
+@st.cache_resource
+def get_validation_pool_manager():
+    return ValidationPoolManager()
+
+
+def get_validation_pool(base_ref_path="reference_data", prewarm=False):
+    """Returns the shared ProcessPoolExecutor for the current reference data version."""
+    return get_validation_pool_manager().get(base_ref_path, prewarm=prewarm)
+
+
+def reset_validation_pool():
+    """Drops the pool (e.g. after a worker crashed) so the next call starts a fresh one."""
+    get_validation_pool_manager().reset()
+
+
 def display_metric(title, value, delta=None, container=None):
     target_container = container if container else st
     delta_html = f'<div class="metric-delta" style="font-size:0.8rem; color:#e2e8f0;">{delta}</div>' if delta else ""
@@ -2863,46 +4729,63 @@ def display_metric(title, value, delta=None, container=None):
     </div>
     """, unsafe_allow_html=True)
 
+def _prepare_report_frame(exceptions_df, dept_stats):
+    """Normalises exception rows for the Excel report: cleaned reasons, integer severity, numeric amounts and ids."""
+    exceptions_df_prepared = exceptions_df.copy() if exceptions_df is not None else pd.DataFrame()
+
+    if 'Exception Reasons' in exceptions_df_prepared.columns:
+        exceptions_df_prepared['Exception Reasons'] = exceptions_df_prepared['Exception Reasons'].astype(str).replace('<NA>', '').replace('nan', '').replace('None','')
+    if 'Severity' in exceptions_df_prepared.columns:
+        exceptions_df_prepared['Severity'] = pd.to_numeric(exceptions_df_prepared['Severity'], errors='coerce').fillna(0)
+        if exceptions_df_prepared['Severity'].notna().all():
+             try:
+                exceptions_df_prepared['Severity'] = exceptions_df_prepared['Severity'].astype(int)
+             except ValueError:
+                pass
+
+    numeric_cols_to_preserve = ['Net amount', 'Severity', 'id', 'run_id']
+    if dept_stats:
+         numeric_cols_to_preserve.extend(['Total Records', 'Exception Records', 'Exception Rate (%)'])
+
+    for col in exceptions_df_prepared.columns:
+        if col in numeric_cols_to_preserve:
+            if col == 'Net amount':
+                exceptions_df_prepared[col] = pd.to_numeric(exceptions_df_prepared[col], errors='coerce').fillna(0.0)
+            elif col in ['id', 'run_id']:
+                exceptions_df_prepared[col] = pd.to_numeric(exceptions_df_prepared[col], errors='coerce')
+        else:
+            if not pd.api.types.is_numeric_dtype(exceptions_df_prepared[col]) and \
+               not pd.api.types.is_string_dtype(exceptions_df_prepared[col]):
+                exceptions_df_prepared[col] = exceptions_df_prepared[col].astype(str).replace('<NA>', '').replace('nan', '').replace('None','').replace('NaT','')
+    return exceptions_df_prepared
+
+
+def _report_number_format(header):
+    if header == "Net amount": return '#,##0.00'
+    if header == "Exception Rate (%)": return '0.00"%"'
+    if header == "Severity" or "Records" in header or "ID" in header or "id" in header: return '0'
+    return None
+
+
+def _department_summary_frame(dept_stats):
+    if not dept_stats:
+        return pd.DataFrame(columns=['Department', 'Total Records', 'Exception Records', 'Exception Rate (%)'])
+    return pd.DataFrame([{'Department': dept, 'Total Records': stats.get('total_records', 0), 'Exception Records': stats.get('exception_records', 0), 'Exception Rate (%)': round(stats.get('exception_rate', 0), 2)} for dept, stats in dept_stats.items()])
+
+
 def create_excel_report(exceptions_df, dept_stats, filename_for_logging="ExcelReport"):
+    from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+    from openpyxl.utils import get_column_letter
+
     output = io.BytesIO()
     try:
         if exceptions_df is None or exceptions_df.empty:
             logging.info(f"create_excel_report: exceptions_df is empty for {filename_for_logging}. Creating empty Exceptions sheet.")
-            exceptions_df_prepared = exceptions_df.copy() if exceptions_df is not None else pd.DataFrame()
-        else:
-            exceptions_df_prepared = exceptions_df.copy()
-
-        if 'Exception Reasons' in exceptions_df_prepared.columns:
-            exceptions_df_prepared['Exception Reasons'] = exceptions_df_prepared['Exception Reasons'].astype(str).replace('<NA>', '').replace('nan', '').replace('None','')
-        if 'Severity' in exceptions_df_prepared.columns:
-            exceptions_df_prepared['Severity'] = pd.to_numeric(exceptions_df_prepared['Severity'], errors='coerce').fillna(0)
-            if exceptions_df_prepared['Severity'].notna().all():
-                 try:
-                    exceptions_df_prepared['Severity'] = exceptions_df_prepared['Severity'].astype(int)
-                 except ValueError:
-                    pass
-
-        numeric_cols_to_preserve = ['Net amount', 'Severity', 'id', 'run_id']
-        if dept_stats:
-             numeric_cols_to_preserve.extend(['Total Records', 'Exception Records', 'Exception Rate (%)'])
-
-        for col in exceptions_df_prepared.columns:
-            if col in numeric_cols_to_preserve:
-                if col == 'Net amount':
-                    exceptions_df_prepared[col] = pd.to_numeric(exceptions_df_prepared[col], errors='coerce').fillna(0.0)
-                elif col in ['id', 'run_id']:
-                    exceptions_df_prepared[col] = pd.to_numeric(exceptions_df_prepared[col], errors='coerce')
-            else:
-                if not pd.api.types.is_numeric_dtype(exceptions_df_prepared[col]) and \
-                   not pd.api.types.is_string_dtype(exceptions_df_prepared[col]):
-                    exceptions_df_prepared[col] = exceptions_df_prepared[col].astype(str).replace('<NA>', '').replace('nan', '').replace('None','').replace('NaT','')
+        exceptions_df_prepared = _prepare_report_frame(exceptions_df, dept_stats)
 
         with pd.ExcelWriter(output, engine='openpyxl') as writer:
             exceptions_df_prepared.to_excel(writer, sheet_name='Exceptions', index=False)
-            if not dept_stats:
-                 dept_summary_df = pd.DataFrame(columns=['Department', 'Total Records', 'Exception Records', 'Exception Rate (%)'])
-            else:
-                dept_summary_df = pd.DataFrame([{'Department': dept, 'Total Records': stats.get('total_records', 0), 'Exception Records': stats.get('exception_records', 0), 'Exception Rate (%)': round(stats.get('exception_rate', 0), 2)} for dept, stats in dept_stats.items()])
+            dept_summary_df = _department_summary_frame(dept_stats)
             dept_summary_df.to_excel(writer, sheet_name='Department Summary', index=False)
             workbook = writer.book
             header_font = Font(bold=True, color="FFFFFF"); header_fill = PatternFill(start_color="667eea", end_color="667eea", fill_type="solid")
@@ -2921,10 +4804,8 @@ def create_excel_report(exceptions_df, dept_stats, filename_for_logging="ExcelRe
                 for row_idx in range(2, ws.max_row + 1):
                     for col_idx in range(1, ws.max_column + 1):
                         cell = ws.cell(row=row_idx, column=col_idx); cell.alignment = Alignment(horizontal="left", vertical="center", wrap_text=True); cell.border = cell_border
-                        header_cell_value = str(ws.cell(row=1, column=col_idx).value or "")
-                        if header_cell_value == "Net amount": cell.number_format = '#,##0.00'
-                        elif header_cell_value == "Exception Rate (%)": cell.number_format = '0.00"%"'
-                        elif header_cell_value == "Severity" or "Records" in header_cell_value or "ID" in header_cell_value or "id" in header_cell_value : cell.number_format = '0'
+                        number_format = _report_number_format(str(ws.cell(row=1, column=col_idx).value or ""))
+                        if number_format: cell.number_format = number_format
                 for col_idx_letter_enum, column_cells_obj in enumerate(ws.columns, 1):
                     current_col_letter = get_column_letter(col_idx_letter_enum); header_val_str = str(ws.cell(row=1, column=col_idx_letter_enum).value or ""); max_length = len(header_val_str)
                     for cell_in_col_obj in column_cells_obj:
@@ -2942,7 +4823,146 @@ def create_excel_report(exceptions_df, dept_stats, filename_for_logging="ExcelRe
         logging.exception(f"create_excel_report: Error generating Excel report for {filename_for_logging}: {e}")
         st.markdown(f'<div class="error-box"><strong>❌ Error:</strong> Error generating Excel report: {e}</div>', unsafe_allow_html=True); return None
 
+class ExceptionReportSpool:
+    """
+    Collects exception rows for the Excel report on disk instead of in memory.
+
+    The streaming pipeline appends each chunk's exceptions as they are found; write_excel()
+    then streams them into a write-only workbook with the same layout and styling as
+    create_excel_report, so neither the rows nor the workbook are held in memory at once.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self.columns = []
+        self.widths = {}
+        self.row_count = 0
+
+    def append(self, exceptions_df):
+        if exceptions_df is None or exceptions_df.empty:
+            return
+        frame = _prepare_report_frame(exceptions_df, None)
+        for col in frame.columns:
+            if col not in self.columns:
+                self.columns.append(col)
+                self.widths[col] = len(str(col))
+            text = frame[col].dropna().astype(str)
+            if not text.empty:
+                self.widths[col] = max(self.widths[col], int(text.map(lambda v: max(len(line) for line in v.split('\n'))).max()))
+        pickle.dump(frame, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.row_count += len(frame)
+
+    def _frames(self):
+        self._file.seek(0)
+        while True:
+            try:
+                yield pickle.load(self._file)
+            except EOFError:
+                return
+
+    def close(self):
+        self._file.close()
+
+    def write_excel(self, dept_stats, filename_for_logging="ExcelReport"):
+        """Writes the spooled exceptions and the department summary to an .xlsx in a BytesIO."""
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+        from openpyxl.utils import get_column_letter
+
+        try:
+            if self.row_count == 0:
+                logging.info(f"ExceptionReportSpool: no exceptions for {filename_for_logging}. Creating empty Exceptions sheet.")
+            header_font = Font(bold=True, color="FFFFFF"); header_fill = PatternFill(start_color="667eea", end_color="667eea", fill_type="solid")
+            thin_border_side = Side(style='thin'); cell_border = Border(left=thin_border_side, right=thin_border_side, top=thin_border_side, bottom=thin_border_side)
+            header_alignment = Alignment(horizontal="center", vertical="center"); body_alignment = Alignment(horizontal="left", vertical="center", wrap_text=True)
+            workbook = Workbook(write_only=True)
+
+            def _add_sheet(title, columns, widths, rows):
+                ws = workbook.create_sheet(title)
+                for col_idx, col in enumerate(columns, 1):  # widths must be set before the first row
+                    ws.column_dimensions[get_column_letter(col_idx)].width = min(widths.get(col, len(str(col))) + 5, 60)
+                header_row = []
+                for col in columns:
+                    cell = WriteOnlyCell(ws, value=str(col)); cell.font = header_font; cell.fill = header_fill; cell.alignment = header_alignment; cell.border = cell_border
+                    header_row.append(cell)
+                ws.append(header_row)
+                number_formats = [_report_number_format(str(col)) for col in columns]
+                for values in rows:
+                    row = []
+                    for value, number_format in zip(values, number_formats):
+                        cell = WriteOnlyCell(ws, value=None if value is None or (not isinstance(value, str) and pd.isna(value)) else value)
+                        cell.alignment = body_alignment; cell.border = cell_border
+                        if number_format: cell.number_format = number_format
+                        row.append(cell)
+                    ws.append(row)
+
+            def _exception_rows():
+                for frame in self._frames():
+                    yield from frame.reindex(columns=self.columns).itertuples(index=False, name=None)
+
+            _add_sheet('Exceptions', self.columns, self.widths, _exception_rows())
+            dept_summary_df = _department_summary_frame(dept_stats)
+            dept_widths = {col: max([len(str(col))] + [len(str(v)) for v in dept_summary_df[col]]) for col in dept_summary_df.columns}
+            _add_sheet('Department Summary', list(dept_summary_df.columns), dept_widths, dept_summary_df.itertuples(index=False, name=None))
+
+            output = io.BytesIO()
+            workbook.save(output)
+            output.seek(0)
+            return output
+        except Exception as e:
+            logging.exception(f"ExceptionReportSpool: Error generating Excel report for {filename_for_logging}: {e}")
+            return None
+
+
+def _page_state(key_prefix, total_rows, page_size, filter_signature=None):
+    """
+    Current 1-based page of a paged view and the page count. The page resets to 1 when
+    `filter_signature` changes and is clamped when the row count shrinks.
+    """
+    page_key = f"{key_prefix}_page"
+    signature_key = f"{key_prefix}_page_filters"
+    if st.session_state.get(signature_key) != filter_signature:
+        st.session_state[signature_key] = filter_signature
+        st.session_state[page_key] = 1
+    total_pages = max(1, math.ceil(total_rows / page_size))
+    page = min(max(1, st.session_state.get(page_key, 1)), total_pages)
+    st.session_state[page_key] = page
+    return page, total_pages
+
+
+def render_page_navigation(key_prefix, page, total_pages, total_rows, page_size):
+    """Previous/next buttons and a 'rows x-y of n' caption for a view paged with _page_state."""
+    nav_prev, nav_info, nav_next = st.columns([1, 3, 1])
+    if nav_prev.button("◀ Previous", key=f"{key_prefix}_prev", disabled=page <= 1, use_container_width=True):
+        st.session_state[f"{key_prefix}_page"] = page - 1
+        st.rerun()
+    first_row = (page - 1) * page_size + 1 if total_rows else 0
+    last_row = min(page * page_size, total_rows)
+    nav_info.markdown(
+        f"<div style='text-align:center;padding-top:0.4rem'>Rows {first_row:,}–{last_row:,} of {total_rows:,} · Page {page} of {total_pages}</div>",
+        unsafe_allow_html=True
+    )
+    if nav_next.button("Next ▶", key=f"{key_prefix}_next", disabled=page >= total_pages, use_container_width=True):
+        st.session_state[f"{key_prefix}_page"] = page + 1
+        st.rerun()
+
+
+def _show_original_record(original_data):
+    if not original_data:
+        st.warning("Original row data is not available for this exception record.")
+        return
+    original_df = pd.DataFrame([original_data]).dropna(axis=1, how='all')
+    st.markdown("#### Original Record Details")
+    st.dataframe(original_df.T.rename(columns={0: 'Value'}).astype(str), use_container_width=True)
+
+
 def display_interactive_exceptions(df, key_prefix="df"):
+    """
+    Paged, sortable grid of exception records. Only the current page is sent to the browser;
+    the full original record is shown for the selected row, loaded from the database when
+    the frame does not carry it.
+    """
     if df.empty:
         st.success("No exceptions to display for the current selection.")
         return
@@ -2952,47 +4972,605 @@ def display_interactive_exceptions(df, key_prefix="df"):
         'Account2.Code', 'Sub Ledger.Code', 'Exception Reasons', 'Severity'
     ] if col in df.columns]
 
-    st.info("💡 Click on any row to see the complete original data for that record.")
+    sort_col, order_col, size_col = st.columns([2, 1, 1])
+    sort_by = sort_col.selectbox("Sort by", display_cols, key=f"{key_prefix}_sort")
+    descending = order_col.toggle("Descending", value=False, key=f"{key_prefix}_descending")
+    page_size = size_col.selectbox("Rows per page", PAGE_SIZE_OPTIONS, index=1, key=f"{key_prefix}_page_size")
 
-    selection_key = f"{key_prefix}_selection"
-    if selection_key not in st.session_state:
-        st.session_state[selection_key] = None
+    page, total_pages = _page_state(key_prefix, len(df), page_size, (sort_by, descending, page_size, len(df)))
 
-    edited_df = st.data_editor(
-        df[display_cols],
-        key=f"{key_prefix}_editor",
+    # Sort only the key column and slice row positions, so the frame itself is never copied.
+    sort_keys = df[sort_by].reset_index(drop=True)
+    try:
+        order = sort_keys.sort_values(ascending=not descending, kind='stable', na_position='last').index.to_numpy()
+    except TypeError:  # mixed types in columns expanded from original_row_data
+        order = sort_keys.astype(str).sort_values(ascending=not descending, kind='stable').index.to_numpy()
+    page_df = df.iloc[order[(page - 1) * page_size:page * page_size]]
+
+    st.info("💡 Select a row to see the complete original data for that record.")
+    event = st.dataframe(
+        page_df[display_cols],
+        key=f"{key_prefix}_grid_{page}_{sort_by}_{descending}_{page_size}",
         use_container_width=True,
         hide_index=True,
-        num_rows="dynamic",
-        disabled=df.columns,
-        on_change=lambda: st.session_state.update({selection_key: st.session_state[f"{key_prefix}_editor"].get("selection")})
+        on_select="rerun",
+        selection_mode="single-row",
     )
+    render_page_navigation(key_prefix, page, total_pages, len(df), page_size)
+
+    selected_rows = event.selection.rows if event else []
+    if not selected_rows:
+        return
+    selected_record = page_df.iloc[selected_rows[0]]
+    exception_id = selected_record.get('id', 'N/A')
+
+    with st.expander(f"**👁️ Viewing Original Data for Exception ID: {exception_id}**", expanded=True):
+        original_data_raw = selected_record.get('original_row_data')
+        if isinstance(original_data_raw, (dict, str)):
+            try:
+                original_data = original_data_raw if isinstance(original_data_raw, dict) else json.loads(original_data_raw)
+            except (json.JSONDecodeError, TypeError):
+                st.error("Could not parse the original row data. It might be corrupted.")
+                st.text(original_data_raw)
+                return
+        elif 'id' in selected_record and pd.notna(exception_id):
+            with st.spinner("Loading original record..."):
+                original_data = db_manager.get_exception_detail([exception_id]).get(int(exception_id))
+        else:
+            # Records that were never saved (e.g. the upload preview) carry the full row themselves.
+            original_data = selected_record.drop(labels=['Exception Reasons', 'Severity'], errors='ignore').to_dict()
+        _show_original_record(original_data)
+
+# --- Ledger file readers ---
+# Columns the validator, duplicate check, suspicious rules and persistence read by name.
+# Passing these as `columns` to read_ledger_file skips everything else in wide exports.
+# Note: the accepted-exception fingerprint and `original_row_data` are built from the whole
+# row, so the upload pipeline keeps reading all columns unless a caller opts in.
+LEDGER_WORKING_COLUMNS = [
+    'Document No.', 'Created user', 'Modified user', 'Department.Name', 'Sub Department.Name',
+    'Function.Name', 'FC-Vertical.Name', 'Location.Name', 'Crop.Name', 'Activity.Name',
+    'Region.Name', 'Zone.Name', 'Business Unit.Name', 'Account.Code', 'Account2.Code',
+    'Sub Ledger.Code', 'Net amount', 'Narration',
+]
+
+# Low-cardinality text columns stored as categoricals to cut memory on large exports.
+LEDGER_CATEGORICAL_COLUMNS = ['Department.Name', 'Location.Name', 'Created user']
+
+LEDGER_FILE_EXTENSIONS = ('.xlsx', '.xls', '.csv', '.parquet')
+
+
+def get_excel_engine():
+    """Returns 'calamine' when python-calamine is installed (much faster), else 'openpyxl'."""
+    return 'calamine' if importlib.util.find_spec('python_calamine') is not None else 'openpyxl'
+
+
+def compact_ledger_dtypes(df):
+    """Converts the low-cardinality text columns to categoricals in place and returns df."""
+    for col in LEDGER_CATEGORICAL_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            # Match the str() conversion the pipeline applied before (NaN becomes 'nan').
+            values = df[col].astype(str) if col == 'Created user' else df[col]
+            df[col] = values.astype('category')
+    return df
+
+
+def read_ledger_file(source, filename=None, columns=None, engine=None, compact=True):
+    """
+    Reads a ledger export into a DataFrame. `source` may be a path or a file-like object
+    (e.g. a Streamlit upload); the format is picked from `filename` or the source name.
+
+    - .xlsx/.xls use the standard export layout (5 header rows and a totals footer) and the
+      fastest available Excel engine unless `engine` is given.
+    - .csv/.parquet are expected to be plain tables with the header on the first row.
+    - `columns` limits parsing to those column names (missing ones are ignored).
+    - `compact` stores department/location/user as categoricals.
+    """
+    name = filename or getattr(source, 'name', None) or str(source)
+    extension = os.path.splitext(name)[1].lower()
+    wanted = set(columns) if columns else None
+    usecols = (lambda c: str(c).strip() in wanted) if wanted else None
+
+    if extension == '.csv':
+        df = pd.read_csv(source, usecols=usecols, low_memory=False)
+    elif extension == '.parquet':
+        parquet_columns = None
+        if wanted:
+            # Resolve the names against the file schema so only those column chunks are read.
+            import pyarrow.parquet as pq
+            parquet_columns = [c for c in pq.read_schema(source).names if str(c).strip() in wanted]
+            if hasattr(source, 'seek'):
+                source.seek(0)
+        df = pd.read_parquet(source, columns=parquet_columns)
+    elif extension in ('.xlsx', '.xls'):
+        df = pd.read_excel(source, engine=engine or get_excel_engine(), skiprows=5, skipfooter=1, usecols=usecols)
+    else:
+        raise ValueError(f"Unsupported file type '{extension}'. Expected one of: {', '.join(LEDGER_FILE_EXTENSIONS)}")
+
+    df.columns = df.columns.str.strip()
+    if compact:
+        compact_ledger_dtypes(df)
+    return df
+
+
+EXCEL_ERROR_VALUES = {'#N/A', '#DIV/0!', '#REF!', '#VALUE!', '#NAME?', '#NUM!', '#NULL!'}
+
+
+def _convert_excel_cell(value):
+    # Mirrors pandas' openpyxl cell conversion so streamed rows hash like read_excel rows.
+    if value is None:
+        return ""
+    if isinstance(value, str) and value in EXCEL_ERROR_VALUES:
+        return np.nan
+    if isinstance(value, float) and not isinstance(value, bool) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _iter_excel_rows(source):
+    """Yields (header, rows) batches from the first sheet using openpyxl's read-only mode."""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        for _ in range(5):
+            next(rows, None)
+        header = None
+        for row in rows:
+            if header is None:
+                if any(v is not None for v in row):
+                    header = list(row)
+                continue
+            yield header, row
+    finally:
+        workbook.close()
+
+
+def iter_ledger_chunks(source, chunksize=50000, filename=None, columns=None, compact=True):
+    """
+    Streams a ledger export as DataFrames of at most `chunksize` rows, so files larger
+    than memory can be validated. Row indexes continue across chunks; dtypes are inferred
+    per chunk.
+
+    Excel (.xlsx) is read row by row with openpyxl's read-only mode and the totals footer
+    is dropped at the end; CSV and Parquet use their native chunked readers. Legacy .xls
+    has no streaming reader and raises ValueError; convert it to .xlsx or read it whole
+    with read_ledger_file.
+    """
+    name = filename or getattr(source, 'name', None) or str(source)
+    extension = os.path.splitext(name)[1].lower()
+    wanted = set(columns) if columns else None
+
+    def _finish(df, offset):
+        df.columns = df.columns.str.strip()
+        if wanted:
+            df = df[[c for c in df.columns if c in wanted]]
+        df.index = pd.RangeIndex(offset, offset + len(df))
+        return compact_ledger_dtypes(df) if compact else df
+
+    offset = 0
+    if extension == '.csv':
+        usecols = (lambda c: str(c).strip() in wanted) if wanted else None
+        for df in pd.read_csv(source, usecols=usecols, chunksize=chunksize, low_memory=False):
+            yield _finish(df, offset)
+            offset += len(df)
+    elif extension == '.parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(source)
+        parquet_columns = [c for c in parquet_file.schema_arrow.names if str(c).strip() in wanted] if wanted else None
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=parquet_columns):
+            df = batch.to_pandas()
+            yield _finish(df, offset)
+            offset += len(df)
+    elif extension == '.xlsx':
+        header, buffered, tail = None, [], []
+        for header, row in _iter_excel_rows(source):
+            # Like read_excel(skipfooter=1): trailing blank rows are trimmed and the last
+            # non-empty row (the totals footer) is dropped, so hold that tail back.
+            if all(v is None for v in row):
+                tail.append(row)
+                continue
+            for held in tail:
+                buffered.append([_convert_excel_cell(v) for v in held[:len(header)]] + [""] * (len(header) - len(held)))
+            tail = [row]
+            if len(buffered) >= chunksize:
+                df = TextParser([header] + buffered, header=0).read()
+                buffered = []
+                yield _finish(df, offset)
+                offset += len(df)
+        if buffered:
+            df = TextParser([header] + buffered, header=0).read()
+            yield _finish(df, offset)
+    elif extension == '.xls':
+        raise ValueError(f"Cannot stream '{name}': .xls files can only be read whole. Convert it to .xlsx or process it without chunking.")
+    else:
+        raise ValueError(f"Unsupported file type '{extension}' for streaming. Expected one of: .xlsx, .csv, .parquet")
+
+
+def build_transaction_fingerprint(row):
+    """
+    Builds the normalized fingerprint used to detect transactions that were already
+    processed in a previous run: doc no | location | activity | crop | net amount.
+    """
+    doc_no = str(row.get("Document No.", "")).strip().lower()
+    location = str(row.get("Location.Name", "")).strip().lower()
+    activity = str(row.get("Activity.Name", "")).strip().lower()
+    crop = str(row.get("Crop.Name", "")).strip().lower()
+    try:
+        net_amount = f"{float(row.get('Net amount', 0.0)):.2f}"
+    except (ValueError, TypeError):
+        net_amount = "0.00"
+    return f"{doc_no}|{location}|{activity}|{crop}|{net_amount}"
+
+
+TRANSACTION_FINGERPRINT_COLUMNS = ["Document No.", "Location.Name", "Activity.Name", "Crop.Name"]
+
+# Columns the pipeline touches after validation (fingerprints, scoping, immunity and stats).
+# Stages past validation work on this slim view instead of carrying every input column.
+PIPELINE_WORKING_COLUMNS = TRANSACTION_FINGERPRINT_COLUMNS + [
+    "Net amount", "Created user", "Department.Name", "Sub Department.Name", "Account2.Code", "Sub Ledger.Code",
+]
+
+
+def _format_net_amount(value):
+    try:
+        return f"{float(value):.2f}"
+    except (ValueError, TypeError):
+        return "0.00"
+
+
+def _normalized_text(df, col, lower=True):
+    """str(value).strip() for every row (NaN becomes 'nan', like the row-wise code); '' if the column is missing."""
+    if col not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    values = df[col].astype(object).map(str).str.strip()
+    return values.str.lower() if lower else values
+
+
+def compute_transaction_fingerprints(df):
+    """Column-wise equivalent of build_transaction_fingerprint for a whole DataFrame."""
+    parts = [_normalized_text(df, col) for col in TRANSACTION_FINGERPRINT_COLUMNS]
+    if "Net amount" in df.columns:
+        net_amounts = df["Net amount"].astype(object).map(_format_net_amount)
+    else:
+        net_amounts = pd.Series("0.00", index=df.index, dtype=object)
+    return parts[0].str.cat(parts[1:] + [net_amounts], sep="|")
+
+
+def filter_records_for_user(df_original, user_role, username, managed_users=None):
+    """
+    Applies the role-based upload scope. Returns (filtered_df, filter_message).
+    Users only see their own records, Managers see their team, everyone else sees all rows.
+    """
+    if not isinstance(df_original['Created user'].dtype, pd.CategoricalDtype):
+        df_original['Created user'] = df_original['Created user'].astype(str)
+
+    # Boolean masks only: the selection is materialized once, and Management/Super User
+    # scope returns the original frame itself without copying it.
+    if user_role == 'User':
+        df_to_process = df_original[df_original['Created user'].str.lower() == username.lower()]
+        filter_message = f"As a **User**, this file has been automatically filtered to process records created by you."
+    elif user_role == 'Manager':
+        accessible_users = [username.lower()] + [u.lower() for u in (managed_users or [])]
+        df_to_process = df_original[df_original['Created user'].str.lower().isin(accessible_users)]
+        filter_message = f"As a **Manager**, this file has been filtered for you and your team."
+    else: # Management and Super User
+        df_to_process = df_original
+        filter_message = "As **Management/Super User**, all records in the file will be processed."
+    return df_to_process, filter_message
+
+
+REQUIRED_PROCESSING_COLUMNS = ['Department.Name', 'Account2.Code', 'Sub Ledger.Code']
+
+
+def _verdict_counts(df, key_column, exceptions_df, exception_mask=None):
+    """
+    total_records/exception_records per value of key_column from a single groupby over the
+    rows' exception verdicts. exceptions_df rows carry the index of the row they came from,
+    so the verdicts are read off the index instead of re-grouping the exception rows.
+    """
+    if exception_mask is None:
+        exception_mask = df.index.isin(exceptions_df.index) if not exceptions_df.empty else np.zeros(len(df), dtype=bool)
+    verdicts = pd.Series(exception_mask, index=df.index, dtype=np.int64)
+    counts = verdicts.groupby(df[key_column], observed=True).agg(['size', 'sum'])
+    counts.columns = ['total_records', 'exception_records']
+    return counts
+
+
+def compute_department_stats(df, exceptions_df, exception_mask=None):
+    """Per-department total/exception counts in the dict shape used by save_department_summary."""
+    department_stats = {}
+    if 'Department.Name' not in df.columns:
+        return department_stats
+
+    counts = _verdict_counts(df, 'Department.Name', exceptions_df, exception_mask)
+    for dept, total_records, exception_records in zip(counts.index, counts['total_records'].tolist(), counts['exception_records'].tolist()):
+        department_stats[dept] = {
+            'total_records': total_records,
+            'exception_records': exception_records,
+            'exception_rate': (exception_records / total_records * 100) if total_records > 0 else 0
+        }
+    return department_stats
+
+
+def merge_department_stats(merged, chunk_stats):
+    """Adds one chunk's department stats into `merged` (in place) and recomputes the rates."""
+    for dept, stats in chunk_stats.items():
+        entry = merged.setdefault(dept, {'total_records': 0, 'exception_records': 0, 'exception_rate': 0})
+        entry['total_records'] += stats['total_records']
+        entry['exception_records'] += stats['exception_records']
+        entry['exception_rate'] = (entry['exception_records'] / entry['total_records'] * 100) if entry['total_records'] > 0 else 0
+    return merged
+
+
+def compute_user_stats(df, exceptions_df, exception_mask=None):
+    """Per-user total/exception counts; user names are stripped and blank users ignored."""
+    # Group on the raw (usually categorical) column, then normalize the few distinct names.
+    counts = _verdict_counts(df, 'Created user', exceptions_df, exception_mask)
+    counts.index = counts.index.astype(str).str.strip()
+    user_stats = counts[counts.index != ''].groupby(level=0).sum().astype(int)
+    user_stats.index.name = 'Created user'
+    return user_stats.reset_index()
+
+
+def merge_user_stats(merged, chunk_stats):
+    if merged is None or merged.empty:
+        return chunk_stats
+    return pd.concat([merged, chunk_stats]).groupby('Created user', as_index=False)[['total_records', 'exception_records']].sum()
+
+
+def _build_pipeline_context():
+    """Loads everything the pipeline needs once per file: fingerprints, validator and rules."""
+    rules_dict = {}
+    suspicious_rules_df = db_manager.get_all_suspicious_rules()
+    if not suspicious_rules_df.empty:
+        for _, rule in suspicious_rules_df.iterrows():
+            if rule['rule_values']:
+                key = (rule['sub_department_name'], rule['rule_column'])
+                rules_dict[key] = [str(v).lower() for v in rule['rule_values']]
+    return {
+        'historical_fingerprints': db_manager.get_historical_fingerprints(),
+        'validator': DataValidator(base_ref_path="reference_data", accepted_exception_fingerprints_set=get_accepted_fingerprint_cache().refresh()),
+        'immunity_list': db_manager.load_suspense_immunity_list(),
+        'rules_dict': rules_dict,
+    }
+
+
+def _validate_and_deduplicate(ctx, df_to_process):
+    """
+    Validates the rows and marks clean rows already seen in previous runs, without copying
+    the input. Returns (keep_mask, fingerprints, exceptions_df, exception_count,
+    new_clean_count, ignored_clean_count); keep_mask selects the exception rows plus the
+    new clean rows, i.e. the rows that make up the run.
+    """
+    # 1. Run validation on ALL incoming data first
+    all_exceptions_df, _ = ctx['validator'].validate_dataframe(df_to_process)
+
+    # 2. Clean rows whose fingerprint was saved by a previous run are duplicates
+    exception_mask = df_to_process.index.isin(all_exceptions_df.index)
+    fingerprints = compute_transaction_fingerprints(df_to_process)
+    duplicate_mask = ~exception_mask & fingerprints.isin(ctx['historical_fingerprints']).to_numpy()
+    keep_mask = ~duplicate_mask
+
+    exception_count = int(exception_mask.sum())
+    ignored_clean_count = int(duplicate_mask.sum())
+    new_clean_count = len(df_to_process) - exception_count - ignored_clean_count
+    return keep_mask, fingerprints, all_exceptions_df, exception_count, new_clean_count, ignored_clean_count
+
+
+def _persist_processed_rows(ctx, run_id, df_to_process, keep_mask, fingerprints, exceptions_df, processing_log=None):
+    """
+    Saves one batch of rows for a run: suspicious-rule hits, exceptions and transaction
+    fingerprints for the rows selected by keep_mask. Returns (flagged_count, user_stats,
+    department_stats, uploaded_users) so callers can aggregate per-run summaries across batches.
+    """
+    historical_fingerprints = ctx['historical_fingerprints']
+    immunity_list = ctx['immunity_list']
+    rules_dict = ctx['rules_dict']
+    flagged_count = 0
+    kept = df_to_process.loc[keep_mask, [c for c in PIPELINE_WORKING_COLUMNS if c in df_to_process.columns]]
+    kept_fingerprints = fingerprints[keep_mask]
+
+    # --- Suspicious Transaction Check (runs on de-duplicated data) ---
+    # Only rows in a sub-department that has rules, that are not historical duplicates and
+    # whose ledger combination is not immune can match, so just those rows are visited.
+    if rules_dict and not kept.empty:
+        sub_depts = _normalized_text(kept, 'Sub Department.Name', lower=False)
+        ledger_keys = _normalized_text(kept, 'Account2.Code', lower=False) + "_" + _normalized_text(kept, 'Sub Ledger.Code', lower=False)
+        candidate_mask = (
+            (sub_depts != '')
+            & sub_depts.isin({rule_sub_dept for rule_sub_dept, _ in rules_dict})
+            & ~kept_fingerprints.isin(historical_fingerprints)
+            & ~ledger_keys.isin(immunity_list)
+        )
+        for index, sub_dept in sub_depts[candidate_mask].items():
+            row = df_to_process.loc[index]
+            user = row.get('Created user', 'Unknown User')
+            for (rule_sub_dept, rule_col), rule_vals_lower in rules_dict.items():
+                if sub_dept == rule_sub_dept:
+                    row_val_lower = str(row.get(rule_col, '')).strip().lower()
+                    log_entry = f"Row for **{user}**: Checking Sub-Dept `'{sub_dept}'`. Comparing value `'{row_val_lower}'` in column `'{rule_col}'` against rule `'{rule_vals_lower}'`."
+
+                    if row_val_lower in rule_vals_lower:
+                        db_manager.log_suspicious_transaction(run_id, row.to_dict(), user)
+                        flagged_count += 1
+                        if processing_log is not None: processing_log.append(log_entry + " -> **MATCH FOUND**")
+                        break
+                    else:
+                        if processing_log is not None: processing_log.append(log_entry + " -> No Match")
+
+    if not exceptions_df.empty:
+        db_manager.save_exceptions(run_id, exceptions_df)
+
+    # --- Save transaction history for future duplicate checks ---
+    if not kept.empty:
+        db_manager.save_transaction_fingerprints(run_id, list(set(kept_fingerprints)))
+
+    exception_mask = kept.index.isin(exceptions_df.index)
+    user_stats = compute_user_stats(kept, exceptions_df, exception_mask) if 'Created user' in kept.columns else None
+    department_stats = compute_department_stats(kept, exceptions_df, exception_mask)
+    return flagged_count, user_stats, department_stats, _uploaded_users(kept)
+
+
+def _finalize_run(run_id, filename, user_stats, department_statistics, uploaded_users, exceptions_df, report_spool=None):
+    """
+    Saves the per-run summaries, notifies Super Users about ghost users and stores the report.
+    The report is built from `report_spool` (an ExceptionReportSpool) when given, else from `exceptions_df`.
+    """
+    if user_stats is not None:
+        db_manager.save_user_performance_stats(run_id, user_stats)
+    if department_statistics:
+        db_manager.save_department_summary(run_id, department_statistics)
+
+    # --- Ghost User Detection (on de-duplicated data) ---
+    ghost_users = set()
+    try:
+        all_users_in_db_df = db_manager.get_all_users()
+        known_users = set(all_users_in_db_df['username'].str.lower()) if not all_users_in_db_df.empty else set()
+        ghost_users = uploaded_users - known_users
+        if ghost_users:
+            ghost_users_str = ", ".join(sorted(list(ghost_users)))
+            super_users = db_manager.get_users_by_role('Super User')
+            if super_users:
+                message = f"In file '{filename}', these usernames were found but do not exist: **{ghost_users_str}**. Please add them if they are valid users."
+                for su in super_users:
+                    db_manager.create_notification(username=su, notif_type='Ghost User Detected', message=message)
+    except Exception as e_ghost:
+        logging.error(f"Error during ghost user detection: {e_ghost}", exc_info=True)
+
+    # --- Create and Save Excel Report ---
+    if report_spool is not None:
+        excel_report_data = report_spool.write_excel(department_statistics, filename)
+    else:
+        excel_report_data = create_excel_report(exceptions_df, department_statistics, filename)
+    if excel_report_data:
+        db_manager.save_excel_report(run_id, excel_report_data)
+        excel_report_data.seek(0)
+    return ghost_users, excel_report_data
+
+
+def _uploaded_users(df):
+    return set(df['Created user'].dropna().astype(str).str.lower()) if 'Created user' in df.columns else set()
+
+
+def run_validation_pipeline(df_to_process, filename, file_size, upload_time=None, return_final_df=True):
+    """
+    Headless validation pipeline shared by the upload page and the batch CLI.
+
+    Validates the rows, drops clean rows already seen in previous runs, and persists the
+    run, exceptions, user performance, department summary, suspicious-rule hits, Excel
+    report and transaction fingerprints. Contains no Streamlit UI calls; the caller is
+    responsible for presenting the returned result dict. The de-duplicated rows are only
+    materialized as `final_df` when return_final_df is True (the upload page displays them).
+    """
+    missing_core_cols = [col for col in REQUIRED_PROCESSING_COLUMNS if col not in df_to_process.columns]
+    if missing_core_cols:
+        raise ValueError(f'Missing essential columns for processing: {", ".join(missing_core_cols)}. Cannot proceed.')
+
+    ctx = _build_pipeline_context()
+    keep_mask, fingerprints, all_exceptions_df, exception_count, new_clean_count, ignored_clean_count = _validate_and_deduplicate(ctx, df_to_process)
+    processed_count = int(keep_mask.sum())
+
+    current_run_id = db_manager.save_validation_run(
+        filename=filename,
+        total_records=processed_count,
+        total_exceptions=exception_count,
+        file_size=file_size,
+        upload_time=upload_time
+    )
+
+    processing_log = []
+    flagged_count, user_stats, department_statistics, uploaded_users = _persist_processed_rows(
+        ctx, current_run_id, df_to_process, keep_mask, fingerprints, all_exceptions_df, processing_log
+    )
+    ghost_users, excel_report_data = _finalize_run(current_run_id, filename, user_stats, department_statistics, uploaded_users, all_exceptions_df)
+
+    return {
+        'run_id': current_run_id,
+        'final_df': df_to_process[keep_mask] if return_final_df else None,
+        'exceptions_df': all_exceptions_df,
+        'department_statistics': department_statistics,
+        'processed_count': processed_count,
+        'exception_count': exception_count,
+        'new_clean_count': new_clean_count,
+        'ignored_clean_count': ignored_clean_count,
+        'flagged_count': flagged_count,
+        'processing_log': processing_log,
+        'ghost_users': ghost_users,
+        'excel_report': excel_report_data,
+    }
+
+
+def run_streaming_validation_pipeline(chunks, filename, file_size, upload_time=None):
+    """
+    Streaming variant of run_validation_pipeline for exports larger than memory.
+
+    `chunks` is an iterable of DataFrames (see iter_ledger_chunks). Each chunk is validated,
+    de-duplicated and persisted on its own; only per-user/per-department counts and the set
+    of uploaded users are kept in memory. Exception rows are spooled to a temporary file and
+    streamed into the Excel report at the end.
+    The run is created with the first non-empty chunk and its totals are filled in once the
+    last chunk is done. Returns None, without creating a run, when the chunks hold no rows.
+    Otherwise the result dict has the same keys as run_validation_pipeline, with `final_df`
+    and `exceptions_df` set to None (the exceptions are in the saved run and its report).
+    """
+    ctx = _build_pipeline_context()
+    current_run_id = None
+
+    totals = {'processed_count': 0, 'exception_count': 0, 'new_clean_count': 0, 'ignored_clean_count': 0, 'flagged_count': 0}
+    user_stats, department_statistics, uploaded_users = None, {}, set()
+    report_spool = ExceptionReportSpool()
+    try:
+        for chunk_number, df_chunk in enumerate(chunks, 1):
+            missing_core_cols = [col for col in REQUIRED_PROCESSING_COLUMNS if col not in df_chunk.columns]
+            if missing_core_cols:
+                raise ValueError(f'Missing essential columns for processing: {", ".join(missing_core_cols)}. Cannot proceed.')
+            if df_chunk.empty:
+                continue
+            if current_run_id is None:
+                current_run_id = db_manager.save_validation_run(filename=filename, total_records=0, total_exceptions=0, file_size=file_size, upload_time=upload_time)
+
+            keep_mask, fingerprints, chunk_exceptions_df, exception_count, new_clean_count, ignored_clean_count = _validate_and_deduplicate(ctx, df_chunk)
+            flagged_count, chunk_user_stats, chunk_department_stats, chunk_users = _persist_processed_rows(
+                ctx, current_run_id, df_chunk, keep_mask, fingerprints, chunk_exceptions_df
+            )
+
+            totals['processed_count'] += int(keep_mask.sum())
+            totals['exception_count'] += exception_count
+            totals['new_clean_count'] += new_clean_count
+            totals['ignored_clean_count'] += ignored_clean_count
+            totals['flagged_count'] += flagged_count
+            if chunk_user_stats is not None:
+                user_stats = merge_user_stats(user_stats, chunk_user_stats)
+            merge_department_stats(department_statistics, chunk_department_stats)
+            uploaded_users |= chunk_users
+            report_spool.append(chunk_exceptions_df)
+            logging.info(f"{filename}: chunk {chunk_number} done ({totals['processed_count']:,} rows processed so far).")
+
+        if current_run_id is None:
+            logging.info(f"{filename}: no rows to validate; no run created.")
+            return None
+        db_manager.update_validation_run_totals(current_run_id, totals['processed_count'], totals['exception_count'])
+        ghost_users, excel_report_data = _finalize_run(current_run_id, filename, user_stats, department_statistics, uploaded_users, None, report_spool=report_spool)
+    except Exception:
+        # Keep the partial run visible with the counts that were actually saved.
+        if current_run_id is not None:
+            db_manager.update_validation_run_totals(current_run_id, totals['processed_count'], totals['exception_count'])
+        raise
+    finally:
+        report_spool.close()
+
+    return {
+        'run_id': current_run_id,
+        'final_df': None,
+        'exceptions_df': None,
+        'department_statistics': department_statistics,
+        **totals,
+        'processing_log': [],
+        'ghost_users': ghost_users,
+        'excel_report': excel_report_data,
+    }
 
-    selection = st.session_state[selection_key]
-    if selection and selection.get("rows"):
-        try:
-            selected_index = selection["rows"][0]
-            selected_record = df.iloc[selected_index]
-            exception_id = selected_record.get('id', 'N/A')
-
-            with st.expander(f"**👁️ Viewing Original Data for Exception ID: {exception_id}**", expanded=True):
-                # In MySQL version, this can be a dict or a string
-                original_data_raw = selected_record.get('original_row_data')
-                if pd.notna(original_data_raw):
-                    try:
-                        original_data = original_data_raw if isinstance(original_data_raw, dict) else json.loads(original_data_raw)
-                        original_df = pd.DataFrame([original_data]).dropna(axis=1, how='all')
-                        st.markdown("#### Original Record Details")
-                        st.dataframe(original_df.T.rename(columns={0: 'Value'}), use_container_width=True)
-                    except (json.JSONDecodeError, TypeError):
-                        st.error("Could not parse the original row data. It might be corrupted.")
-                        st.text(original_data_raw)
-                else:
-                    st.warning("Original row data is not available for this exception record.")
-        except IndexError:
-            st.warning("Could not retrieve the selected row. Please try again.")
-        finally:
-            st.session_state[selection_key] = None
 
 def process_uploaded_file(uploaded_file, selected_date=None):
     try:
@@ -3004,10 +5582,9 @@ def process_uploaded_file(uploaded_file, selected_date=None):
         df_original = pd.DataFrame()
         with st.spinner(f"📖 Reading file: {uploaded_file.name}..."):
             try:
-                df_original = pd.read_excel(uploaded_file, engine='openpyxl', skiprows=5, skipfooter=1)
-                df_original.columns = df_original.columns.str.strip()
+                df_original = read_ledger_file(uploaded_file)
             except Exception as e:
-                st.markdown(f'<div class="error-box"><strong>❌ Error!</strong> Could not read Excel file "{uploaded_file.name}". Details: {str(e)}</div>', unsafe_allow_html=True)
+                st.markdown(f'<div class="error-box"><strong>❌ Error!</strong> Could not read file "{uploaded_file.name}". Details: {str(e)}</div>', unsafe_allow_html=True)
                 return
 
         if df_original.empty:
@@ -3019,19 +5596,7 @@ def process_uploaded_file(uploaded_file, selected_date=None):
             return
 
         # --- Role-Based Filtering (from your code) ---
-        df_to_process = pd.DataFrame()
-        df_original['Created user'] = df_original['Created user'].astype(str)
-
-        if user_role == 'User':
-            df_to_process = df_original[df_original['Created user'].str.lower() == username.lower()].copy()
-            filter_message = f"As a **User**, this file has been automatically filtered to process records created by you."
-        elif user_role == 'Manager':
-            accessible_users = [username.lower()] + [u.lower() for u in st.session_state.get("managed_users", [])]
-            df_to_process = df_original[df_original['Created user'].str.lower().isin(accessible_users)].copy()
-            filter_message = f"As a **Manager**, this file has been filtered for you and your team."
-        else: # Management and Super User
-            df_to_process = df_original.copy()
-            filter_message = "As **Management/Super User**, all records in the file will be processed."
+        df_to_process, filter_message = filter_records_for_user(df_original, user_role, username, managed_users)
         
         st.info(f"""
         {filter_message}\n
@@ -3043,183 +5608,40 @@ def process_uploaded_file(uploaded_file, selected_date=None):
             st.warning("No records in the uploaded file match your user profile or team. Nothing to process.")
             return
 
-        # --- Check for essential columns (from your code) ---
-        required_columns_for_processing = ['Department.Name', 'Account2.Code', 'Sub Ledger.Code']
-        missing_core_cols = [col for col in required_columns_for_processing if col not in df_to_process.columns]
-        if missing_core_cols:
-            st.error(f'Error! Missing essential columns for processing: {", ".join(missing_core_cols)}. Cannot proceed.')
-            return
-        
-        # --- NEW DUPLICATE CHECK LOGIC ---
-        with st.spinner("🔍 Checking for duplicate transactions from previous runs..."):
-            historical_fingerprints = db_manager.get_historical_fingerprints()
-            
-            # NEW: Fetch accepted exception fingerprints here
-            accepted_exception_fingerprints_from_db = db_manager.get_accepted_exception_fingerprints()
-            
-            # MODIFIED: Pass accepted_exception_fingerprints_from_db instead of db_manager
-            validator = DataValidator(base_ref_path="reference_data", accepted_exception_fingerprints_set=accepted_exception_fingerprints_from_db)
-            
-            # 1. Run validation on ALL incoming data first
-            all_exceptions_df, _ = validator.validate_dataframe(df_to_process.copy())
-            
-            # 2. Separate the incoming data into two groups
-            exception_indices = all_exceptions_df.index
-            exceptions_to_process = df_to_process.loc[exception_indices].copy()
-            clean_df_from_upload = df_to_process.drop(index=exception_indices).copy()
-
-            # 3. Filter the CLEAN rows to remove historical duplicates
-            new_clean_rows = []
-            ignored_clean_count = 0
-            for index, row in clean_df_from_upload.iterrows():
-                # ... inside the loop `for index, row in clean_df_from_upload.iterrows():` ...
-                doc_no = str(row.get("Document No.", "")).strip().lower()
-                location = str(row.get("Location.Name", "")).strip().lower()
-                activity = str(row.get("Activity.Name", "")).strip().lower()
-                crop = str(row.get("Crop.Name", "")).strip().lower()
-                
-                # --- NORMALIZED FINGERPRINT ---
-                try:
-                    net_amount_val = float(row.get("Net amount", 0.0))
-                    net_amount = f"{net_amount_val:.2f}"
-                except (ValueError, TypeError):
-                    net_amount = "0.00"
-                
-                fingerprint = f"{doc_no}|{location}|{activity}|{crop}|{net_amount}"
-
-                if fingerprint in historical_fingerprints:
-                    ignored_clean_count += 1
-                else:
-                    new_clean_rows.append(row)
-            
-            if new_clean_rows:
-                final_clean_df = pd.DataFrame(new_clean_rows, columns=clean_df_from_upload.columns)
-            else:
-                final_clean_df = pd.DataFrame(columns=clean_df_from_upload.columns)
+        with st.spinner("🔍 Validating, de-duplicating and saving transactions..."):
+            try:
+                result = run_validation_pipeline(df_to_process, uploaded_file.name, uploaded_file.size, upload_time=selected_date)
+            except ValueError as e_cols:
+                st.error(f'Error! {e_cols}')
+                return
 
-            # 4. Re-assemble the final dataframe for processing
-            final_df_to_process = pd.concat([exceptions_to_process, final_clean_df], ignore_index=True)
-        
-        st.success(f"Duplicate check complete. Ignored **{ignored_clean_count}** clean rows that were duplicates of past transactions.")
-        st.info(f"Processing **{len(final_df_to_process)}** unique transactions (**{len(exceptions_to_process)}** with exceptions, **{len(final_clean_df)}** new clean rows).")
-        # --- END OF NEW DUPLICATE CHECK LOGIC ---
-
-        # --- Save the main validation run ---
-        current_run_id = db_manager.save_validation_run(
-            filename=uploaded_file.name,
-            total_records=len(final_df_to_process),
-            total_exceptions=len(exceptions_to_process),
-            file_size=uploaded_file.size,
-            upload_time=selected_date
-        )
+        final_df_to_process = result['final_df']
+        exceptions_df_from_validation = result['exceptions_df']
+        excel_report_data = result['excel_report']
 
-        # --- Suspicious Transaction Check (from your code, now runs on de-duplicated data) ---
-        processing_log = [] 
-        with st.spinner(f"🕵️‍♀️ Checking for suspicious transactions..."):
-            immunity_list = db_manager.load_suspense_immunity_list()
-            suspicious_rules_df = db_manager.get_all_suspicious_rules()
-            flagged_count = 0
-
-            if not suspicious_rules_df.empty:
-                rules_dict = {}
-                for _, rule in suspicious_rules_df.iterrows():
-                    if rule['rule_values']:
-                        key = (rule['sub_department_name'], rule['rule_column'])
-                        rules_dict[key] = [str(v).lower() for v in rule['rule_values']]
-
-                for index, row in final_df_to_process.iterrows(): # MODIFIED: Runs on de-duplicated data
-                    user = row.get('Created user', 'Unknown User')
-                    
-                                        # ... inside the loop `for index, row in final_df_to_process.iterrows():` ...
-                    doc_no_s = str(row.get("Document No.", "")).strip().lower()
-                    location_s = str(row.get("Location.Name", "")).strip().lower()
-                    activity_s = str(row.get("Activity.Name", "")).strip().lower()
-                    crop_s = str(row.get("Crop.Name", "")).strip().lower()
-                    
-                    # --- NORMALIZED FINGERPRINT ---
-                    try:
-                        net_amount_val_s = float(row.get("Net amount", 0.0))
-                        net_amount_s = f"{net_amount_val_s:.2f}"
-                    except (ValueError, TypeError):
-                        net_amount_s = "0.00"
-                    
-                    fingerprint_s = f"{doc_no_s}|{location_s}|{activity_s}|{crop_s}|{net_amount_s}"
-                    if fingerprint_s in historical_fingerprints:
-                        continue
-                        
-                    account_code = str(row.get("Account2.Code", "")).strip()
-                    sub_ledger_code = str(row.get("Sub Ledger.Code", "")).strip()
-                    if f"{account_code}_{sub_ledger_code}" in immunity_list:
-                        continue
+        st.success(f"Duplicate check complete. Ignored **{result['ignored_clean_count']}** clean rows that were duplicates of past transactions.")
+        st.info(f"Processing **{len(final_df_to_process)}** unique transactions (**{result['exception_count']}** with exceptions, **{result['new_clean_count']}** new clean rows).")
 
-                    sub_dept = str(row.get('Sub Department.Name', '')).strip()
-                    if not sub_dept: continue
-                    
-                    for (rule_sub_dept, rule_col), rule_vals_lower in rules_dict.items():
-                        if sub_dept == rule_sub_dept:
-                            row_val_lower = str(row.get(rule_col, '')).strip().lower()
-                            log_entry = f"Row for **{user}**: Checking Sub-Dept `'{sub_dept}'`. Comparing value `'{row_val_lower}'` in column `'{rule_col}'` against rule `'{rule_vals_lower}'`."
-                            
-                            if row_val_lower in rule_vals_lower:
-                                db_manager.log_suspicious_transaction(current_run_id, row.to_dict(), user)
-                                flagged_count += 1
-                                processing_log.append(log_entry + " -> **MATCH FOUND**")
-                                break
-                            else:
-                                processing_log.append(log_entry + " -> No Match")
-        
-        if flagged_count > 0:
-            st.success(f"✅ Flagged **{flagged_count}** new suspicious transaction(s) for manual admin review.")
+        if result['flagged_count'] > 0:
+            st.success(f"✅ Flagged **{result['flagged_count']}** new suspicious transaction(s) for manual admin review.")
         else:
             st.info("ℹ️ No transactions matched the custom suspicious rules.")
             
         with st.expander("🔍 View Suspicious Rule Check Log"):
-            if not processing_log:
+            if not result['processing_log']:
                 st.write("No applicable rules were found for the sub-departments in this file.")
             else:
-                for entry in processing_log:
+                for entry in result['processing_log']:
                     st.markdown(entry, unsafe_allow_html=True)
         
-        # --- Existing DataValidator Logic ---
         summary_tab, exceptions_tab, data_tab = st.tabs(["📊 Validation Summary", "📋 Exception Records", "📖 Processed Data"])
-        
-        exceptions_df_from_validation = all_exceptions_df
-        # Re-calculate department statistics on the final de-duplicated dataframe
-        _, department_statistics = validator.validate_dataframe(final_df_to_process)
-
-        if not exceptions_df_from_validation.empty:
-            db_manager.save_exceptions(current_run_id, exceptions_df_from_validation)
-        
-        db_manager.save_user_performance(current_run_id, final_df_to_process, exceptions_df_from_validation)
-        if department_statistics:
-            db_manager.save_department_summary(current_run_id, department_statistics)
-
-        # --- Ghost User Detection (from your code, on de-duplicated data) ---
-        try:
-            all_users_in_db_df = db_manager.get_all_users()
-            known_users = set(all_users_in_db_df['username'].str.lower()) if not all_users_in_db_df.empty else set()
-            uploaded_users = set(final_df_to_process['Created user'].dropna().astype(str).str.lower())
-            ghost_users = uploaded_users - known_users
-            if ghost_users:
-                ghost_users_str = ", ".join(sorted(list(ghost_users)))
-                with summary_tab:
-                     st.warning(f"👻 **Ghost Users Found:** The following users from the file do not exist in the system: `{ghost_users_str}`.")
-                super_users = db_manager.get_users_by_role('Super User')
-                if super_users:
-                    message = f"In file '{uploaded_file.name}', these usernames were found but do not exist: **{ghost_users_str}**. Please add them if they are valid users."
-                    for su in super_users:
-                        db_manager.create_notification(username=su, notif_type='Ghost User Detected', message=message)
-        except Exception as e_ghost:
-            logging.error(f"Error during ghost user detection: {e_ghost}", exc_info=True)
-
-        # --- Create and Save Excel Report (from your code) ---
-        excel_report_data = create_excel_report(exceptions_df_from_validation, department_statistics, uploaded_file.name)
-        if excel_report_data:
-            db_manager.save_excel_report(current_run_id, excel_report_data)
-            excel_report_data.seek(0)
 
         # --- Display Results in UI (from your code, using new counts) ---
         with summary_tab:
+            if result['ghost_users']:
+                ghost_users_str = ", ".join(sorted(list(result['ghost_users'])))
+                st.warning(f"👻 **Ghost Users Found:** The following users from the file do not exist in the system: `{ghost_users_str}`.")
+
             st.markdown("#### 📊 File Information (Post-Deduplication)")
             col_info1, col_info2, col_info3 = st.columns(3)
             display_metric("Unique Records Processed", f"{len(final_df_to_process):,}", container=col_info1)
@@ -3257,23 +5679,9 @@ def process_uploaded_file(uploaded_file, selected_date=None):
             st.dataframe(final_df_to_process, use_container_width=True)
 
         if not final_df_to_process.empty:
-            with st.spinner("Saving transaction history for future duplicate checks..."):
-                processed_fingerprints = set()
-                for _, row in final_df_to_process.iterrows():
-                    try:
-                        doc_no = str(row.get("Document No.", "")).strip().lower()
-                        location = str(row.get("Location.Name", "")).strip().lower()
-                        activity = str(row.get("Activity.Name", "")).strip().lower()
-                        crop = str(row.get("Crop.Name", "")).strip().lower()
-                        net_amount_val = float(row.get("Net amount", 0.0))
-                        net_amount = f"{net_amount_val:.2f}"
-                        fingerprint = f"{doc_no}|{location}|{activity}|{crop}|{net_amount}"
-                        processed_fingerprints.add(fingerprint)
-                    except (ValueError, TypeError):
-                        continue
-                db_manager.save_transaction_fingerprints(current_run_id, list(processed_fingerprints))
-                st.success("Transaction history saved.")
-                check_and_trigger_notifications()
+            st.success("Transaction history saved.")
+            # The unresolved-entry check runs in the background; uploads landing together share one check.
+            get_notification_scheduler().request_run()
 
     except Exception as e_process:
         st.error(f'An unhandled error occurred while processing "{uploaded_file.name}": {str(e_process)}')
@@ -3292,11 +5700,11 @@ def show_upload_page():
 
     # The rest of the page is only visible if the user has upload permission
     with st.container(border=True):
-        st.write("📤 **Drag & Drop Your Excel Files Here**")
+        st.write("📤 **Drag & Drop Your Ledger Files Here (Excel, CSV or Parquet)**")
         st.caption("or click 'Browse files' to select them from your computer")
         uploaded_files_list = st.file_uploader(
             "File Uploader",
-            type=['xlsx', 'xls'],
+            type=['xlsx', 'xls', 'csv', 'parquet'],
             accept_multiple_files=True,
             label_visibility="collapsed"
         )
@@ -3360,7 +5768,7 @@ def show_upload_page():
                         db_manager.save_user_performance(valid_manual_entry_run_id, pd.DataFrame([manual_row_data]), empty_exceptions_for_valid_manual)
                         st.success(f"Manual record validated successfully and run logged (Run ID: {valid_manual_entry_run_id}).")
 
-def show_exception_details_page(start_date, end_date):
+def show_exception_details_page(start_date, end_date, history_df):
     """
     Displays a detailed, filterable view of all exceptions within the user's scope
     and the selected date range.
@@ -3371,10 +5779,8 @@ def show_exception_details_page(start_date, end_date):
     # 1. Get user context from session state
     user_role = st.session_state.get("role")
     username = st.session_state.get("username_actual")
-    managed_users = st.session_state.get("managed_users", [])
 
-    # 2. Get all accessible validation runs within the filtered date range
-    history_df = db_manager.get_validation_history(user_role, username, managed_users)
+    # 2. Narrow the accessible validation runs to the filtered date range
     if start_date and end_date:
         history_df = history_df[(history_df['upload_time'].dt.date >= start_date) & (history_df['upload_time'].dt.date <= end_date)]
 
@@ -3382,26 +5788,9 @@ def show_exception_details_page(start_date, end_date):
         st.warning("No validation runs found for your account in the selected date range.")
         return
 
-    # 3. Load all exception data for the accessible runs
+    # 3. Load the exception data of the accessible runs; the user/team scope is applied in SQL
     with st.spinner("Loading exception data..."):
-        run_ids_to_load = history_df['id'].tolist()
-        all_exceptions_list = [db_manager.get_exceptions_by_run(run_id) for run_id in run_ids_to_load]
-        # Concatenate all dataframes, ignoring any that might be empty
-        unfiltered_df = pd.concat([df for df in all_exceptions_list if not df.empty], ignore_index=True)
-
-    if unfiltered_df.empty:
-        st.success("No exception records were found in the selected date range.")
-        return
-
-    # 4. Apply hierarchical security filtering to the master dataframe
-    scoped_df = pd.DataFrame()
-    if user_role == 'User':
-        scoped_df = unfiltered_df[unfiltered_df['Created user'].str.lower() == username.lower()]
-    elif user_role == 'Manager':
-        team_to_filter = [username.lower()] + [u.lower() for u in managed_users]
-        scoped_df = unfiltered_df[unfiltered_df['Created user'].str.lower().isin(team_to_filter)]
-    else: # Management and Super User see all data
-        scoped_df = unfiltered_df.copy()
+        scoped_df = db_manager.get_exceptions_for_runs(history_df['id'].tolist(), user_role, username)
 
     if scoped_df.empty:
         st.warning("No exception records fall within your specific access scope for this period.")
@@ -3439,10 +5828,9 @@ def show_exception_details_page(start_date, end_date):
         # Reuse the existing helper function to display the interactive table
         display_interactive_exceptions(final_df, key_prefix="details_page")
 
-def show_analytics_page(start_date, end_date):
+def show_analytics_page(start_date, end_date, validation_history):
     st.markdown("### 📊 Dashboard Analytics")
     
-    validation_history = db_manager.get_validation_history()
     if start_date and end_date:
         validation_history = validation_history[(validation_history['upload_time'].dt.date >= start_date) & (validation_history['upload_time'].dt.date <= end_date)]
 
@@ -3498,9 +5886,8 @@ def show_analytics_page(start_date, end_date):
             st.dataframe(agg_dept_summary.style.format({"exception_rate": "{:.2f}%", "total_records":"{:,}","exception_records":"{:,}"}), use_container_width=True, hide_index=True)
 
 
-def show_trends_page(start_date, end_date):
+def show_trends_page(start_date, end_date, trends_history_df):
     st.markdown("### 📈 Trends & History")
-    trends_history_df = db_manager.get_validation_history()
 
     if start_date and end_date:
         trends_history_df = trends_history_df[
@@ -3556,16 +5943,14 @@ def show_trends_page(start_date, end_date):
     st.dataframe(display_history_log_df.sort_values(by='Upload Time', ascending=False), use_container_width=True, hide_index=True)
 
 
-def show_user_location_page(start_date, end_date):
+def show_user_location_page(start_date, end_date, history_df):
     st.markdown("### 👤📍 User & Location Analysis")
 
     # --- 1. Get User Context & Initial Data ---
     user_role = st.session_state.get("role")
     username = st.session_state.get("username_actual")
-    managed_users = st.session_state.get("managed_users", [])
     
-    # This call is already correctly scoped based on previous updates
-    history_df = db_manager.get_validation_history(user_role, username, managed_users)
+    # history_df is already scoped to the runs this user may see
     if start_date and end_date:
         history_df = history_df[(history_df['upload_time'].dt.date >= start_date) & (history_df['upload_time'].dt.date <= end_date)]
 
@@ -3583,28 +5968,12 @@ def show_user_location_page(start_date, end_date):
 
     with st.spinner(f"Loading data for '{selected_run_display}'..."):
         run_ids_to_load = history_df['id'].tolist() if selected_run_id == "all" else [selected_run_id]
-        all_exceptions = [db_manager.get_exceptions_by_run(run_id) for run_id in run_ids_to_load]
-        ul_exceptions_df_master = pd.concat([df for df in all_exceptions if not df.empty], ignore_index=True)
-
-    if ul_exceptions_df_master.empty:
-        st.success(f"No exceptions found for the selected scope. Nothing to analyze.")
-        return
-
-    # --- NEW: HIERARCHICAL DATA SCOPING BLOCK ---
-    # This block ensures the data is filtered *before* being used in the dashboard.
-    scoped_exceptions_df = pd.DataFrame()
-    if user_role == 'User':
-        scoped_exceptions_df = ul_exceptions_df_master[ul_exceptions_df_master['Created user'].str.lower() == username.lower()].copy()
-    elif user_role == 'Manager':
-        team_to_filter = [u.lower() for u in managed_users] + [username.lower()]
-        scoped_exceptions_df = ul_exceptions_df_master[ul_exceptions_df_master['Created user'].str.lower().isin(team_to_filter)].copy()
-    else: # Management and Super User see all data within the selected runs
-        scoped_exceptions_df = ul_exceptions_df_master.copy()
+        # Scoped in SQL to the user, or the manager's reporting tree.
+        scoped_exceptions_df = db_manager.get_exceptions_for_runs(run_ids_to_load, user_role, username)
 
     if scoped_exceptions_df.empty:
         st.warning("No exception data found for your specific access scope (user or team).")
         return
-    # --- END OF NEW BLOCK ---
 
     st.markdown("#### Filters")
     # The user list for the filter is now created from the *scoped* data.
@@ -3656,7 +6025,10 @@ def show_user_location_page(start_date, end_date):
     ul_error_types_df = pd.DataFrame(columns=['Error Type', 'Count'])
     if 'Exception Reasons' in ul_exceptions_df.columns and ul_exceptions_df['Exception Reasons'].notna().any():
         st.markdown("##### 📊 Top 10 Common Error Types for this Scope")
-        ul_error_types_df = ul_exceptions_df['Exception Reasons'].str.split('; ', expand=True).stack().str.strip().value_counts().reset_index()
+        ul_error_types_df = db_manager.get_exception_reason_counts(
+            run_ids_to_load, users=None if selected_user == "All Users" else [selected_user],
+            user_role=user_role, username=username, include_accepted=False
+        )
         ul_error_types_df.columns = ['Error Type', 'Count']
         st.dataframe(ul_error_types_df.head(10), use_container_width=True, hide_index=True)
         
@@ -3780,7 +6152,7 @@ def show_clarification_center_page():
                             st.success(f"Waiver for {waiver['username']} has been revoked.")
                             st.rerun()
 
-def show_user_performance_page(start_date, end_date):
+def show_user_performance_page(start_date, end_date, history_df, all_users_df):
     st.markdown("### 👤📊 User Performance Dashboard")
 
     # --- 1. Get User Context & Initial Data ---
@@ -3788,10 +6160,8 @@ def show_user_performance_page(start_date, end_date):
     username = st.session_state.get("username_actual")
     managed_users = st.session_state.get("managed_users", [])
     
-    all_users_df = db_manager.get_all_users()
     full_name_map = pd.Series(all_users_df.full_name.values,index=all_users_df.username).to_dict() if not all_users_df.empty else {}
 
-    history_df = db_manager.get_validation_history(user_role, username, managed_users)
     if start_date and end_date:
         history_df = history_df[(pd.to_datetime(history_df['upload_time']).dt.date >= start_date) & 
                                 (pd.to_datetime(history_df['upload_time']).dt.date <= end_date)]
@@ -3864,7 +6234,7 @@ def show_user_performance_page(start_date, end_date):
             
             if selected_manager_display:
                 selected_manager_username = manager_options_map[selected_manager_display]
-                manager_team_users = db_manager.get_managed_users(selected_manager_username)
+                manager_team_users = db_manager.get_team_members(selected_manager_username)
                 team_list = manager_team_users + [selected_manager_username]
                 team_with_exceptions = get_filtered_users_with_exceptions(run_ids_in_scope, team_list)
                 
@@ -3925,6 +6295,90 @@ def get_filtered_users_with_exceptions(run_ids, user_list=None):
     finally:
         if conn and conn.is_connected(): conn.close()
 
+# --- Chart images for emails ---
+# Plotly's to_image starts a fresh headless browser (Kaleido) for every call, which takes
+# seconds per chart. Images are rendered by one long-lived Kaleido browser instead and cached
+# on disk by figure content, so the same chart is only ever rendered once.
+CHART_CACHE_DIR = os.path.join(".compiled", "charts")
+CHART_CACHE_MAX_FILES = 2000
+CHART_IMAGE_SCALE = 2
+CHART_RENDER_TABS = 4  # figures rendered in parallel by render_many
+
+
+def chart_cache_key(fig, scale=CHART_IMAGE_SCALE):
+    return hashlib.sha256(f"{fig.to_json()}|png|{scale}".encode('utf-8')).hexdigest()[:32]
+
+
+class ChartRenderer:
+    """
+    Renders Plotly figures to PNG through a persistent Kaleido browser (kaleido >= 1.1, with
+    CHART_RENDER_TABS tabs) and caches the images in CHART_CACHE_DIR by chart_cache_key. With
+    an older Kaleido every batch still starts its own browser, but cached charts skip it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._server_started = False
+
+    def _ensure_server(self):
+        if self._server_started:
+            return
+        if importlib.util.find_spec('kaleido') is None:
+            raise RuntimeError("Chart images need the 'kaleido' package (pip install \"kaleido>=1.1\").")
+        import kaleido
+        if hasattr(kaleido, 'start_sync_server'):
+            kaleido.start_sync_server(n=CHART_RENDER_TABS, silence_warnings=True)
+            atexit.register(kaleido.stop_sync_server, silence_warnings=True)
+        self._server_started = True
+
+    def render(self, fig, scale=CHART_IMAGE_SCALE):
+        return self.render_many([fig], scale)[0]
+
+    def render_many(self, figs, scale=CHART_IMAGE_SCALE):
+        """PNG bytes for each figure, in order. Uncached figures are rendered in one batch."""
+        keys = [chart_cache_key(fig, scale) for fig in figs]
+        paths = [os.path.join(CHART_CACHE_DIR, f"{key}.png") for key in keys]
+        missing = {}
+        for path, fig in zip(paths, figs):
+            try:
+                os.utime(path)  # a hit counts as a use, so pruning drops the least recently used images
+            except FileNotFoundError:
+                missing[path] = fig
+        if missing:
+            os.makedirs(CHART_CACHE_DIR, exist_ok=True)
+            tmp_paths = [f"{path}.{os.getpid()}.{threading.get_ident()}.tmp" for path in missing]
+            with self._lock:
+                self._ensure_server()
+                started = time.perf_counter()
+                pio.write_images(list(missing.values()), tmp_paths, format="png", scale=scale)
+            for tmp_path, path in zip(tmp_paths, missing):
+                os.replace(tmp_path, path)  # atomic, so readers never see a half-written image
+            logging.info(f"Rendered {len(missing)} chart image(s) in {time.perf_counter() - started:.1f}s "
+                         f"({len(figs) - len(missing)} served from cache).")
+
+        images = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+        if missing:
+            _prune_cache_dir(CHART_CACHE_DIR, CHART_CACHE_MAX_FILES, '.png')  # only after this batch's images are read
+        return images
+
+
+@st.cache_resource
+def get_chart_renderer():
+    return ChartRenderer()
+
+
+def build_mistake_pie_chart(mistake_counts):
+    """Top-10 mistake pie for one user; mistake_counts has columns ('Mistake Type', 'Count')."""
+    fig = px.pie(mistake_counts.head(10), names='Mistake Type', values='Count',
+                 title="Top Mistake Types Distribution",
+                 color_discrete_sequence=px.colors.qualitative.Pastel)
+    fig.update_traces(textposition='inside', textinfo='percent+label')
+    return fig
+
+
 #
 # --- FULLY COMPLETED HELPER FUNCTIONS FOR USER PERFORMANCE PAGE ---
 #
@@ -3937,8 +6391,6 @@ def display_single_user_performance(user, run_ids, full_name_map):
         placeholders_sql = ','.join(['%s'] * len(run_ids))
         perf_query = f"SELECT up.*, vr.upload_time, vr.filename FROM `user_performance` up JOIN `validation_runs` vr ON up.run_id = vr.id WHERE up.`user` = %s AND up.run_id IN ({placeholders_sql}) ORDER BY vr.upload_time ASC"
         user_perf_df = pd.read_sql_query(perf_query, conn, params=params)
-        exc_query = f"SELECT vr.upload_time, e.exception_reason FROM `exceptions` e JOIN `validation_runs` vr ON e.run_id = vr.id WHERE e.created_user = %s AND e.run_id IN ({placeholders_sql})"
-        user_exc_df = pd.read_sql_query(exc_query, conn, params=params)
     except mysql.connector.Error as e:
         st.error(f"Error fetching performance details: {e}"); return
     finally:
@@ -3957,15 +6409,12 @@ def display_single_user_performance(user, run_ids, full_name_map):
     display_metric("Total Records by User", f"{int(total_recs_by_user):,}", container=kpi_col3)
     display_metric("Runs Involved", f"{runs_involved}", container=kpi_col4)
 
-    fig_mistakes, fig_trend, mistake_counts = None, None, pd.DataFrame()
-    if not user_exc_df.empty:
+    fig_mistakes, fig_trend = None, None
+    mistake_counts = db_manager.get_exception_reason_counts(run_ids, users=[user])
+    if not mistake_counts.empty:
         st.markdown("##### 🛠️ Common Mistake Analysis")
-        mistake_counts = user_exc_df['exception_reason'].str.split('; ', expand=True).stack().str.strip().value_counts().reset_index()
         mistake_counts.columns = ['Mistake Type', 'Count']
-        fig_mistakes = px.pie(mistake_counts.head(10), names='Mistake Type', values='Count', 
-                              title="Top Mistake Types Distribution",
-                              color_discrete_sequence=px.colors.qualitative.Pastel)
-        fig_mistakes.update_traces(textposition='inside', textinfo='percent+label')
+        fig_mistakes = build_mistake_pie_chart(mistake_counts)
         st.plotly_chart(fig_mistakes, use_container_width=True)
 
     if not user_perf_df.empty:
@@ -4014,8 +6463,7 @@ def display_single_user_performance(user, run_ids, full_name_map):
                     st.error("Cannot send email as one or more charts could not be generated.")
                 else:
                     with st.spinner("Preparing and sending email..."):
-                        mistakes_img_bytes = fig_mistakes.to_image(format="png", scale=2)
-                        trend_img_bytes = fig_trend.to_image(format="png", scale=2)
+                        mistakes_img_bytes, trend_img_bytes = get_chart_renderer().render_many([fig_mistakes, fig_trend])
                         images_to_embed = {"mistake_analysis_chart": mistakes_img_bytes, "exception_rate_trend": trend_img_bytes}
                         send_performance_email(to_recipients=to_recipients_list, subject=subject, html_body=email_body_html, cc_recipients=cc_recipients_list, images=images_to_embed)
 
@@ -4026,8 +6474,7 @@ def display_all_users_performance_summary(run_ids, user_list, full_name_map):
         placeholders = ','.join(['%s'] * len(run_ids))
         perf_query = f"SELECT * FROM user_performance WHERE run_id IN ({placeholders})"
         all_perf_df = pd.read_sql_query(perf_query, conn, params=tuple(run_ids))
-        exc_query = f"SELECT created_user, exception_reason FROM exceptions WHERE run_id IN ({placeholders})"
-        all_exc_df = pd.read_sql_query(exc_query, conn, params=tuple(run_ids))
+        all_mistakes_df = db_manager.get_exception_reason_counts(run_ids, users=user_list)
         notif_df = db_manager.get_notification_counts(run_ids, user_list)
     except mysql.connector.Error as e:
         st.error(f"Database error fetching summary data: {e}"); return
@@ -4036,7 +6483,6 @@ def display_all_users_performance_summary(run_ids, user_list, full_name_map):
     
     if user_list is not None:
         all_perf_df = all_perf_df[all_perf_df['user'].isin(user_list)]
-        all_exc_df = all_exc_df[all_exc_df['created_user'].isin(user_list)]
     
     if all_perf_df.empty:
         st.info("No performance records to summarize for this scope."); return
@@ -4057,9 +6503,8 @@ def display_all_users_performance_summary(run_ids, user_list, full_name_map):
     st.dataframe(summary_by_user[['Full Name', 'user', 'total_records', 'exception_records', 'exception_rate']].sort_values('exception_rate', ascending=False), use_container_width=True, hide_index=True)
 
     fig_mistakes_summary = None
-    if not all_exc_df.empty:
+    if not all_mistakes_df.empty:
         st.markdown("##### 🛠️ Common Mistake Analysis")
-        all_mistakes_df = all_exc_df['exception_reason'].str.split('; ', expand=True).stack().str.strip().value_counts().reset_index()
         all_mistakes_df.columns = ['Mistake Type', 'Count']
         fig_mistakes_summary = px.bar(all_mistakes_df.head(15), x='Mistake Type', y='Count', title="Top 15 Mistake Types Across All Users in Scope", template="plotly_white")
         st.plotly_chart(fig_mistakes_summary, use_container_width=True)
@@ -4100,19 +6545,127 @@ def display_all_users_performance_summary(run_ids, user_list, full_name_map):
                     st.error("Cannot send email because the summary chart could not be generated.")
                 else:
                     with st.spinner("Preparing and sending email..."):
-                        mistakes_summary_bytes = fig_mistakes_summary.to_image(format="png", scale=2)
+                        mistakes_summary_bytes = get_chart_renderer().render(fig_mistakes_summary)
                         images_to_embed = {"mistake_summary_chart": mistakes_summary_bytes}
                         send_performance_email(to_recipients=to_recipients_list, subject=subject, html_body=email_body_html, cc_recipients=cc_recipients_list, images=images_to_embed)
 
+    if st.session_state.get("role") in ['Management', 'Super User']:
+        render_bulk_performance_email(run_ids, summary_by_user, full_name_map)
+
+
+def queue_performance_emails_for_users(run_ids, summary_by_user, full_name_map, requested_by):
+    """
+    Builds one personal performance email per user in summary_by_user and queues them as a
+    single job. Returns (job_id, number queued, users skipped for lack of an email address).
+    """
+    sender_email = st.secrets["email_credentials"]["sender_email"]
+    users_df = db_manager.get_all_users()
+    email_map = {row.username: row.email for row in users_df.itertuples() if row.email} if not users_df.empty else {}
+    mistakes_df = db_manager.get_exception_reason_counts(run_ids, users=summary_by_user['user'].tolist(), by_user=True)
+
+    recipients = {}
+    skipped = []
+    for row in summary_by_user.itertuples(index=False):
+        address = email_map.get(row.user) or (row.user if '@' in row.user else None)
+        if address:
+            recipients[row.user] = address
+        else:
+            skipped.append(row.user)
+
+    # Every user's mistake chart is rendered in one parallel batch (cached ones are reused).
+    mistake_tables = {
+        user: group[['reason', 'count']].rename(columns={'reason': 'Mistake Type', 'count': 'Count'})
+        for user, group in mistakes_df.groupby('user') if user in recipients
+    }
+    chart_users = list(mistake_tables)
+    chart_images = dict(zip(chart_users, get_chart_renderer().render_many(
+        [build_mistake_pie_chart(mistake_tables[user]) for user in chart_users]
+    ))) if chart_users else {}
+
+    job_id = f"performance-{int(time.time() * 1000)}"
+    emails = []
+    for row in summary_by_user.itertuples(index=False):
+        address = recipients.get(row.user)
+        if not address:
+            continue
+        user_mistakes = mistake_tables.get(row.user)
+        mistakes_html = (
+            user_mistakes.head(5).to_html(index=False, border=0) + '<img src="cid:mistake_analysis_chart" width="560">'
+            if user_mistakes is not None else "<p>No exceptions recorded.</p>"
+        )
+        html_body = f"""
+            <html style="font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;">
+            <body style="background-color: #f4f4f4; margin: 0; padding: 20px;">
+                <h2 style="color: #333333;">Performance Summary for {full_name_map.get(row.user, row.user)}</h2>
+                <p>Total Records: {int(row.total_records):,}</p>
+                <p>Total Exceptions: {int(row.exception_records):,}</p>
+                <p>Exception Rate: {row.exception_rate:.2f}%</p>
+                <h3 style="color: #333333;">Most Common Mistakes</h3>
+                {mistakes_html}
+            </body></html>"""
+        images = {"mistake_analysis_chart": chart_images[row.user]} if row.user in chart_images else None
+        message = build_performance_message(sender_email, [address], f"Your Performance Report ({len(run_ids)} run(s))", html_body, images=images)
+        emails.append(([address], message["Subject"], message.as_bytes()))
+
+    queued = db_manager.enqueue_emails(emails, created_by=requested_by, job_id=job_id)
+    if queued:
+        get_email_dispatcher().request_send()
+    return job_id, queued, skipped
+
+
+def render_bulk_performance_email(run_ids, summary_by_user, full_name_map):
+    with st.expander("📨 Email Every User Their Performance"):
+        st.caption(f"Queues a personal performance email for each of the {len(summary_by_user)} user(s) in this summary. "
+                   "Emails are sent in the background; users without an email address are skipped.")
+        if st.button("Queue Performance Emails", key="queue_bulk_performance_emails"):
+            try:
+                with st.spinner("Rendering charts and queueing emails..."):
+                    job_id, queued, skipped = queue_performance_emails_for_users(
+                        run_ids, summary_by_user, full_name_map, st.session_state.get("username_actual")
+                    )
+            except KeyError:
+                st.error("Email credentials are not configured in st.secrets. Please check your secrets.toml file.")
+                return
+            except Exception as e:
+                st.error(f"Failed to prepare the performance emails: {e}")
+                logging.error(f"Failed to prepare bulk performance emails: {e}", exc_info=True)
+                return
+            st.session_state.bulk_performance_email_job = job_id
+            st.success(f"Queued {queued} performance email(s).")
+            if skipped:
+                st.warning(f"No email address on file for {len(skipped)} user(s): {', '.join(sorted(skipped))}")
+
+        job_id = st.session_state.get("bulk_performance_email_job")
+        if job_id:
+            render_email_job_progress(job_id)
+
+
+def render_email_job_progress(job_id):
+    """Progress of a queued email job; refreshes itself while messages are still waiting."""
+    counts = db_manager.get_email_outbox_status(job_id)
+    waiting = counts.get('Pending', 0) + counts.get('Sending', 0)
+
+    @st.fragment(run_every=3 if waiting else None)
+    def _job_progress():
+        counts = db_manager.get_email_outbox_status(job_id)
+        total = sum(counts.values())
+        if not total:
+            return
+        done = counts.get('Sent', 0) + counts.get('Failed', 0)
+        st.progress(done / total, text=f"{counts.get('Sent', 0):,} of {total:,} emails sent")
+        if counts.get('Failed'):
+            st.warning(f"{counts['Failed']} email(s) could not be delivered; see Settings → Outbound Email.")
+
+    _job_progress()
+
 # We create new helper functions to avoid repeating code    
 
 
-def show_ledger_summary_page(start_date, end_date):
+def show_ledger_summary_page(start_date, end_date, history_df):
     st.markdown("### 🧾 Ledger & Sub-Ledger Exception Summary")
     account_names_df, subledger_names_df = load_account_name_mapping(), load_subledger_name_mapping()
     if account_names_df is None or subledger_names_df is None:
         st.error("Cannot display page: mapping files could not be loaded."); return
-    history_df = db_manager.get_validation_history()
     if start_date and end_date:
         history_df = history_df[(history_df['upload_time'].dt.date >= start_date) & (history_df['upload_time'].dt.date <= end_date)]
     if history_df.empty: st.info("No validation runs found for the selected period."); return
@@ -4178,13 +6731,12 @@ def show_ledger_summary_page(start_date, end_date):
     st.dataframe(summary_df, use_container_width=True, hide_index=True)
 
 
-def show_user_ledger_exceptions_page(start_date, end_date):
+def show_user_ledger_exceptions_page(start_date, end_date, history_df):
     st.markdown("### 👤🧾 User-wise Ledger Exception Details")
 
     # --- 1. Get User Context and load necessary data ---
     user_role = st.session_state.get("role")
     username = st.session_state.get("username_actual")
-    managed_users = st.session_state.get("managed_users", [])
 
     account_names_df = load_account_name_mapping()
     subledger_names_df = load_subledger_name_mapping()
@@ -4192,8 +6744,7 @@ def show_user_ledger_exceptions_page(start_date, end_date):
         st.error("Cannot display page: account or sub-ledger name mapping files could not be loaded.")
         return
 
-    # This correctly fetches only the runs the user is allowed to see
-    history_df = db_manager.get_validation_history(user_role, username, managed_users)
+    # history_df only holds the runs the user is allowed to see
     if start_date and end_date:
         history_df = history_df[(history_df['upload_time'].dt.date >= start_date) & (history_df['upload_time'].dt.date <= end_date)]
 
@@ -4213,31 +6764,18 @@ def show_user_ledger_exceptions_page(start_date, end_date):
     # --- 3. Load and Filter Master Data ---
     with st.spinner(f"Loading data for '{selected_run_display}'..."):
         run_ids_to_load = history_df['id'].tolist() if selected_run_id == "all" else [selected_run_id]
-        all_exceptions = [db_manager.get_exceptions_by_run(run_id) for run_id in run_ids_to_load]
-        exceptions_df = pd.concat([df for df in all_exceptions if not df.empty], ignore_index=True)
+        # Scoped in SQL to the user, or the manager's reporting tree.
+        exceptions_df = db_manager.get_exceptions_for_runs(run_ids_to_load, user_role, username)
 
     ledger_exception_reason = "Incorrect Ledger/Sub-Ledger Combination"
-    ledger_errors_df_master = exceptions_df[exceptions_df['Exception Reasons'].str.contains(ledger_exception_reason, na=False)].copy()
-
-    if ledger_errors_df_master.empty:
+    if exceptions_df.empty:
         st.success(f"No 'Incorrect Ledger/Sub-Ledger Combination' exceptions found for the selected scope.")
         return
-
-    # --- 4. NEW AND CRITICAL: HIERARCHICAL DATA SCOPING BLOCK ---
-    # This block filters the data *before* it's used to create the user selection filter.
-    ledger_errors_df = pd.DataFrame()
-    if user_role == 'User':
-        ledger_errors_df = ledger_errors_df_master[ledger_errors_df_master['Created user'].str.lower() == username.lower()].copy()
-    elif user_role == 'Manager':
-        team_to_filter = [u.lower() for u in managed_users] + [username.lower()]
-        ledger_errors_df = ledger_errors_df_master[ledger_errors_df_master['Created user'].str.lower().isin(team_to_filter)].copy()
-    else:  # Management and Super User see all ledger exceptions within the selected runs
-        ledger_errors_df = ledger_errors_df_master.copy()
+    ledger_errors_df = exceptions_df[exceptions_df['Exception Reasons'].str.contains(ledger_exception_reason, na=False)].copy()
 
     if ledger_errors_df.empty:
-        st.warning("No ledger/sub-ledger exceptions found for your specific access scope (user or team).")
+        st.success(f"No 'Incorrect Ledger/Sub-Ledger Combination' exceptions found for the selected scope.")
         return
-    # --- END OF CORRECTION ---
 
     st.markdown("---")
     st.markdown("#### Filters")
@@ -4304,12 +6842,11 @@ def show_user_ledger_exceptions_page(start_date, end_date):
     display_interactive_exceptions(merged_df, key_prefix="user_ledger_view")
 
 
-def show_location_expenses_page(start_date, end_date):
+def show_location_expenses_page(start_date, end_date, history_df):
     st.markdown("### 📍 Location Expenses")
     st.markdown("Analyze expenses aggregated by Ledger and Sub-Ledger across all locations. Select a single validation run or 'All Runs' for an aggregate view over the selected time period.")
 
     # 1. Select a Run or "All Runs"
-    history_df = db_manager.get_validation_history()
     if start_date and end_date:
         history_df = history_df[
             (history_df['upload_time'].dt.date >= start_date) & 
@@ -4466,23 +7003,15 @@ def show_location_expenses_page(start_date, end_date):
         st.error(f"Could not generate the pivot table. Error: {e}")
         logging.error(f"Error creating pivot table on location expense page: {e}", exc_info=True)
 
-def show_access_control_page():
+def show_access_control_page(all_users_df):
     st.markdown("### 🔑 Access Control Panel")
     st.caption("This page is only visible to the Super User.")
 
-    # This hardcoded list of all page names is used for the permission settings.
-    # IMPORTANT: This list must be maintained if you add/remove/rename pages in the main() function.
-    all_pages = [
-        "📊 Dashboard Analytics", "📈 Trends & History", "👤📊 User Performance",
-        "🗂️ Report Archive", "📝 Correction Status", "📋 Exception Details", 
-        "📍 Location Expenses", "🧾 Ledger/Sub-Ledger Summary", "👤🧾 User-wise Ledger Exceptions", 
-        "👤📍 User & Location Analysis", "🗑️ Data Management", "⚙️ Settings", "🛠️ User Management",
-        "🕵️ Suspicious Tag Control", "📋 Suspicious Transactions","📝 Correction Entries", "📈 Correction Analytics","✉️ Send Notification"
-    ]
+    # Pages that can be switched off per role or user, in navigation order.
+    all_pages = [page for page, spec in PAGE_REGISTRY.items() if spec['can_disable']]
     
     # Fetch all current permissions from the database once for efficiency
     permissions = db_manager.get_all_permissions()
-    all_users_df = db_manager.get_all_users()
 
     if not permissions or not permissions['roles']:
         st.error("Could not load permissions from the database. Please check the database connection and tables.")
@@ -4584,18 +7113,155 @@ def show_access_control_page():
                         st.error("Failed to update user overrides.")
 
 
-def show_report_archive_page():
+# --- Consolidated report cache ---
+# Consolidated archive reports are built on a background thread and written to disk, keyed
+# by the selected runs, the filter scope and the exceptions' data version, so downloading
+# or emailing the same report again, or any rerun of the page, reuses the file.
+REPORT_CACHE_DIR = os.path.join(".compiled", "reports")
+REPORT_CACHE_FORMAT = 1
+REPORT_CACHE_MAX_FILES = 200
+REPORT_BUILD_FAILURES_KEPT = 20
+REPORT_SCOPE_CACHE_TTL_SECONDS = 300
+
+
+@st.cache_data(ttl=REPORT_SCOPE_CACHE_TTL_SECONDS, max_entries=50, show_spinner=False)
+def load_report_scope(run_ids, user_role, username, data_version):
+    """Slim exception list of run_ids visible to the user; data_version only keys the cache."""
+    return db_manager.get_exceptions_for_runs(list(run_ids), user_role, username)
+
+
+def consolidated_report_key(run_ids, user_role, username, filter_selection, data_version, exception_ids):
+    key_data = {
+        'format': REPORT_CACHE_FORMAT,
+        'runs': sorted(int(run_id) for run_id in run_ids),
+        'scope': [user_role, username, filter_selection],
+        'data_version': data_version,
+        # The exact rows in the report, so a change in someone's team also yields a new report.
+        'rows': hashlib.sha256(np.sort(np.asarray(exception_ids, dtype=np.int64)).tobytes()).hexdigest(),
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+
+def cached_report_path(cache_key):
+    return os.path.join(REPORT_CACHE_DIR, f"{cache_key}.xlsx")
+
+
+def read_cached_report(cache_key):
+    report_path = cached_report_path(cache_key)
+    with open(report_path, 'rb') as f:
+        report_data = f.read()
+    try:
+        os.utime(report_path)  # pruning drops the least recently used reports first
+    except FileNotFoundError:
+        pass  # pruned after it was read; the bytes are still good
+    return report_data
+
+
+def build_consolidated_report(cache_key, report_rows):
+    """
+    Builds the consolidated Excel report for report_rows (id, Exception Reasons, Severity) and
+    writes it to the report cache. Runs on the report builder thread, so no st.* output.
+    """
+    row_data = db_manager.get_exception_detail(report_rows['id'].tolist())
+    report_df = pd.DataFrame([
+        {**row_data.get(exception_id, {}), 'Exception Reasons': reason, 'Severity': severity}
+        for exception_id, reason, severity in zip(report_rows['id'], report_rows['Exception Reasons'], report_rows['Severity'])
+    ])
+
+    special_cols = ['id', 'run_id', 'Exception Reasons', 'Severity', 'original_row_data']
+    original_cols = [col for col in report_df.columns if col not in special_cols]
+    final_column_order = original_cols + ['Exception Reasons', 'Severity']
+    final_df_for_excel = report_df[[col for col in final_column_order if col in report_df.columns]]
+
+    report_data = create_excel_report(final_df_for_excel, {}, filename_for_logging=f"ConsolidatedReport_{cache_key}")
+    if not report_data:
+        raise RuntimeError("Excel report generation returned no data.")
+
+    report_path = cached_report_path(cache_key)
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{report_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(report_data.getvalue())
+    os.replace(tmp_path, report_path)  # atomic, so readers never see a half-written file
+    _prune_cache_dir(REPORT_CACHE_DIR, REPORT_CACHE_MAX_FILES, '.xlsx')
+    return report_path
+
+
+def _prune_cache_dir(cache_dir, max_files, extension):
+    """Keeps the max_files most recently used `extension` files of an on-disk cache."""
+    try:
+        entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith(extension)]
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in entries[max_files:]:
+            os.remove(entry.path)
+    except OSError as e:
+        logging.warning(f"Could not prune the cache in {cache_dir}: {e}")
+
+
+class ReportBuilder:
+    """
+    Builds consolidated reports on a small thread pool. A report requested again while it is
+    still being built shares the running build instead of starting another one. Failed builds
+    are kept until the page has shown them (discard), at most REPORT_BUILD_FAILURES_KEPT of them.
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="report-builder")
+        self._builds = {}
+        self._lock = threading.Lock()
+
+    def submit(self, cache_key, report_rows):
+        with self._lock:
+            future = self._builds.get(cache_key)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self._executor.submit(build_consolidated_report, cache_key, report_rows)
+                self._builds[cache_key] = future
+                future.add_done_callback(lambda f, key=cache_key: self._forget(key, f))
+            return future
+
+    def _forget(self, cache_key, future):
+        # Successful builds are served from disk from now on; failures stay so the page can show them.
+        with self._lock:
+            if future.exception() is None:
+                if self._builds.get(cache_key) is future:
+                    del self._builds[cache_key]
+                return
+            failed_keys = [key for key, build in self._builds.items() if build.done() and build.exception() is not None]
+            for key in failed_keys[:-REPORT_BUILD_FAILURES_KEPT]:
+                del self._builds[key]
+
+    def discard(self, cache_key, future):
+        """Forgets a finished build once the page has taken its result."""
+        with self._lock:
+            if self._builds.get(cache_key) is future:
+                del self._builds[cache_key]
+
+    def get(self, cache_key):
+        with self._lock:
+            return self._builds.get(cache_key)
+
+    def read(self, cache_key, report_rows):
+        """The cached report's bytes; if the cache pruned the file in the meantime, it is rebuilt first."""
+        try:
+            return read_cached_report(cache_key)
+        except FileNotFoundError:
+            logging.info(f"Report {cache_key} was pruned from the cache before it was read; rebuilding it.")
+            self.submit(cache_key, report_rows).result()
+            return read_cached_report(cache_key)
+
+
+@st.cache_resource
+def get_report_builder():
+    return ReportBuilder()
+
+
+def show_report_archive_page(history_df):
     st.markdown("### 🗂️ Report Archive")
     st.info("Select one or more validation runs to generate a consolidated report. You can then download it or email it directly from the dashboard.")
 
     # --- 1. Get User Context and Accessible Runs ---
     user_role = st.session_state.get("role")
     username = st.session_state.get("username_actual")
-    managed_users = st.session_state.get("managed_users", [])
-
-    history_df = db_manager.get_validation_history(
-        user_role=user_role, username=username, managed_users=managed_users
-    )
 
     if history_df.empty:
         st.warning("No validation reports found for your accessible scope.")
@@ -4631,30 +7297,12 @@ def show_report_archive_page():
 
     # --- 3. Fetch Data and Apply Top-Level Security Filter ---
     with st.spinner("Loading and filtering report data based on your access level..."):
-        selected_ids = [run_options_dict[display] for display in selected_run_displays]
-        
-        all_exceptions_list = [db_manager.get_exceptions_by_run(run_id) for run_id in selected_ids]
-
-        non_empty_dfs = [df for df in all_exceptions_list if not df.empty]
-        
-        if not non_empty_dfs:
-            st.success("✅ All exceptions in the selected run(s) have been corrected. There is nothing to report.")
-            return
+        selected_ids = sorted(run_options_dict[display] for display in selected_run_displays)
+        data_version = db_manager.get_exception_data_version(selected_ids)
 
-        unfiltered_df = pd.concat([df for df in all_exceptions_list if not df.empty], ignore_index=True)
-
-        if unfiltered_df.empty:
-            st.warning("The selected run(s) contain no exception records to report.")
-            return
-            
-        scoped_df = pd.DataFrame()
-        if user_role == 'User':
-            scoped_df = unfiltered_df[unfiltered_df['Created user'].str.lower() == username.lower()]
-        elif user_role == 'Manager':
-            team_to_filter = [u.lower() for u in managed_users] + [username.lower()]
-            scoped_df = unfiltered_df[unfiltered_df['Created user'].str.lower().isin(team_to_filter)]
-        else:
-            scoped_df = unfiltered_df.copy()
+        # Scoped in SQL to the user, or the manager's reporting tree; reused across reruns
+        # until the exceptions of the selected runs change.
+        scoped_df = load_report_scope(tuple(selected_ids), user_role, username, data_version)
 
     if scoped_df.empty:
         st.error("No transactions found within your accessible scope for the selected run(s).")
@@ -4699,7 +7347,7 @@ def show_report_archive_page():
                 selected_manager = st.selectbox("Select a Manager to view their team's report", [""] + all_managers)
                 if selected_manager:
                     user_filter_selection = f"Team_of_{selected_manager}"
-                    manager_team_list = db_manager.get_managed_users(selected_manager)
+                    manager_team_list = db_manager.get_team_members(selected_manager)
                     team_to_filter = [selected_manager.lower()] + [u.lower() for u in manager_team_list]
                     filtered_df = scoped_df[scoped_df['Created user'].str.lower().isin(team_to_filter)]
 
@@ -4718,49 +7366,73 @@ def show_report_archive_page():
     st.markdown(f"Your final report contains **{len(filtered_df)}** exception records based on your filters.")
 
     # --- 5. Generate and Download/Email Logic ---
-    special_cols = ['id', 'run_id', 'Exception Reasons', 'Severity', 'original_row_data']
-    original_cols = [col for col in filtered_df.columns if col not in special_cols]
-    final_column_order = original_cols + ['Exception Reasons', 'Severity']
-    
-    final_df_for_excel = filtered_df[[col for col in final_column_order if col in filtered_df.columns]]
+    # The report is built once per (runs, filter scope, data version) in the background and
+    # then served from the report cache.
+    cache_key = consolidated_report_key(selected_ids, user_role, username, user_filter_selection, data_version, filtered_df['id'])
+    report_builder = get_report_builder()
+    report_rows = filtered_df[['id', 'Exception Reasons', 'Severity']].copy()
+    if not os.path.exists(cached_report_path(cache_key)):
+        build = report_builder.get(cache_key)
+        if build is not None and build.done() and build.exception() is not None:
+            # The failure now lives in this session, so the builder does not keep it.
+            st.session_state['report_build_error'] = (cache_key, str(build.exception()))
+            report_builder.discard(cache_key, build)
+        build_error = st.session_state.get('report_build_error')
+        if build_error and build_error[0] == cache_key:
+            st.error(f"An error occurred while generating the Excel report data: {build_error[1]}")
+            if not st.button("🔄 Try Again"):
+                return
+            del st.session_state['report_build_error']
+        report_builder.submit(cache_key, report_rows)
+        render_report_build_status(report_builder, cache_key)
+        return
 
-    final_report_data = create_excel_report(final_df_for_excel, {})
-    
-    if final_report_data:
-        report_filename = f"Filtered_Report_{user_filter_selection.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.xlsx"
-        st.download_button(
-            label="📥 Download Report as Excel",
-            data=final_report_data,
-            file_name=report_filename,
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
+    report_filename = f"Filtered_Report_{user_filter_selection.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.xlsx"
+    st.caption("✔️ Report ready.")
+    st.download_button(
+        label="📥 Download Report as Excel",
+        data=lambda: report_builder.read(cache_key, report_rows),  # read from disk only when clicked
+        file_name=report_filename,
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        on_click="ignore",
+    )
 
-        with st.expander("📧 Email This Report as an Attachment"):
-            with st.form("email_report_form"):
-                email_to = st.text_input("To (separate multiple emails with a comma)")
-                email_cc = st.text_input("CC (optional)")
-                email_subject = st.text_input("Subject", value=f"Data Validation Report: {user_filter_selection}")
-                email_body = st.text_area("Email Body", value=f"Please find the attached data validation report for {user_filter_selection}, generated on {datetime.now().strftime('%Y-%m-%d %H:%M')}.")
-                
-                submitted = st.form_submit_button("Send Email")
-                if submitted:
-                    to_recipients = [email.strip() for email in email_to.split(',') if email.strip()]
-                    cc_recipients = [email.strip() for email in email_cc.split(',') if email.strip()] if email_cc else []
-                    
-                    if not to_recipients:
-                        st.error("Please enter at least one recipient in the 'To' field.")
-                    else:
-                        with st.spinner("Attaching report and sending email..."):
-                            send_report_email_with_attachment(
-                                to_recipients=to_recipients,
-                                cc_recipients=cc_recipients,
-                                subject=email_subject,
-                                html_body=f"<p>{email_body}</p>",
-                                attachment_data=final_report_data,
-                                attachment_filename=report_filename
-                            )
-    else:
-        st.error("An error occurred while generating the Excel report data.")
+    with st.expander("📧 Email This Report as an Attachment"):
+        with st.form("email_report_form"):
+            email_to = st.text_input("To (separate multiple emails with a comma)")
+            email_cc = st.text_input("CC (optional)")
+            email_subject = st.text_input("Subject", value=f"Data Validation Report: {user_filter_selection}")
+            email_body = st.text_area("Email Body", value=f"Please find the attached data validation report for {user_filter_selection}, generated on {datetime.now().strftime('%Y-%m-%d %H:%M')}.")
+
+            submitted = st.form_submit_button("Send Email")
+            if submitted:
+                to_recipients = [email.strip() for email in email_to.split(',') if email.strip()]
+                cc_recipients = [email.strip() for email in email_cc.split(',') if email.strip()] if email_cc else []
+
+                if not to_recipients:
+                    st.error("Please enter at least one recipient in the 'To' field.")
+                else:
+                    with st.spinner("Attaching report and sending email..."):
+                        send_report_email_with_attachment(
+                            to_recipients=to_recipients,
+                            cc_recipients=cc_recipients,
+                            subject=email_subject,
+                            html_body=f"<p>{email_body}</p>",
+                            attachment_data=io.BytesIO(report_builder.read(cache_key, report_rows)),
+                            attachment_filename=report_filename
+                        )
+
+
+def render_report_build_status(report_builder, cache_key):
+    """Polls a background report build and reruns the page once the report is in the cache."""
+    @st.fragment(run_every=1)
+    def _build_status():
+        build = report_builder.get(cache_key)
+        if os.path.exists(cached_report_path(cache_key)) or (build is not None and build.done()):
+            st.rerun()
+        st.info("⏳ Generating the consolidated Excel report in the background. The download and email options appear here when it is ready.")
+
+    _build_status()
 
 def show_correction_entries_page():
     st.markdown("### 📝 Correction Entries")
@@ -4769,7 +7441,6 @@ def show_correction_entries_page():
     # --- 1. Get User Context and Permissions ---
     user_role = st.session_state.get("role")
     username = st.session_state.get("username_actual")
-    managed_users = st.session_state.get("managed_users", [])
 
     manager_can_accept = False
     if user_role == 'Manager':
@@ -4796,144 +7467,156 @@ def show_correction_entries_page():
     st.markdown("---")
     st.markdown("#### Filters")
 
-    # This logic correctly fetches entries that are not yet Accepted OR marked as 'Yes'
-    all_accessible_entries = db_manager.get_correction_entries(
-        user_role=user_role,
-        username=username,
-        managed_users=managed_users
-    )
-
-    if all_accessible_entries.empty:
+    # Filter options come from DISTINCT queries; entries are then fetched one page at a time.
+    user_choices, run_choices = db_manager.get_correction_entry_filter_options(user_role, username)
+    if not run_choices:
         st.success("✅ No pending correction entries found for your current view.")
         return
 
-    # Filter UI and logic
     filter_col1, filter_col2, filter_col3 = st.columns(3)
     with filter_col1:
-        user_options = ["All"] + sorted(all_accessible_entries['created_user'].unique().tolist())
-        filter_user_selection = st.selectbox("Filter by User", options=user_options)
+        filter_user_selection = st.selectbox("Filter by User", options=["All"] + user_choices)
     with filter_col2:
-        run_options = ["All"] + sorted(all_accessible_entries['run_id'].unique().tolist())
-        filter_run_selection = st.selectbox("Filter by Run ID", options=run_options)
+        filter_run_selection = st.selectbox("Filter by Run ID", options=["All"] + run_choices)
     with filter_col3:
         narration_filter = st.text_input("Filter by Narration")
-    
-    entries_df = all_accessible_entries.copy()
-    if filter_user_selection != "All":
-        entries_df = entries_df[entries_df['created_user'] == filter_user_selection]
-    if filter_run_selection != "All":
-        entries_df = entries_df[entries_df['run_id'] == filter_run_selection]
-    if narration_filter:
-        try:
-            mask = entries_df['narration'].str.contains(narration_filter, case=False, na=False)
-            entries_df = entries_df[mask]
-        except Exception:
-            pass
 
-    if entries_df.empty:
+    entry_filters = {
+        'narration_filter': narration_filter.strip() or None,
+        'filter_user': None if filter_user_selection == "All" else filter_user_selection,
+        'filter_run_id': None if filter_run_selection == "All" else filter_run_selection,
+    }
+    total_entries = db_manager.count_correction_entries(user_role, username, **entry_filters)
+
+    if total_entries == 0:
         st.warning("No entries match your current filter criteria.")
         return
 
-    st.info(f"Displaying {len(entries_df)} correction entries based on your filters.")
+    st.info(f"Found {total_entries:,} correction entries based on your filters.")
 
     # --- 4. MODIFIED: New Bulk Actions Section ---
     st.markdown("---")
-    st.markdown("#### Bulk Actions for Visible Entries")
-    st.caption("Apply an action to all entries currently visible on the page.")
+    st.markdown("#### Bulk Actions for Filtered Entries")
+    st.caption("Apply an action to every entry matching the filters, across all pages.")
     
     # -- Bulk Status Updates (Available to all roles) --
     st.markdown("##### Update Status")
     status_cols = st.columns(3)
-    if status_cols[0].button("Set All to 'Yes'", use_container_width=True):
-        with st.spinner("Updating all entries to 'Yes'..."):
-            db_manager.batch_update_exception_status(entries_df['id'].tolist(), 'Yes', action_by=username, user_role=user_role)
-        st.rerun()
-
-    if status_cols[1].button("Set All to 'No'", use_container_width=True):
-        with st.spinner("Updating all entries to 'No'..."):
-            db_manager.batch_update_exception_status(entries_df['id'].tolist(), 'No', action_by=username, user_role=user_role)
-        st.rerun()
-        
-    if status_cols[2].button("Set All to 'Pending'", use_container_width=True):
-        with st.spinner("Updating all entries to 'Pending'..."):
-            db_manager.batch_update_exception_status(entries_df['id'].tolist(), 'Pending', action_by=username, user_role=user_role)
-        st.rerun()
+    for status_col, bulk_status in zip(status_cols, ['Yes', 'No', 'Pending']):
+        if status_col.button(f"Set All to '{bulk_status}'", use_container_width=True):
+            with st.spinner(f"Updating all entries to '{bulk_status}'..."):
+                entry_ids = db_manager.get_correction_entry_ids(user_role, username, **entry_filters)
+                db_manager.batch_update_exception_status(entry_ids, bulk_status, action_by=username, user_role=user_role)
+            st.rerun()
 
     # -- Bulk Acceptance (Privileged roles only) --
     if show_accept_button:
         st.markdown("##### Final Acceptance (Privileged)")
-        if st.button("Accept All Visible Entries", type="primary", use_container_width=True):
-            with st.spinner("Accepting all visible entries..."):
-                db_manager.batch_accept_correction_entries(entries_df['id'].tolist())
-            st.success("All visible entries have been accepted and removed from all dashboards.")
+        if st.button("Accept All Filtered Entries", type="primary", use_container_width=True):
+            with st.spinner("Accepting all filtered entries..."):
+                db_manager.batch_accept_correction_entries(db_manager.get_correction_entry_ids(user_role, username, **entry_filters))
+            st.success("All filtered entries have been accepted and removed from all dashboards.")
             st.rerun()
 
     st.markdown("---")
 
-    # --- 5. Display Individual Entries ---
-    for _, row in entries_df.iterrows():
-        exception_id = row['id']
-        current_status = row['correction_status']
-        
-        with st.expander(f"**ID: {exception_id}** | User: **{row.get('created_user')}** | Dept: **{row.get('department')}** | Status: **{current_status}**"):
-            
-            st.markdown("##### Details")
-            metric_col1, metric_col2, metric_col3, metric_col4 = st.columns(4)
-            metric_col1.metric("Location", row.get('location', 'N/A'))
-            metric_col2.metric("Crop", row.get('crop', 'N/A'))
-            metric_col3.metric("Net Amount", f"{row.get('net_amount', 0):,.2f}")
-            metric_col4.metric("Severity", row.get('severity', 0))
-            
-            st.markdown(f"**Exception Reason(s):** {row.get('exception_reason', 'N/A')}")
-            st.markdown(f"**Narration:**")
-            
-            narration_text = row.get('narration')
-            if not narration_text: 
-                try:
-                    original_data = json.loads(row['original_row_data'])
-                    narration_key = next((k for k in original_data if k.lower() == 'narration'), None)
-                    if narration_key:
-                        narration_text = original_data.get(narration_key)
-                except (json.JSONDecodeError, TypeError):
-                    narration_text = None
-            
-            st.info(f"{narration_text or 'No narration provided.'}")
+    # --- 5. Paged Entry List ---
+    sort_col, order_col, size_col = st.columns([2, 1, 1])
+    sort_label = sort_col.selectbox("Sort by", list(CORRECTION_ENTRY_SORT_COLUMNS), key="correction_entries_sort")
+    descending = order_col.toggle("Descending", value=True, key="correction_entries_descending")
+    page_size = size_col.selectbox("Rows per page", PAGE_SIZE_OPTIONS, index=0, key="correction_entries_page_size")
 
-            st.markdown("---")
-            st.markdown("##### Actions")
-            
-            action_col1, action_col2 = st.columns([2, 1])
-            with action_col1:
-                st.write("**Update Status:**")
-                status_options = ['Pending', 'Yes', 'No']
-                new_status = st.radio(
-                    "Correction Status",
-                    options=status_options,
-                    index=status_options.index(current_status),
-                    key=f"status_radio_{exception_id}",
-                    horizontal=True,
-                    label_visibility="collapsed"
-                )
-                if new_status != current_status:
-                    db_manager.update_exception_status(exception_id, new_status, action_by=username, user_role=user_role)
+    page, total_pages = _page_state(
+        "correction_entries", total_entries, page_size,
+        (tuple(entry_filters.values()), sort_label, descending, page_size)
+    )
+    entries_df = db_manager.get_correction_entries_page(
+        user_role, username, **entry_filters,
+        sort_by=CORRECTION_ENTRY_SORT_COLUMNS[sort_label], descending=descending,
+        offset=(page - 1) * page_size, limit=page_size
+    )
+
+    st.caption("Select an entry to review its details and update its status.")
+    event = st.dataframe(
+        entries_df.rename(columns={
+            'id': 'ID', 'run_id': 'Run ID', 'created_user': 'User', 'department': 'Department',
+            'location': 'Location', 'crop': 'Crop', 'net_amount': 'Net Amount', 'severity': 'Severity',
+            'exception_reason': 'Exception Reason(s)', 'narration': 'Narration', 'correction_status': 'Status',
+        }),
+        key=f"correction_entries_grid_{page}_{hash((tuple(entry_filters.values()), sort_label, descending, page_size))}",
+        use_container_width=True,
+        hide_index=True,
+        on_select="rerun",
+        selection_mode="single-row",
+    )
+    render_page_navigation("correction_entries", page, total_pages, total_entries, page_size)
+
+    # --- 6. Selected Entry ---
+    if event and event.selection.rows:
+        show_correction_entry_detail(entries_df.iloc[event.selection.rows[0]], username, user_role, show_accept_button)
+
+
+def show_correction_entry_detail(row, username, user_role, show_accept_button):
+    """Details and actions for one correction entry; its original record is loaded on demand."""
+    exception_id = int(row['id'])
+    current_status = row['correction_status']
+    original_data = db_manager.get_exception_detail([exception_id]).get(exception_id)
+
+    with st.container(border=True):
+        st.markdown(f"**ID: {exception_id}** | User: **{row.get('created_user')}** | Dept: **{row.get('department')}** | Status: **{current_status}**")
+
+        st.markdown("##### Details")
+        metric_col1, metric_col2, metric_col3, metric_col4 = st.columns(4)
+        metric_col1.metric("Location", row.get('location') or 'N/A')
+        metric_col2.metric("Crop", row.get('crop') or 'N/A')
+        metric_col3.metric("Net Amount", f"{row.get('net_amount') or 0:,.2f}")
+        metric_col4.metric("Severity", int(row.get('severity') or 0))
+
+        st.markdown(f"**Exception Reason(s):** {row.get('exception_reason', 'N/A')}")
+        st.markdown(f"**Narration:**")
+
+        narration_text = row.get('narration')
+        if not narration_text and original_data:
+            narration_key = next((k for k in original_data if k.lower() == 'narration'), None)
+            if narration_key:
+                narration_text = original_data.get(narration_key)
+
+        st.info(f"{narration_text or 'No narration provided.'}")
+
+        st.markdown("---")
+        st.markdown("##### Actions")
+
+        action_col1, action_col2 = st.columns([2, 1])
+        with action_col1:
+            st.write("**Update Status:**")
+            status_options = ['Pending', 'Yes', 'No']
+            new_status = st.radio(
+                "Correction Status",
+                options=status_options,
+                index=status_options.index(current_status),
+                key=f"status_radio_{exception_id}",
+                horizontal=True,
+                label_visibility="collapsed"
+            )
+            if new_status != current_status:
+                db_manager.update_exception_status(exception_id, new_status, action_by=username, user_role=user_role)
+                st.rerun()
+        with action_col2:
+            if show_accept_button:
+                st.write("**Final Acceptance:**")
+                if st.button("Accept", key=f"accept_btn_{exception_id}", type="primary", use_container_width=True):
+                    with st.spinner(f"Accepting entry {exception_id}..."):
+                        db_manager.accept_correction_entry(exception_id)
+                    st.success(f"Entry {exception_id} accepted and closed.")
                     st.rerun()
-            with action_col2:
-                if show_accept_button:
-                    st.write("**Final Acceptance:**")
-                    if st.button("Accept", key=f"accept_btn_{exception_id}", type="primary", use_container_width=True):
-                        with st.spinner(f"Accepting entry {exception_id}..."):
-                            db_manager.accept_correction_entry(exception_id)
-                        st.success(f"Entry {exception_id} accepted and closed.")
-                        st.rerun()
-            
-            with st.expander("View Original Row Data"):
-                try:
-                    original_data = json.loads(row['original_row_data'])
-                    st.dataframe(pd.DataFrame([original_data]), use_container_width=True)
-                except:
-                    st.warning("Could not display original row data.")
 
-def show_correction_analytics_page():
+        with st.expander("View Original Row Data"):
+            if original_data:
+                st.dataframe(pd.DataFrame([original_data]).astype(str), use_container_width=True)
+            else:
+                st.warning("Could not display original row data.")
+
+def show_correction_analytics_page(all_users_df):
     st.markdown("### 📈 Correction Analytics")
 
     # This page is exclusively for the Super User
@@ -4944,7 +7627,6 @@ def show_correction_analytics_page():
     st.caption("Analyze the breakdown of correction statuses across the system or for a specific user.")
 
     # --- 1. User Selection Filter ---
-    all_users_df = db_manager.get_all_users()
     user_list = sorted(all_users_df['username'].tolist()) if not all_users_df.empty else []
     
     view_options = ["Overall Summary"] + user_list
@@ -4988,56 +7670,91 @@ def show_correction_analytics_page():
     summary_df = pd.DataFrame([status_data])
     st.dataframe(summary_df, use_container_width=True)
 
-def show_data_management_page():
+def show_data_management_page(history_df):
     st.markdown("### 🗑️ Data Management")
     st.warning("🚨 **Caution:** Actions on this page are permanent and cannot be undone.")
 
     st.markdown("---")
-    st.markdown("#### ❌ Delete a Specific Validation Run")
-    st.markdown("Select a validation run to permanently delete it and all its associated data (exceptions, summaries, etc.).")
+    st.markdown("#### ❌ Delete Validation Runs")
+    st.markdown("Select one or more validation runs to permanently delete them and all their associated data (exceptions, summaries, archived rows, etc.). "
+                "Runs are deleted in the background in small batches, so uploads and other users are not blocked meanwhile.")
+
+    deletion_queue = get_run_deletion_queue()
+    render_run_deletion_progress(deletion_queue)
 
-    history_df = db_manager.get_validation_history()
+    active_run_ids = deletion_queue.active_run_ids()
+    if not history_df.empty:
+        history_df = history_df[~history_df['id'].isin(active_run_ids)]
 
     if history_df.empty:
         st.info("No validation runs available to delete.")
         return
 
     run_options = {f"Run {row['id']}: {row['filename']} ({pd.to_datetime(row['upload_time']).strftime('%Y-%m-%d %H:%M')})": row['id'] for _, row in history_df.iterrows()}
-    
-    if 'run_to_delete_display' not in st.session_state:
-        st.session_state.run_to_delete_display = None
 
-    selected_run_display = st.selectbox(
-        "Select a run to delete", 
-        options=[None] + list(run_options.keys()), 
+    selected_run_displays = st.multiselect(
+        "Select runs to delete",
+        options=list(run_options.keys()),
         key="delete_run_select"
     )
 
-    if selected_run_display:
-        selected_run_id = run_options[selected_run_display]
-        run_details = history_df[history_df['id'] == selected_run_id].iloc[0]
+    if selected_run_displays:
+        selected_runs = {run_options[display]: display for display in selected_run_displays}
+        run_details = history_df[history_df['id'].isin(selected_runs.keys())]
 
         with st.expander("⚠️ Review Run Details Before Deleting", expanded=True):
-            st.markdown(f"- **Run ID:** `{run_details['id']}`")
-            st.markdown(f"- **Filename:** `{run_details['filename']}`")
-            st.markdown(f"- **Upload Time:** `{pd.to_datetime(run_details['upload_time']).strftime('%Y-%m-%d %H:%M:%S')}`")
-            st.markdown(f"- **Total Records:** `{run_details['total_records']}`")
-            st.markdown(f"- **Total Exceptions:** `{run_details['total_exceptions']}`")
+            st.dataframe(
+                run_details[['id', 'filename', 'upload_time', 'total_records', 'total_exceptions', 'status']].rename(columns={
+                    'id': 'Run ID', 'filename': 'Filename', 'upload_time': 'Upload Time', 'total_records': 'Total Records',
+                    'total_exceptions': 'Total Exceptions', 'status': 'Status'}),
+                use_container_width=True, hide_index=True
+            )
 
-            st.error("This action will permanently delete the run entry, all its exceptions, department summaries, and user performance records.")
-            
-            confirm_delete = st.checkbox("I understand this is permanent and want to delete this run.", key=f"confirm_delete_{selected_run_id}")
+            st.error(f"This action will permanently delete {len(selected_runs)} run(s) with all their exceptions, department summaries, and user performance records.")
 
-            if st.button(f"Permanently Delete Run {selected_run_id}", disabled=not confirm_delete):
-                with st.spinner(f"Deleting run {selected_run_id}..."):
-                    success = db_manager.delete_run(selected_run_id)
-                    if success:
-                        st.success(f"Successfully deleted Run ID {selected_run_id}.")
-                        st.rerun()
-                    else:
-                        st.error(f"Failed to delete Run ID {selected_run_id}. Check logs for details.")
+            confirm_key = "confirm_delete_" + "_".join(str(run_id) for run_id in sorted(selected_runs))
+            confirm_delete = st.checkbox("I understand this is permanent and want to delete the selected runs.", key=confirm_key)
+
+            if st.button(f"Permanently Delete {len(selected_runs)} Run(s)", disabled=not confirm_delete):
+                deletion_queue.submit(selected_runs, st.session_state.get('username'))
+                del st.session_state["delete_run_select"]
+                st.rerun()
     else:
-        st.info("Select a run from the dropdown list to manage it.")
+        st.info("Select one or more runs from the list to manage them.")
+
+
+def render_run_deletion_progress(deletion_queue):
+    """Shows queued/running/finished run deletions; refreshes itself every few seconds while any are active."""
+    if not deletion_queue.snapshot():
+        return
+
+    @st.fragment(run_every=2 if deletion_queue.active_run_ids() else None)
+    def _progress_panel():
+        jobs = deletion_queue.snapshot()
+        active = any(job['state'] in ('Queued', 'Deleting') for job in jobs.values())
+        with st.container(border=True):
+            st.markdown("##### ⏳ Run Deletions")
+            for run_id, job in jobs.items():
+                if job['state'] == 'Deleting':
+                    fraction = job['deleted'] / job['total'] if job['total'] else 0.0
+                    step = f" – {job['table']}" if job['table'] else ""
+                    st.progress(min(fraction, 1.0), text=f"{job['label']}: {job['deleted']:,} of {job['total'] or 0:,} rows deleted{step}")
+                elif job['state'] == 'Queued':
+                    st.caption(f"🕒 {job['label']}: queued")
+                elif job['state'] == 'Deleted':
+                    st.caption(f"✅ {job['label']}: deleted ({job['deleted']:,} rows) at {job['finished_at']:%H:%M:%S}")
+                else:
+                    st.caption(f"❌ {job['label']}: deletion failed, check the logs. The run can be selected again to retry.")
+            if not active and st.button("Clear finished", key="clear_finished_run_deletions"):
+                deletion_queue.clear_finished()
+                st.rerun()
+        # Once the last deletion finishes, refresh the whole page so the run list is current.
+        if st.session_state.get('run_deletions_active') and not active:
+            st.session_state.run_deletions_active = False
+            st.rerun()
+        st.session_state.run_deletions_active = active
+
+    _progress_panel()
 
 
 def show_settings_page():
@@ -5095,6 +7812,62 @@ def show_settings_page():
                 st.success("User-specific settings have been saved.")
                 st.rerun()
 
+        # Background check status
+        st.markdown("##### Unresolved-Entry Check")
+        scheduler = get_notification_scheduler()
+        global_settings = settings.get('global', {})
+        st.caption(f"Runs in the background after uploads and every {scheduler.interval_seconds // 60} minutes; only one server instance runs it at a time.")
+        col_chk1, col_chk2, col_chk3 = st.columns(3)
+        display_metric("Last Run", global_settings.get('notification_check_last_run_at', 'Never'), container=col_chk1)
+        last_duration = global_settings.get('notification_check_last_duration_seconds')
+        display_metric("Last Duration", f"{last_duration}s" if last_duration else "-", container=col_chk2)
+        display_metric("Next Scheduled", scheduler.next_run_at.strftime('%H:%M:%S') if scheduler.next_run_at else "-", container=col_chk3)
+        last_status = global_settings.get('notification_check_last_status')
+        if last_status and last_status != 'ok':
+            st.warning(f"Last check {last_status}")
+        if st.button("▶️ Run Check Now"):
+            scheduler.request_run()
+            st.info(f"Check requested; it will start within {scheduler.delay_seconds} seconds.")
+
+        # Outbound email queue status
+        st.markdown("##### Outbound Email")
+        dispatcher = get_email_dispatcher()
+        outbox = db_manager.get_email_outbox_status()
+        st.caption(f"Queued emails are sent in the background in batches of up to {dispatcher.batch_size} per SMTP session; "
+                   f"failed sends are retried {len(EMAIL_RETRY_DELAYS_SECONDS)} times with increasing delays.")
+        col_mail1, col_mail2, col_mail3 = st.columns(3)
+        display_metric("Waiting", f"{outbox.get('Pending', 0) + outbox.get('Sending', 0):,}", container=col_mail1)
+        display_metric(f"Sent (last {EMAIL_SENT_RETENTION_DAYS} days)", f"{outbox.get('Sent', 0):,}", container=col_mail2)
+        display_metric("Failed", f"{outbox.get('Failed', 0):,}", container=col_mail3)
+        if outbox.get('Failed'):
+            failed_emails = db_manager.get_failed_emails()
+            st.dataframe(failed_emails, use_container_width=True, hide_index=True)
+            if st.button("🔁 Retry Failed Emails"):
+                requeued = db_manager.retry_failed_emails()
+                dispatcher.request_send()
+                st.success(f"{requeued} email(s) queued again.")
+                st.rerun()
+
+        # Reference data hot-reload status
+        st.markdown("---")
+        st.markdown("#### 📚 Reference Data")
+        registry = get_reference_registry()
+        snapshot = registry.current()
+        st.caption(f"Changes to files in `{registry.base_ref_path}/` are picked up automatically within about {registry.poll_interval} seconds.")
+        col_ref1, col_ref2 = st.columns(2)
+        display_metric("Active Version", snapshot['version'], container=col_ref1)
+        display_metric("Compiled At", snapshot['compiled_at'].strftime('%Y-%m-%d %H:%M:%S'), container=col_ref2)
+        entries = {REFERENCE_LIST_FILES[key][0]: entry for key, entry in snapshot['lists'].items()}
+        entries.update({REFERENCE_TABLE_FILES[name][0]: entry for name, entry in snapshot['tables'].items()})
+        problems = {f: e['status'] for f, e in entries.items() if e['status'] != 'ok'}
+        if problems:
+            st.warning("Some reference files could not be used: " + ", ".join(f"`{f}` ({status})" for f, status in sorted(problems.items())))
+        if st.button("🔄 Check Reference Files Now"):
+            if registry.reload():
+                st.success(f"Loaded new reference data version {registry.version}.")
+            else:
+                st.info("Reference data is already up to date.")
+
     # --- Existing Sections ---
     st.markdown("---")
     st.markdown("#### 🛠 Database Management")
@@ -5117,9 +7890,11 @@ def show_settings_page():
                             "correction_status",
                             "user_performance",
                             "department_summary",
+                            "exception_reason_links",
                             "exceptions",
-                            "validation_runs"
-                        ]
+                            "validation_runs",
+                            "archived_runs",
+                        ] + [f"{table}_archive" for table in ARCHIVE_TABLES if table != "notifications"]
                         for table in tables_to_clear:
                             cursor.execute(f"TRUNCATE TABLE `{table}`")
                             logging.info(f"Cleared table: {table}")
@@ -5141,7 +7916,7 @@ def show_settings_page():
     dashboard_version = "4.0.0-mysql"
     st.markdown(f"""**Data Validation Dashboard - Version {dashboard_version}**\n\nThis application is designed to help users validate data from Excel files against a predefined set of business rules...\n\nBuilt with Streamlit, Pandas, Plotly, and MySQL.""")
 
-def show_send_notification_page():
+def show_send_notification_page(all_users_df):
     st.markdown("### ✉️ Send Manual Notification")
 
     # Role check to ensure only authorized users see this page
@@ -5152,8 +7927,6 @@ def show_send_notification_page():
 
     st.caption("Send a direct message or alert to any user in the system.")
     
-    # Fetch all users to populate the dropdown
-    all_users_df = db_manager.get_all_users()
     if all_users_df.empty:
         st.warning("There are no users in the system to send notifications to.")
         return
@@ -5205,17 +7978,14 @@ def show_send_notification_page():
                 else:
                     st.error("Failed to send notification. Please check the logs.")
 
-def show_correction_status_page(start_date, end_date):
+def show_correction_status_page(start_date, end_date, history_df):
     st.markdown("### 📝 Correction Status")
     db_manager = get_database_manager()
 
     user_role = st.session_state.get("role")
     username = st.session_state.get("username_actual")
-    managed_users = st.session_state.get("managed_users", [])
 
     # === Part 1: Status Update Section ===
-    history_df = db_manager.get_validation_history(user_role, username, managed_users)
-    
     runs_for_status_update_df = pd.DataFrame()
     update_caption = ""
 
@@ -5246,29 +8016,24 @@ def show_correction_status_page(start_date, end_date):
         if selected_run_display:
             selected_run_id = int(runs_for_status_update_df[runs_for_status_update_df['display_name'] == selected_run_display]['id'].iloc[0])
 
-            all_users_with_exceptions_in_run = []
+            users_to_show = []
             conn = db_manager._get_connection()
             try:
                 query = """
                     SELECT DISTINCT `user` FROM `user_performance` 
                     WHERE run_id = %s AND exception_records > 0 AND `user` IS NOT NULL AND `user` != ''
                 """
-                df_users = pd.read_sql_query(query, conn, params=(selected_run_id,))
+                params = [selected_run_id]
+                scope_sql, scope_params = db_manager._visibility_filter('`user`', user_role, username)
+                if scope_sql:
+                    query += f" AND {scope_sql}"
+                    params.extend(scope_params)
+                df_users = pd.read_sql_query(query, conn, params=tuple(params))
                 if not df_users.empty:
-                    all_users_with_exceptions_in_run = df_users['user'].tolist()
+                    users_to_show = df_users['user'].tolist()
             finally:
                 if conn.is_connected():
                     conn.close()
-
-            users_to_show = []
-            if user_role == 'User':
-                if username in all_users_with_exceptions_in_run:
-                    users_to_show = [username]
-            elif user_role == 'Manager':
-                team_members_lower = {u.lower() for u in (managed_users + [username])}
-                users_to_show = [u for u in all_users_with_exceptions_in_run if u.lower() in team_members_lower]
-            else:
-                users_to_show = all_users_with_exceptions_in_run
             
             if not users_to_show:
                 st.success("✅ No users with exceptions were found in this run for your specific scope.")
@@ -5313,12 +8078,8 @@ def show_correction_status_page(start_date, end_date):
             
         run_ids_in_scope = all_runs_in_range['id'].tolist()
         
-        accessible_users = None
-        if user_role == 'Manager':
-            accessible_users = managed_users + [username]
-        
         # The debug info is removed from the function call
-        summary_df, _ = db_manager.get_correction_summary(run_ids_in_scope, accessible_users)
+        summary_df, _ = db_manager.get_correction_summary(run_ids_in_scope, user_role=user_role, username=username)
         
         if summary_df.empty:
             st.info("No correction status data to analyze for the selected scope.")
@@ -5350,14 +8111,12 @@ def show_correction_status_page(start_date, end_date):
         st.dataframe(user_summary, use_container_width=True)
 
 
-def show_user_management_page():
+def show_user_management_page(all_users_df):
     st.markdown("### 🛠️ User Management")
     st.info("View all users, create new accounts, and manage existing users.")
 
     db_manager = get_database_manager()
 
-    # Fetch all necessary user data at the beginning
-    all_users_df = db_manager.get_all_users()
     all_users_list = all_users_df['username'].tolist() if not all_users_df.empty else []
     manager_list = all_users_df[all_users_df['role'] == 'Manager']['username'].tolist() if not all_users_df.empty else []
     management_list = db_manager.get_management_users()
@@ -5496,11 +8255,12 @@ def show_user_management_page():
                     with st.form(f"change_password_form_{user_to_manage}"):
                         password_to_change = st.text_input("New Password", type="password", key=f"new_pass_{user_to_manage}")
                         if st.form_submit_button("Set New Password"):
-                            if password_to_change:
-                                db_manager.update_user_password(user_to_manage, password_to_change)
+                            if not password_to_change:
+                                st.warning("Password field cannot be empty.")
+                            elif db_manager.update_user_password(user_to_manage, password_to_change):
                                 st.success(f"Password for '{user_to_manage}' has been changed.")
                             else:
-                                st.warning("Password field cannot be empty.")
+                                st.error("Could not change the password. Please try again.")
                 
                 with st.expander("🚨 Danger Zone - Permanent Deletion"):
                      # This section remains unchanged
@@ -5630,21 +8390,8 @@ def show_suspicious_category_transactions_page():
         st.subheader("Items Pending Your Review")
         st.caption("Review transactions flagged by custom rules. Accept them or reject and send back for correction.")
         
-        # Determine team scope for Managers
-        team_list = []
-        if user_role == "Manager":
-            managed_users = st.session_state.get("managed_users", [])
-            team_list = [username.lower()] + [user.lower() for user in managed_users]
-
-        all_pending_df = db_manager.get_suspicious_transactions_for_admin()
-        
-        # Filter for Managers, show all for Super User/Management
-        pending_review_df = all_pending_df
-        if user_role == "Manager":
-            if not all_pending_df.empty:
-                pending_review_df = all_pending_df[all_pending_df['created_user'].str.lower().isin(team_list)].copy()
-            else:
-                pending_review_df = pd.DataFrame()
+        # Managers only see their reporting tree; the scope is applied in SQL
+        pending_review_df = db_manager.get_suspicious_transactions_for_admin(user_role, username)
 
         if pending_review_df.empty:
             st.success("✅ There are no new transactions pending review.")
@@ -5661,7 +8408,9 @@ def show_suspicious_category_transactions_page():
                     details_cols[0].metric("Sub Department", row.get('Sub Department.Name', 'N/A'))
                     details_cols[1].metric("Location", row.get('Location.Name', 'N/A'))
                     details_cols[2].metric("Crop", row.get('Crop.Name', 'N/A'))
-                    st.dataframe(pd.DataFrame([row.to_dict()]), use_container_width=True, hide_index=True)
+                    if st.toggle("Show full transaction record", key=f"pending_full_{log_id}"):
+                        full_record = db_manager.get_suspicious_transaction_detail([log_id]).get(log_id, {})
+                        st.dataframe(pd.DataFrame([{**row.to_dict(), **full_record}]), use_container_width=True, hide_index=True)
                     
                     st.markdown("##### Actions")
                     action_cols = st.columns(2)
@@ -5686,14 +8435,7 @@ def show_suspicious_category_transactions_page():
         # --- Section 2: Tracking for Admins/Managers ---
         st.subheader("Track Items Sent for Correction")
         
-        all_rejected_df = db_manager.get_rejected_transactions()
-        
-        rejected_df_for_view = all_rejected_df
-        if user_role == "Manager":
-            if not all_rejected_df.empty:
-                rejected_df_for_view = all_rejected_df[all_rejected_df['created_user'].str.lower().isin(team_list)].copy()
-            else:
-                rejected_df_for_view = pd.DataFrame()
+        rejected_df_for_view = db_manager.get_rejected_transactions(user_role, username)
 
         if rejected_df_for_view.empty:
             st.info("No items are currently pending user correction.")
@@ -5719,7 +8461,9 @@ def show_suspicious_category_transactions_page():
                     details_cols_rej[0].metric("Sub Department", row.get('Sub Department.Name', 'N/A'))
                     details_cols_rej[1].metric("Location", row.get('Location.Name', 'N/A'))
                     details_cols_rej[2].metric("Crop", row.get('Crop.Name', 'N/A'))
-                    st.dataframe(pd.DataFrame([row.to_dict()]), use_container_width=True, hide_index=True)
+                    if st.toggle("Show full transaction record", key=f"rejected_full_{log_id}"):
+                        full_record = db_manager.get_suspicious_transaction_detail([log_id]).get(log_id, {})
+                        st.dataframe(pd.DataFrame([{**row.to_dict(), **full_record}]), use_container_width=True, hide_index=True)
                     
                     # --- ADDED --- "Call Back" button for Super User
                     if user_role == "Super User" and status == "Rejected":
@@ -5759,9 +8503,66 @@ def show_suspicious_category_transactions_page():
                     if db_manager.confirm_user_correction(log_id):
                         st.success("Thank you for confirming. The task has been removed from your list."); time.sleep(1); st.rerun()
 
+def open_smtp_connection(timeout=30):
+    """
+    Opens an SMTP session with the [email_credentials] from st.secrets and returns
+    (server, sender_email). Uses implicit TLS by default; with `use_ssl = false` it connects
+    in plain text (upgraded when `starttls = true`) and only logs in when a password is set,
+    so a local debugging server such as `python -m aiosmtpd -n -l localhost:1025` can stand in.
+    """
+    creds = st.secrets["email_credentials"]
+    sender_email, password = creds["sender_email"], creds.get("sender_password")
+    smtp_server, smtp_port = creds["smtp_server"], int(creds["smtp_port"])
+    context = ssl.create_default_context()
+    if creds.get("use_ssl", True):
+        server = smtplib.SMTP_SSL(smtp_server, smtp_port, context=context, timeout=timeout)
+    else:
+        server = smtplib.SMTP(smtp_server, smtp_port, timeout=timeout)
+        if creds.get("starttls", False):
+            server.starttls(context=context)
+    try:
+        if password:
+            server.login(sender_email, password)
+    except Exception:
+        server.close()
+        raise
+    return server, sender_email
+
+
+def queue_email(message, recipients, created_by=None, job_id=None):
+    """Queues a built MIME message for the EmailDispatcher. Returns True once it is stored."""
+    queued = db_manager.enqueue_emails([(recipients, message["Subject"] or "", message.as_bytes())], created_by=created_by, job_id=job_id)
+    if queued:
+        get_email_dispatcher().request_send()
+    return bool(queued)
+
+
+def build_performance_message(sender_email, to_recipients, subject, html_body, cc_recipients=None, images=None):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.image import MIMEImage
+
+    message = MIMEMultipart("related")
+    message["From"] = sender_email
+    message["To"] = ", ".join(to_recipients)
+    if cc_recipients:
+        message["Cc"] = ", ".join(cc_recipients)
+    message["Subject"] = subject
+
+    # Attach the HTML body and images
+    message.attach(MIMEText(html_body, "html"))
+    if images:
+        for cid, img_data in images.items():
+            img = MIMEImage(img_data, _subtype="png")
+            img.add_header('Content-ID', f'<{cid}>')
+            message.attach(img)
+    return message
+
+
 def send_performance_email(to_recipients, subject, html_body, cc_recipients=None, images=None):
     """
-    Connects to the SMTP server and sends a multipart HTML email with embedded images.
+    Queues a multipart HTML email with embedded images; the EmailDispatcher sends it in the
+    background.
 
     Args:
         to_recipients (list): A list of email addresses for the 'To' field.
@@ -5771,46 +8572,24 @@ def send_performance_email(to_recipients, subject, html_body, cc_recipients=None
         images (dict, optional): A dictionary of images to embed. Defaults to None.
     """
     try:
-        # Fetch credentials from Streamlit secrets
         sender_email = st.secrets["email_credentials"]["sender_email"]
-        password = st.secrets["email_credentials"]["sender_password"]
-        smtp_server = st.secrets["email_credentials"]["smtp_server"]
-        smtp_port = st.secrets["email_credentials"]["smtp_port"]
 
         if not to_recipients:
             st.error("No recipients specified in the 'To' field.")
             return
-            
+
         if cc_recipients is None:
             cc_recipients = []
 
         # Combine all recipients for the mail server
         all_recipients_list = to_recipients + cc_recipients
+        message = build_performance_message(sender_email, to_recipients, subject, html_body, cc_recipients, images)
 
-        # Create the email message
-        message = MIMEMultipart("related")
-        message["From"] = sender_email
-        message["To"] = ", ".join(to_recipients)
-        if cc_recipients:
-            message["Cc"] = ", ".join(cc_recipients)
-        message["Subject"] = subject
-
-        # Attach the HTML body and images
-        message.attach(MIMEText(html_body, "html"))
-        if images:
-            for cid, img_data in images.items():
-                img = MIMEImage(img_data, _subtype="png")
-                img.add_header('Content-ID', f'<{cid}>')
-                message.attach(img)
-
-        # Send the email
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(smtp_server, smtp_port, context=context) as server:
-            server.login(sender_email, password)
-            server.sendmail(sender_email, all_recipients_list, message.as_string())
-        
-        st.success(f"Performance report successfully sent to: {', '.join(all_recipients_list)}")
-        logging.info(f"Successfully sent performance email to: {', '.join(all_recipients_list)}")
+        if queue_email(message, all_recipients_list, created_by=st.session_state.get("username_actual")):
+            st.success(f"Performance report queued for sending to: {', '.join(all_recipients_list)}")
+            logging.info(f"Queued performance email to: {', '.join(all_recipients_list)}")
+        else:
+            st.error("Failed to queue the email. Check logs for details.")
 
     except KeyError:
         st.error("Email credentials are not configured in st.secrets. Please check your secrets.toml file.")
@@ -5819,18 +8598,17 @@ def send_performance_email(to_recipients, subject, html_body, cc_recipients=None
         st.error(f"Failed to send email: {e}")
         logging.error(f"Failed to send email: {e}", exc_info=True)
 
-# ADD THIS NEW FUNCTION TO YOUR SCRIPT
 
 def send_report_email_with_attachment(to_recipients, subject, html_body, attachment_data, attachment_filename, cc_recipients=None):
     """
-    Connects to the SMTP server and sends an email with a file attachment.
+    Queues an email with a file attachment; the EmailDispatcher sends it in the background.
     """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.application import MIMEApplication
+
     try:
-        # Fetch credentials from Streamlit secrets
         sender_email = st.secrets["email_credentials"]["sender_email"]
-        password = st.secrets["email_credentials"]["sender_password"]
-        smtp_server = st.secrets["email_credentials"]["smtp_server"]
-        smtp_port = st.secrets["email_credentials"]["smtp_port"]
 
         if not to_recipients:
             st.error("No recipients specified in the 'To' field.")
@@ -5853,15 +8631,12 @@ def send_report_email_with_attachment(to_recipients, subject, html_body, attachm
             part['Content-Disposition'] = f'attachment; filename="{attachment_filename}"'
             message.attach(part)
 
-        # Send the email
         all_recipients_list = to_recipients + (cc_recipients or [])
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(smtp_server, smtp_port, context=context) as server:
-            server.login(sender_email, password)
-            server.sendmail(sender_email, all_recipients_list, message.as_string())
-        
-        st.success(f"Report successfully sent to: {', '.join(all_recipients_list)}")
-        logging.info(f"Successfully sent report email to: {', '.join(all_recipients_list)}")
+        if queue_email(message, all_recipients_list, created_by=st.session_state.get("username_actual")):
+            st.success(f"Report queued for sending to: {', '.join(all_recipients_list)}")
+            logging.info(f"Queued report email to: {', '.join(all_recipients_list)}")
+        else:
+            st.error("Failed to queue the email. Check logs for details.")
 
     except KeyError:
         st.error("Email credentials are not configured in st.secrets. Please check your secrets.toml file.")
@@ -5871,14 +8646,14 @@ def send_report_email_with_attachment(to_recipients, subject, html_body, attachm
 
 def send_new_user_credentials_email(to_email, new_username, plain_text_password):
     """
-    Sends a welcome email to a new user with their login credentials.
+    Sends a welcome email to a new user with their login credentials. Sent directly rather
+    than through the email queue so the plain-text password is never stored in the database.
     """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
     try:
-        # Fetch credentials from Streamlit secrets
         sender_email = st.secrets["email_credentials"]["sender_email"]
-        password = st.secrets["email_credentials"]["sender_password"]
-        smtp_server = st.secrets["email_credentials"]["smtp_server"]
-        smtp_port = st.secrets["email_credentials"]["smtp_port"]
 
         if not to_email:
             st.warning("Could not send welcome email: No email address provided.")
@@ -5927,9 +8702,8 @@ def send_new_user_credentials_email(to_email, new_username, plain_text_password)
         message.attach(MIMEText(html_body, "html"))
         
         # Send the email
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(smtp_server, smtp_port, context=context) as server:
-            server.login(sender_email, password)
+        server, sender_email = open_smtp_connection()
+        with server:
             server.sendmail(sender_email, to_email, message.as_string())
         
         st.success(f"Login credentials successfully sent to {to_email}.")
@@ -5950,9 +8724,10 @@ def add_date_filters_to_sidebar(history_df, key_suffix=""):
         st.sidebar.warning("No historical data to filter.")
         return None, None
 
-    history_df['upload_time'] = pd.to_datetime(history_df['upload_time'])
-    min_date = history_df['upload_time'].min().date()
-    max_date = history_df['upload_time'].max().date()
+    # The history frame is shared with the page for this rerun, so it is not modified here.
+    upload_times = pd.to_datetime(history_df['upload_time'])
+    min_date = upload_times.min().date()
+    max_date = upload_times.max().date()
 
     filter_type = st.sidebar.radio(
         "Filter by:",
@@ -5963,8 +8738,7 @@ def add_date_filters_to_sidebar(history_df, key_suffix=""):
     start_date, end_date = None, None
 
     if filter_type == "Month":
-        history_df['month_year'] = history_df['upload_time'].dt.to_period('M')
-        month_options = sorted(history_df['month_year'].unique(), reverse=True)
+        month_options = sorted(upload_times.dt.to_period('M').unique(), reverse=True)
         selected_month = st.sidebar.selectbox(
             "Select Month",
             options=month_options,
@@ -5988,23 +8762,115 @@ def add_date_filters_to_sidebar(history_df, key_suffix=""):
     return start_date, end_date
 
 
+class PageData:
+    """
+    Data shared between main() and the pages, loaded at most once per script run. The date
+    filter and the selected page get the same validation history instead of each querying it,
+    and nothing is loaded for pages that are not shown.
+    """
+
+    # Roles for which the scoped validation history already contains every run.
+    UNSCOPED_ROLES = ("Super User", "Management")
+
+    def __init__(self, user_role, username, managed_users):
+        self.user_role = user_role
+        self.username = username
+        self.managed_users = managed_users
+        self._loaded = {}
+
+    def get(self, name):
+        if name not in self._loaded:
+            self._loaded[name] = getattr(self, f"_load_{name}")()
+        return self._loaded[name]
+
+    def _load_history(self):
+        """Validation runs the current user may see."""
+        return db_manager.get_validation_history(self.user_role, self.username, self.managed_users)
+
+    def _load_all_history(self):
+        """Every validation run, regardless of the user's scope."""
+        if self.user_role in self.UNSCOPED_ROLES:
+            return self.get('history')
+        return db_manager.get_validation_history()
+
+    def _load_all_users(self):
+        return db_manager.get_all_users()
+
+
+_ALL_ROLES = ("Super User", "Management", "Manager", "User")
+_MANAGER_ROLES = ("Super User", "Management", "Manager")
+_ADMIN_ROLES = ("Super User", "Management")
+
+
+def _page(render, roles, date_filter=False, data=None, can_disable=True):
+    return {'render': render, 'roles': roles, 'date_filter': date_filter, 'data': data or {}, 'can_disable': can_disable}
+
+
+# Navigation in sidebar order. For each page: the roles that see it by default, whether it
+# gets the sidebar date filter (start_date, end_date), the PageData it needs as
+# {argument name: loader name}, and whether it can be switched off in Access Control.
+PAGE_REGISTRY = {
+    "🏠 Upload & Validate": _page(show_upload_page, _ALL_ROLES, can_disable=False),
+    "📊 Dashboard Analytics": _page(show_analytics_page, _MANAGER_ROLES, date_filter=True, data={'validation_history': 'all_history'}),
+    "📈 Trends & History": _page(show_trends_page, _MANAGER_ROLES, date_filter=True, data={'trends_history_df': 'all_history'}),
+    "👤📊 User Performance": _page(show_user_performance_page, _ALL_ROLES, date_filter=True, data={'history_df': 'history', 'all_users_df': 'all_users'}),
+    "📝 Correction Entries": _page(show_correction_entries_page, _ALL_ROLES),
+    "📈 Correction Analytics": _page(show_correction_analytics_page, ("Super User",), data={'all_users_df': 'all_users'}),
+    "✉️ Send Notification": _page(show_send_notification_page, _ADMIN_ROLES, data={'all_users_df': 'all_users'}),
+    "📋 Suspicious Transactions": _page(show_suspicious_category_transactions_page, _ALL_ROLES),
+    "🕵️ Suspicious Tag Control": _page(show_suspicious_tag_control_page, _ADMIN_ROLES),
+    "🗂️ Report Archive": _page(show_report_archive_page, _ALL_ROLES, data={'history_df': 'history'}),
+    "📝 Correction Status": _page(show_correction_status_page, _ALL_ROLES, date_filter=True, data={'history_df': 'history'}),
+    "📢 Clarification Center": _page(show_clarification_center_page, _MANAGER_ROLES, can_disable=False),
+    "📋 Exception Details": _page(show_exception_details_page, _MANAGER_ROLES, date_filter=True, data={'history_df': 'history'}),
+    "📍 Location Expenses": _page(show_location_expenses_page, _MANAGER_ROLES, date_filter=True, data={'history_df': 'all_history'}),
+    "🧾 Ledger/Sub-Ledger Summary": _page(show_ledger_summary_page, _MANAGER_ROLES, date_filter=True, data={'history_df': 'all_history'}),
+    "👤🧾 User-wise Ledger Exceptions": _page(show_user_ledger_exceptions_page, _ALL_ROLES, date_filter=True, data={'history_df': 'history'}),
+    "👤📍 User & Location Analysis": _page(show_user_location_page, _MANAGER_ROLES, date_filter=True, data={'history_df': 'history'}),
+    "🔑 Access Control": _page(show_access_control_page, _ADMIN_ROLES, data={'all_users_df': 'all_users'}, can_disable=False),
+    "🛠️ User Management": _page(show_user_management_page, ("Super User",), data={'all_users_df': 'all_users'}),
+    "🗑️ Data Management": _page(show_data_management_page, ("Super User",), data={'history_df': 'all_history'}),
+    "⚙️ Settings": _page(show_settings_page, ("Super User",)),
+}
+
+# Default navigation per role, computed once per process instead of on every rerun.
+ROLE_PAGES = {role: [page for page, spec in PAGE_REGISTRY.items() if role in spec['roles']] for role in _ALL_ROLES}
+
+
+def render_selected_page(selected_page, page_data):
+    """Runs only the selected page's loaders (shared with the date filter) and renders it."""
+    spec = PAGE_REGISTRY[selected_page]
+    kwargs = {}
+    if spec['date_filter']:
+        history_df = page_data.get('history')
+        kwargs['start_date'], kwargs['end_date'] = add_date_filters_to_sidebar(history_df, key_suffix=selected_page.replace(" ", "_"))
+    for argument, loader in spec['data'].items():
+        kwargs[argument] = page_data.get(loader)
+    spec['render'](**kwargs)
+
+
 def main():
     st.markdown("<h1>🎯 Data Validation Dashboard</h1>", unsafe_allow_html=True)
     
     if not check_password():
         st.stop()
 
+    # Starts the background notification check and the email queue once per server process.
+    get_notification_scheduler()
+    get_email_dispatcher()
+
     # --- Get User Context from Session State ---
     user_role = st.session_state.get("role")
     username = st.session_state.get("username_actual")
     
-    if user_role == "Manager" and "managed_users" not in st.session_state:
-        st.session_state["managed_users"] = db_manager.get_managed_users(username)
-    managed_users = st.session_state.get("managed_users", [])
+    # Loaded at login and reused across reruns until it expires or is invalidated.
+    user_context = get_user_context(username, user_role)
+    st.session_state["managed_users"] = user_context['managed_users']
+    managed_users = user_context['managed_users']
 
     # --- Run core logic checks and fetch notifications ---
-    run_user_session_checks(username)
-    user_notifications = db_manager.get_notifications_for_user(username)
+    run_user_session_checks(username, user_context)
+    user_notifications = user_context['notifications']
     
     st.sidebar.image("assets/logo.png", width=150)
     st.sidebar.info(f"Logged in as: **{st.session_state.get('full_name', username)}**\n\nRole: **{user_role}**")
@@ -6018,19 +8884,17 @@ def main():
             if st.button("Mark all as read"):
                 notif_ids = [n['id'] for n in user_notifications]
                 db_manager.mark_notifications_as_read(notif_ids)
+                invalidate_user_context(username)
                 st.rerun()
     
     if st.sidebar.button("Logout"):
-        for key in list(st.session_state.keys()):
-            del st.session_state[key]
+        logout()
         st.rerun()
     
     st.sidebar.markdown("---")
     
     # --- Hierarchical Permission Logic ---
-    user_permissions = db_manager.get_user_permissions(username)
-    if user_role == "Super User":
-        user_permissions = {"can_upload": True, "disabled_pages": []}
+    user_permissions = user_context['permissions']
 
     if user_permissions is None:
         st.error("Could not load your permissions. Please contact an administrator.")
@@ -6039,42 +8903,7 @@ def main():
     st.session_state['can_upload'] = user_permissions['can_upload']
     user_disabled_pages = user_permissions['disabled_pages']
     
-    # --- MODIFIED --- Default page access now includes all new pages for the appropriate roles
-    page_access = {
-        "Super User": [
-            "🏠 Upload & Validate", "📊 Dashboard Analytics", "📈 Trends & History", "👤📊 User Performance", 
-            "📝 Correction Entries", "📈 Correction Analytics", "✉️ Send Notification",
-            "📋 Suspicious Transactions", "🕵️ Suspicious Tag Control",
-            "🗂️ Report Archive", "📝 Correction Status", "📢 Clarification Center", "📋 Exception Details", 
-            "📍 Location Expenses", "🧾 Ledger/Sub-Ledger Summary", "👤🧾 User-wise Ledger Exceptions", 
-            "👤📍 User & Location Analysis", "🔑 Access Control", "🛠️ User Management", 
-            "🗑️ Data Management", "⚙️ Settings"
-        ],
-        "Management": [
-            "🏠 Upload & Validate", "📊 Dashboard Analytics", "📈 Trends & History", "👤📊 User Performance",
-            "📝 Correction Entries", "✉️ Send Notification",
-            "📋 Suspicious Transactions", "🕵️ Suspicious Tag Control",
-            "🗂️ Report Archive", "📝 Correction Status", "📢 Clarification Center", "📋 Exception Details", 
-            "📍 Location Expenses", "🧾 Ledger/Sub-Ledger Summary", "👤🧾 User-wise Ledger Exceptions", 
-            "👤📍 User & Location Analysis", "🔑 Access Control"
-        ],
-        "Manager": [
-            "🏠 Upload & Validate", "📊 Dashboard Analytics", "📈 Trends & History", "👤📊 User Performance",
-            "📝 Correction Entries",
-            "📋 Suspicious Transactions",
-            "🗂️ Report Archive", "📝 Correction Status", "📢 Clarification Center", "📋 Exception Details", 
-            "📍 Location Expenses", "🧾 Ledger/Sub-Ledger Summary", "👤🧾 User-wise Ledger Exceptions", 
-            "👤📍 User & Location Analysis"
-        ],
-        "User": [
-            "🏠 Upload & Validate", "👤📊 User Performance",
-            "📝 Correction Entries",
-            "📋 Suspicious Transactions",
-            "🗂️ Report Archive", "📝 Correction Status", "👤🧾 User-wise Ledger Exceptions"
-        ]
-    }
-    
-    base_pages_for_role = page_access.get(user_role, [])
+    base_pages_for_role = ROLE_PAGES.get(user_role, [])
     page_navigation_options = [page for page in base_pages_for_role if page not in user_disabled_pages]
     
     # This clarification logic for a different feature remains unchanged
@@ -6108,39 +8937,18 @@ def main():
 
     st.markdown("<p style='text-align:center;color:#718096;font-size:1.2rem;margin-bottom:2rem;'>Upload expense reports for validation or manage data and users.</p>", unsafe_allow_html=True)
     
-    start_date, end_date = None, None
-    pages_with_filter = ["📊 Dashboard Analytics", "📈 Trends & History", "👤📊 User Performance", "📝 Correction Status", "📋 Exception Details", "📍 Location Expenses", "🧾 Ledger/Sub-Ledger Summary", "👤🧾 User-wise Ledger Exceptions", "👤📍 User & Location Analysis"]
-    
-    if selected_page in pages_with_filter:
-        history_df = db_manager.get_validation_history(user_role, username, managed_users)
-        start_date, end_date = add_date_filters_to_sidebar(history_df, key_suffix=selected_page.replace(" ", "_"))
-
-    # --- MODIFIED --- Page routing now includes the new pages
-    if selected_page == "🏠 Upload & Validate": show_upload_page()
-    elif selected_page == "📊 Dashboard Analytics": show_analytics_page(start_date, end_date)
-    elif selected_page == "📈 Trends & History": show_trends_page(start_date, end_date)
-    elif selected_page == "👤📊 User Performance": show_user_performance_page(start_date, end_date)
-    elif selected_page == "🗂️ Report Archive": show_report_archive_page()
-    elif selected_page == "📝 Correction Status": show_correction_status_page(start_date, end_date)
-    elif selected_page == "📢 Clarification Center": show_clarification_center_page()
-    elif selected_page == "📋 Exception Details": show_exception_details_page(start_date, end_date)
-    elif selected_page == "📍 Location Expenses": show_location_expenses_page(start_date, end_date)
-    elif selected_page == "🧾 Ledger/Sub-Ledger Summary": show_ledger_summary_page(start_date, end_date)
-    elif selected_page == "👤🧾 User-wise Ledger Exceptions": show_user_ledger_exceptions_page(start_date, end_date)
-    elif selected_page == "👤📍 User & Location Analysis": show_user_location_page(start_date, end_date)
-    elif selected_page == "🔑 Access Control": show_access_control_page()
-    elif selected_page == "🛠️ User Management": show_user_management_page()
-    elif selected_page == "🗑️ Data Management": show_data_management_page()
-    elif selected_page == "⚙️ Settings": show_settings_page()
-    elif selected_page == "🕵️ Suspicious Tag Control": show_suspicious_tag_control_page()
-    elif selected_page == "📋 Suspicious Transactions": show_suspicious_category_transactions_page()
-    elif selected_page == "📝 Correction Entries": show_correction_entries_page()
-    elif selected_page == "📈 Correction Analytics": show_correction_analytics_page()
-    elif selected_page == "✉️ Send Notification": show_send_notification_page()
+    render_selected_page(selected_page, PageData(user_role, username, managed_users))
 
 
-if __name__ == "__main__":
-    log_file_path = "dashboard.log"
+_logging_configured = False
+
+
+def configure_logging(log_file_path="dashboard.log"):
+    """Sets up file + console logging once per process; later calls do nothing."""
+    global _logging_configured
+    if _logging_configured:
+        return
+    _logging_configured = True
     try:
         log_dir = os.path.dirname(os.path.abspath(log_file_path)) or '.'
         if not os.path.exists(log_dir):
@@ -6168,4 +8976,11 @@ if __name__ == "__main__":
         )
     
     logging.info("Dashboard application started.")
-    main()
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    # `streamlit run dashboard.py` still works, but re-executes this whole module on every
+    # interaction; app.py is the faster entry point.
+    configure_logging()
+    configure_page()
+    main()
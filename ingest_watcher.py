@@ -0,0 +1,203 @@
+"""
+Drop-folder ingestion watcher.
+
+Polls a drop directory for new ledger exports and runs each one through the same
+pipeline as batch_validate.py. Successful files are moved to the processed folder,
+anything that fails is moved to the failed folder next to a `.error.txt` note.
+
+- Files are only picked up once their size and mtime have been stable for
+  `--settle-seconds`, so exports that are still being copied are left alone.
+- A SHA-256 of every successfully ingested file is kept in the processed folder;
+  a re-dropped file with identical content is moved aside without creating a new run.
+- At most `--workers` files are processed at the same time.
+
+Usage:
+    python ingest_watcher.py /data/ledger_drop --workers 2 --interval 15
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+
+import batch_validate
+
+HASH_INDEX_FILENAME = ".ingested_hashes"
+
+
+def file_sha256(file_path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def move_to_folder(file_path, target_dir):
+    """Moves a file into target_dir, adding a timestamp suffix if the name is already taken."""
+    name = os.path.basename(file_path)
+    destination = os.path.join(target_dir, name)
+    if os.path.exists(destination):
+        stem, ext = os.path.splitext(name)
+        destination = os.path.join(target_dir, f"{stem}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{ext}")
+    shutil.move(file_path, destination)
+    return destination
+
+
+class DropFolderWatcher:
+    def __init__(self, drop_dir, processed_dir, failed_dir, workers=2, settle_seconds=10, report_dir=None, chunksize=None):
+        self.drop_dir = os.path.abspath(drop_dir)
+        self.processed_dir = os.path.abspath(processed_dir)
+        self.failed_dir = os.path.abspath(failed_dir)
+        self.workers = max(1, workers)
+        self.settle_seconds = settle_seconds
+        self.report_dir = report_dir
+        self.chunksize = chunksize
+
+        for folder in (self.drop_dir, self.processed_dir, self.failed_dir):
+            os.makedirs(folder, exist_ok=True)
+        if self.report_dir:
+            os.makedirs(self.report_dir, exist_ok=True)
+
+        self.hash_index_path = os.path.join(self.processed_dir, HASH_INDEX_FILENAME)
+        self.ingested_hashes = self._load_hash_index()
+        # path -> (size, mtime, first time this size/mtime was seen)
+        self.pending = {}
+        # path -> (future, content hash)
+        self.in_flight = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+    def _load_hash_index(self):
+        if not os.path.exists(self.hash_index_path):
+            return set()
+        with open(self.hash_index_path, 'r', encoding='utf-8') as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def _record_hash(self, content_hash):
+        self.ingested_hashes.add(content_hash)
+        with open(self.hash_index_path, 'a', encoding='utf-8') as f:
+            f.write(content_hash + "\n")
+
+    def _settled_files(self):
+        """Returns files in the drop folder whose size and mtime have not changed for settle_seconds."""
+        now = time.monotonic()
+        present = set()
+        ready = []
+        for candidate in batch_validate.collect_input_files([self.drop_dir]):
+            if candidate in self.in_flight:
+                continue
+            present.add(candidate)
+            try:
+                stat = os.stat(candidate)
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            previous = self.pending.get(candidate)
+            if previous is None or previous[:2] != signature:
+                self.pending[candidate] = (*signature, now)
+                continue
+            if stat.st_size > 0 and now - previous[2] >= self.settle_seconds:
+                ready.append(candidate)
+
+        # Forget files that disappeared from the drop folder before they settled.
+        for stale in set(self.pending) - present:
+            del self.pending[stale]
+        return ready
+
+    def _submit_ready_files(self):
+        for file_path in self._settled_files():
+            if len(self.in_flight) >= self.workers:
+                break
+            self.pending.pop(file_path, None)
+            try:
+                content_hash = file_sha256(file_path)
+            except OSError as e:
+                logging.warning(f"Could not read {file_path} yet, will retry: {e}")
+                continue
+
+            if content_hash in self.ingested_hashes or any(h == content_hash for _, h in self.in_flight.values()):
+                destination = move_to_folder(file_path, self.processed_dir)
+                logging.info(f"Skipping {os.path.basename(file_path)}: identical content was already ingested. Moved to {destination}")
+                continue
+
+            logging.info(f"Queueing {os.path.basename(file_path)} for validation.")
+            future = self.executor.submit(batch_validate.process_file, file_path, None, self.report_dir, self.chunksize)
+            self.in_flight[file_path] = (future, content_hash)
+
+    def _collect_finished(self):
+        """Moves finished files to their final folder. Returns True if any run was saved."""
+        any_saved = False
+        for file_path, (future, content_hash) in list(self.in_flight.items()):
+            if not future.done():
+                continue
+            del self.in_flight[file_path]
+            result = future.result()
+            try:
+                if result['status'] == 'ok':
+                    self._record_hash(content_hash)
+                    destination = move_to_folder(file_path, self.processed_dir)
+                    any_saved = True
+                    logging.info(f"Ingested {result['file']} as run {result['run_id']} "
+                                 f"({result['processed']:,} rows, {result['exceptions']:,} exceptions) in {result['seconds']:.1f}s -> {destination}")
+                else:
+                    destination = move_to_folder(file_path, self.failed_dir)
+                    with open(destination + ".error.txt", 'w', encoding='utf-8') as f:
+                        f.write(f"{datetime.now().isoformat()} {result['status']}: {result['error']}\n")
+                    logging.warning(f"{result['file']} {result['status']}: {result['error']} -> {destination}")
+            except OSError as e:
+                logging.error(f"Could not move {file_path} after processing: {e}", exc_info=True)
+        return any_saved
+
+    def poll_once(self):
+        any_saved = self._collect_finished()
+        self._submit_ready_files()
+        if any_saved:
+            batch_validate.dashboard.run_notification_check()
+
+    def run_forever(self, interval=15):
+        logging.info(f"Watching {self.drop_dir} (processed: {self.processed_dir}, failed: {self.failed_dir}, "
+                     f"workers: {self.workers}, settle: {self.settle_seconds}s).")
+        try:
+            while True:
+                self.poll_once()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            logging.info("Stopping watcher, waiting for in-flight files to finish...")
+        finally:
+            self.executor.shutdown(wait=True)
+            self._collect_finished()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch a drop folder and validate new ledger exports.")
+    parser.add_argument('drop_dir', help="Folder where ledger exports are dropped.")
+    parser.add_argument('--processed-dir', help="Destination for ingested files. (default: <drop_dir>/processed)")
+    parser.add_argument('--failed-dir', help="Destination for files that failed. (default: <drop_dir>/failed)")
+    parser.add_argument('--workers', type=int, default=2, help="Maximum files processed concurrently. (default: 2)")
+    parser.add_argument('--interval', type=float, default=15, help="Seconds between polls of the drop folder. (default: 15)")
+    parser.add_argument('--settle-seconds', type=float, default=10,
+                        help="A file must be unchanged for this long before it is picked up. (default: 10)")
+    parser.add_argument('--report-dir', help="Also write each Excel validation report to this directory.")
+    parser.add_argument('--chunk-size', type=int, help="Stream files through the pipeline in chunks of this many rows.")
+    args = parser.parse_args(argv)
+
+    watcher = DropFolderWatcher(
+        drop_dir=args.drop_dir,
+        processed_dir=args.processed_dir or os.path.join(args.drop_dir, "processed"),
+        failed_dir=args.failed_dir or os.path.join(args.drop_dir, "failed"),
+        workers=args.workers,
+        settle_seconds=args.settle_seconds,
+        report_dir=args.report_dir,
+        chunksize=args.chunk_size,
+    )
+    watcher.run_forever(interval=args.interval)
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s [%(filename)s:%(lineno)d] - %(message)s')
+    sys.exit(main())
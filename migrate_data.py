@@ -1,116 +1,388 @@
-import sqlite3
-import mysql.connector
-import streamlit as st
-import json
+"""
+Copies the legacy SQLite database (validation_dashboard.db) into MySQL.
+
+Rows are streamed from SQLite in id order and inserted in batches, one committed transaction
+per batch, so memory stays flat however large the exceptions table (with its row JSON) or
+the stored Excel reports are. A batch is closed after `--batch-size` rows or
+BATCH_MAX_BYTES of text/blob data, whichever comes first.
+
+The migration is resumable: each table continues after the highest id already present in
+MySQL, so re-running after an interruption copies only what is missing. Pass --truncate to
+empty the destination tables and start over. Resuming into a users table that holds accounts
+the SQLite database does not have (say the Super User the dashboard seeds on its first start
+against an empty database) is refused, since their ids would shadow the SQLite users; use
+--truncate there. This script holds back SUPER_USER_USERNAME/SUPER_USER_PASSWORD while
+copying and only seeds that account afterwards, if the migrated users table is still empty.
+
+Tables run in parallel as far as their foreign keys allow: a table starts once the tables it
+references are complete, and is skipped if one of them failed. At the end every table is
+validated: row counts, a checksum over the migrated columns on both sides, and child rows
+whose parent run is missing.
+
+Usage:
+    python migrate_data.py
+    python migrate_data.py --truncate --workers 4
+    python migrate_data.py --tables exceptions --counts-only
+"""
+import argparse
+import concurrent.futures
+import hashlib
 import logging
+import os
 import re
+import sqlite3
+import struct
+import sys
+import time
+from datetime import datetime, timedelta
+
+import mysql.connector
+
+# Importing dashboard initialises the MySQL schema, which seeds the Super User into an empty
+# users table and would take users.id=1 before the SQLite users are copied; main() seeds it
+# after the copy instead.
+SUPER_USER_ENV = {k: os.environ.pop(k) for k in ('SUPER_USER_USERNAME', 'SUPER_USER_PASSWORD') if k in os.environ}
+
+import dashboard  # noqa: E402
+
+DEFAULT_SQLITE_PATH = "validation_dashboard.db"
+BATCH_MAX_BYTES = 8 * 1024 * 1024
+PROGRESS_LOG_SECONDS = 10
+
+# Tables copied from SQLite, in order, with their foreign keys as {column: referenced table}.
+MIGRATION_TABLES = {
+    'users': {},
+    'validation_runs': {},
+    'exceptions': {'run_id': 'validation_runs'},
+    'department_summary': {'run_id': 'validation_runs'},
+    'user_performance': {'run_id': 'validation_runs'},
+    'correction_status': {'run_id': 'validation_runs'},
+}
+
+# The SQLite app wrote pandas NaN into the row JSON; MySQL-side readers expect JSON null.
+JSON_NAN_PATTERN = re.compile(r'([\[:,]\s*)NaN')
+
+
+def fix_json_nan(text):
+    return JSON_NAN_PATTERN.sub(r'\1null', text) if isinstance(text, str) else text
+
+
+# Per table: {column: function} applied to every source row before it is inserted.
+ROW_FIXES = {
+    'exceptions': {'original_row_data': fix_json_nan},
+}
+
+
+def open_sqlite(sqlite_path):
+    return sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
 
-# Setup basic logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def migrate_data_final():
+def source_columns(sqlite_conn, table):
+    return [row[1] for row in sqlite_conn.execute(f'PRAGMA table_info("{table}")')]
+
+
+def destination_column_types(mysql_conn, table):
+    with mysql_conn.cursor() as cursor:
+        cursor.execute("SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS "
+                       "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (table,))
+        return {name: data_type.lower() for name, data_type in cursor.fetchall()}
+
+
+def _apply_fixes(row, fixes):
+    if not fixes:
+        return tuple(row)
+    row = list(row)
+    for index, fix in fixes:
+        row[index] = fix(row[index])
+    return tuple(row)
+
+
+def _row_fixes(table, columns):
+    return [(columns.index(column), fix) for column, fix in ROW_FIXES.get(table, {}).items() if column in columns]
+
+
+def _insert_batch(mysql_conn, insert_sql, rows):
+    try:
+        with mysql_conn.cursor() as cursor:
+            cursor.executemany(insert_sql, rows)
+        mysql_conn.commit()
+    except mysql.connector.Error:
+        mysql_conn.rollback()
+        raise
+    return len(rows)
+
+
+def migrate_table(table, sqlite_path, db_creds, batch_size):
+    """Copies the source rows above the destination's current MAX(id). Returns the number of rows copied."""
+    sqlite_conn = open_sqlite(sqlite_path)
+    mysql_conn = mysql.connector.connect(**db_creds, autocommit=False)
+    try:
+        columns = source_columns(sqlite_conn, table)
+        missing = [c for c in columns if c not in destination_column_types(mysql_conn, table)]
+        if missing:
+            raise ValueError(f"MySQL table `{table}` has no column(s) {', '.join(missing)}")
+
+        with mysql_conn.cursor() as cursor:
+            # Parents are loaded first, but legacy SQLite data can hold orphans; they are reported by validation.
+            cursor.execute("SET FOREIGN_KEY_CHECKS=0")
+            cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM `{table}`")
+            start_id = cursor.fetchone()[0]
+        mysql_conn.commit()
+
+        remaining = sqlite_conn.execute(f'SELECT COUNT(*) FROM "{table}" WHERE id > ?', (start_id,)).fetchone()[0]
+        if not remaining:
+            logging.info(f"{table}: nothing to copy (MySQL is at id {start_id}).")
+            return 0
+        logging.info(f"{table}: copying {remaining:,} row(s) after id {start_id}.")
+
+        insert_sql = (f"INSERT INTO `{table}` ({', '.join(f'`{c}`' for c in columns)}) "
+                      f"VALUES ({', '.join(['%s'] * len(columns))})")
+        fixes = _row_fixes(table, columns)
+        quoted_source = ", ".join(f'"{c}"' for c in columns)
+        source = sqlite_conn.execute(f'SELECT {quoted_source} FROM "{table}" WHERE id > ? ORDER BY id', (start_id,))
+
+        copied = 0
+        batch, batch_bytes = [], 0
+        last_log = time.monotonic()
+        for row in source:
+            row = _apply_fixes(row, fixes)
+            batch.append(row)
+            batch_bytes += sum(len(v) for v in row if isinstance(v, (str, bytes)))
+            if len(batch) >= batch_size or batch_bytes >= BATCH_MAX_BYTES:
+                copied += _insert_batch(mysql_conn, insert_sql, batch)
+                batch, batch_bytes = [], 0
+                if time.monotonic() - last_log >= PROGRESS_LOG_SECONDS:
+                    logging.info(f"{table}: {copied:,}/{remaining:,} rows copied.")
+                    last_log = time.monotonic()
+        if batch:
+            copied += _insert_batch(mysql_conn, insert_sql, batch)
+        logging.info(f"{table}: copied {copied:,} row(s).")
+        return copied
+    finally:
+        sqlite_conn.close()
+        mysql_conn.close()
+
+
+def run_in_dependency_order(tables, workers, task):
     """
-    Final, production-ready script to migrate data from SQLite to MySQL.
-    This version includes a specific fix for NaN values in the JSON data.
+    Runs task(table) for every table on a thread pool, starting each table once the tables its
+    foreign keys reference (within `tables`) have succeeded. Returns {table: result or exception}.
     """
-    SQLITE_DB_PATH = "validation_dashboard.db" 
-    
+    results = {}
+    pending = {table: set(MIGRATION_TABLES[table].values()) & set(tables) for table in tables}
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while pending or running:
+            for table, parents in list(pending.items()):
+                failed = [p for p in parents if isinstance(results.get(p), Exception)]
+                if failed:
+                    results[table] = RuntimeError(f"skipped because {', '.join(failed)} failed")
+                    del pending[table]
+                elif parents <= results.keys():
+                    running[executor.submit(task, table)] = table
+                    del pending[table]
+            if not running:
+                continue
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                table = running.pop(future)
+                try:
+                    results[table] = future.result()
+                except Exception as e:
+                    logging.error(f"{table}: migration failed: {e}", exc_info=True)
+                    results[table] = e
+    return results
+
+
+def _normalise(value, data_type):
+    """Brings a SQLite or MySQL value to a common form for the checksum."""
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(bytes(value)).hexdigest()
     try:
-        MYSQL_CREDS = st.secrets["mysql"]
-    except Exception as e:
-        logging.error("Could not read secrets.toml. Make sure it exists.")
-        return
+        if data_type in ('timestamp', 'datetime'):
+            if isinstance(value, str):
+                value = datetime.fromisoformat(value)
+            if value.microsecond >= 500000:  # MySQL rounds to whole seconds
+                value += timedelta(seconds=1)
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        if data_type == 'float':  # single precision; MySQL prints FLOAT with 6 significant digits
+            return f"{struct.unpack('f', struct.pack('f', float(value)))[0]:.6g}"
+        if data_type in ('double', 'decimal'):
+            return f"{float(value):.15g}"
+        if data_type in ('tinyint', 'smallint', 'mediumint', 'int', 'bigint'):
+            return int(value)
+    except (ValueError, TypeError, OverflowError):
+        pass
+    return str(value)
+
 
-    logging.info("Starting final data migration from SQLite to MySQL...")
-    sqlite_conn = None
-    mysql_conn = None
+def _checksum(rows, types, fixes=None):
+    digest = hashlib.sha256()
+    count = 0
+    for row in rows:
+        row = _apply_fixes(row, fixes)
+        digest.update(repr(tuple(_normalise(v, t) for v, t in zip(row, types))).encode('utf-8'))
+        count += 1
+    return count, digest.hexdigest()
 
+
+def validate_table(table, sqlite_path, db_creds, counts_only=False):
+    """Compares row counts (and checksums over the migrated columns) between SQLite and MySQL."""
+    sqlite_conn = open_sqlite(sqlite_path)
+    mysql_conn = mysql.connector.connect(**db_creds)
     try:
-        sqlite_conn = sqlite3.connect(SQLITE_DB_PATH)
-        sqlite_conn.row_factory = sqlite3.Row
-        mysql_conn = mysql.connector.connect(**MYSQL_CREDS)
-        sqlite_cursor = sqlite_conn.cursor()
-        mysql_cursor = mysql_conn.cursor()
-        
-        logging.info("Successfully connected to both databases.")
-
-        tables_to_migrate = ["users", "validation_runs", "exceptions", "department_summary", "user_performance", "correction_status"]
-        
-        mysql_cursor.execute("SET FOREIGN_KEY_CHECKS=0;")
-        logging.info("MySQL foreign key checks disabled.")
-
-        logging.info("Emptying all destination tables in MySQL...")
-        for table_name in reversed(tables_to_migrate):
-            mysql_cursor.execute(f"TRUNCATE TABLE `{table_name}`;")
-        logging.info("All destination tables are now empty.")
-
-        for table_name in tables_to_migrate:
-            logging.info(f"--- Migrating table: {table_name} ---")
-            
-            sqlite_cursor.execute(f"SELECT * FROM {table_name}")
-            records = sqlite_cursor.fetchall()
-            
-            if not records:
-                logging.info(f"Table '{table_name}' is empty. Skipping.")
-                continue
+        columns = source_columns(sqlite_conn, table)
+        column_types = destination_column_types(mysql_conn, table)
+        types = [column_types.get(c) for c in columns]
+        result = {'table': table, 'source_checksum': None, 'destination_checksum': None, 'orphans': 0}
 
-            column_names = [desc[0] for desc in sqlite_cursor.description]
-            quoted_column_names = [f"`{col}`" for col in column_names]
-            placeholders = ", ".join(["%s"] * len(column_names))
-            insert_query = f"INSERT INTO `{table_name}` ({', '.join(quoted_column_names)}) VALUES ({placeholders})"
-            
-            data_to_insert = []
+        if counts_only:
+            result['source_rows'] = sqlite_conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+            with mysql_conn.cursor() as cursor:
+                cursor.execute(f"SELECT COUNT(*) FROM `{table}`")
+                result['destination_rows'] = cursor.fetchone()[0]
+        else:
+            quoted_source = ", ".join(f'"{c}"' for c in columns)
+            result['source_rows'], result['source_checksum'] = _checksum(
+                sqlite_conn.execute(f'SELECT {quoted_source} FROM "{table}" ORDER BY id'), types, _row_fixes(table, columns)
+            )
+            with mysql_conn.cursor() as cursor:  # unbuffered: rows stream from the server
+                cursor.execute(f"SELECT {', '.join(f'`{c}`' for c in columns)} FROM `{table}` ORDER BY id")
+                result['destination_rows'], result['destination_checksum'] = _checksum(cursor, types)
+
+        with mysql_conn.cursor() as cursor:
+            for column, parent in MIGRATION_TABLES[table].items():
+                cursor.execute(f"SELECT COUNT(*) FROM `{table}` c LEFT JOIN `{parent}` p ON p.id = c.`{column}` "
+                               f"WHERE c.`{column}` IS NOT NULL AND p.id IS NULL")
+                result['orphans'] += cursor.fetchone()[0]
+        return result
+    finally:
+        sqlite_conn.close()
+        mysql_conn.close()
+
+
+def truncate_tables(db_creds, tables):
+    mysql_conn = mysql.connector.connect(**db_creds, autocommit=True)
+    try:
+        with mysql_conn.cursor() as cursor:
+            cursor.execute("SET FOREIGN_KEY_CHECKS=0")
+            for table in reversed(tables):
+                cursor.execute(f"TRUNCATE TABLE `{table}`")
+                logging.info(f"Emptied MySQL table `{table}`.")
+    finally:
+        mysql_conn.close()
+
+
+def unknown_destination_users(sqlite_path, db_creds):
+    """Usernames in the MySQL users table that the SQLite database does not have."""
+    sqlite_conn = open_sqlite(sqlite_path)
+    try:
+        source = {row[0] for row in sqlite_conn.execute('SELECT username FROM "users"')}
+    finally:
+        sqlite_conn.close()
+    if not source:
+        return []
+    mysql_conn = mysql.connector.connect(**db_creds)
+    try:
+        with mysql_conn.cursor() as cursor:
+            cursor.execute("SELECT username FROM `users`")
+            return sorted(row[0] for row in cursor.fetchall() if row[0] not in source)
+    finally:
+        mysql_conn.close()
 
-            # --- FINAL FIX: Special handling for 'exceptions' table to replace NaN with null ---
-            if table_name == 'exceptions':
-                logging.info("Applying NaN -> null fix for 'exceptions' table...")
-                try:
-                    json_col_index = column_names.index('original_row_data')
-                except ValueError:
-                    json_col_index = -1
-
-                for row in records:
-                    row_list = list(row)
-                    if json_col_index != -1 and isinstance(row_list[json_col_index], str):
-                        # This regex replacement is safer. It replaces `NaN` when it appears as a value, not as part of a string.
-                        # It looks for : NaN, [NaN, or {..., "key": NaN}
-                        problem_text = row_list[json_col_index]
-                        # A robust regex to replace NaN which is not inside quotes
-                        # This finds NaN that is preceded by a colon, comma, or opening bracket, with optional whitespace
-                        # and replaces it with the JSON standard 'null'.
-                        clean_text = re.sub(r'([\[:,]\s*)NaN', r'\1null', problem_text)
-                        row_list[json_col_index] = clean_text
-
-                    data_to_insert.append(tuple(row_list))
-            else:
-                data_to_insert = [tuple(row) for row in records]
-            
-            mysql_cursor.executemany(insert_query, data_to_insert)
-            logging.info(f"Successfully inserted {mysql_cursor.rowcount} records into MySQL table `{table_name}`.")
-
-            mysql_cursor.execute(f"SELECT MAX(id) FROM `{table_name}`")
-            max_id = mysql_cursor.fetchone()[0]
-            if max_id:
-                next_id = max_id + 1
-                mysql_cursor.execute(f"ALTER TABLE `{table_name}` AUTO_INCREMENT = {next_id};")
-                logging.info(f"AUTO_INCREMENT for `{table_name}` reset to {next_id}.")
-
-        mysql_cursor.execute("SET FOREIGN_KEY_CHECKS=1;")
-        logging.info("MySQL foreign key checks re-enabled.")
-        
-        mysql_conn.commit()
-        logging.info("--- MIGRATION COMPLETED SUCCESSFULLY! ---")
 
-    except Exception as e:
-        logging.error(f"An error occurred during migration: {e}", exc_info=True)
-        if mysql_conn:
-            mysql_conn.rollback()
+def seed_super_user(db_creds):
+    """Creates the SUPER_USER_* account if the users table is still empty after the copy."""
+    username, password = SUPER_USER_ENV.get('SUPER_USER_USERNAME'), SUPER_USER_ENV.get('SUPER_USER_PASSWORD')
+    if not (username and password):
+        return
+    mysql_conn = mysql.connector.connect(**db_creds, autocommit=True)
+    try:
+        with mysql_conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM `users`")
+            if cursor.fetchone()[0]:
+                return
+            cursor.execute("INSERT INTO `users` (username, full_name, hashed_password, role) VALUES (%s, %s, %s, %s)",
+                           (username, 'Super User Account', dashboard.hash_password(password), 'Super User'))
+            logging.info(f"Created initial 'Super User' account for '{username}'.")
     finally:
-        if sqlite_conn:
-            sqlite_conn.close()
-        if mysql_conn and mysql_conn.is_connected():
-            mysql_conn.close()
-        logging.info("Database connections closed.")
+        mysql_conn.close()
+
+
+def print_validation(results):
+    print()
+    print(f"{'Table':<22} {'SQLite rows':>12} {'MySQL rows':>12} {'Checksum':>10} {'Orphans':>8}  Status")
+    print("-" * 80)
+    all_ok = True
+    for r in results:
+        checksum = "-" if r['source_checksum'] is None else ("match" if r['source_checksum'] == r['destination_checksum'] else "DIFFERS")
+        ok = r['source_rows'] == r['destination_rows'] and checksum != "DIFFERS"
+        all_ok = all_ok and ok
+        print(f"{r['table']:<22} {r['source_rows']:>12,} {r['destination_rows']:>12,} {checksum:>10} {r['orphans']:>8,}  "
+              f"{'ok' if ok else 'MISMATCH'}{' (orphaned rows)' if r['orphans'] else ''}")
+    print("-" * 80)
+    return all_ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream the legacy SQLite database into MySQL, resumably.")
+    parser.add_argument('--sqlite-path', default=DEFAULT_SQLITE_PATH, help=f"SQLite database to read. (default: {DEFAULT_SQLITE_PATH})")
+    parser.add_argument('--tables', nargs='+', choices=list(MIGRATION_TABLES), help="Only migrate these tables. (default: all)")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Rows inserted per transaction. (default: 1000)")
+    parser.add_argument('--workers', type=int, default=3, help="Tables copied in parallel. (default: 3)")
+    parser.add_argument('--truncate', action='store_true', help="Empty the destination tables first instead of resuming.")
+    parser.add_argument('--counts-only', action='store_true', help="Validate row counts only, without checksums.")
+    parser.add_argument('--no-validate', action='store_true', help="Skip the validation step.")
+    args = parser.parse_args(argv)
+    tables = [t for t in MIGRATION_TABLES if not args.tables or t in args.tables]
+
+    try:
+        open_sqlite(args.sqlite_path).close()
+    except sqlite3.Error as e:
+        logging.error(f"Cannot open SQLite database '{args.sqlite_path}': {e}")
+        return 1
+
+    # Creates any missing MySQL tables and supplies the connection settings.
+    db_manager = dashboard.get_database_manager()
+    db_creds = dict(db_manager.db_creds)
+
+    if args.truncate:
+        truncate_tables(db_creds, tables)
+    elif 'users' in tables:
+        unknown = unknown_destination_users(args.sqlite_path, db_creds)
+        if unknown:
+            logging.error(f"MySQL users table holds account(s) not in SQLite ({', '.join(unknown)}); resuming would "
+                          "skip or collide with the SQLite users. Re-run with --truncate.")
+            return 1
+
+    started = time.perf_counter()
+    results = run_in_dependency_order(
+        tables, args.workers, lambda table: migrate_table(table, args.sqlite_path, db_creds, max(1, args.batch_size))
+    )
+    failed = [t for t in tables if isinstance(results.get(t), Exception)]
+    copied = sum(v for v in results.values() if not isinstance(v, Exception))
+    logging.info(f"Copied {copied:,} row(s) in {time.perf_counter() - started:.1f}s"
+                 + (f"; failed: {', '.join(f'{t} ({results[t]})' for t in failed)}" if failed else "."))
+
+    # Derived data the dashboard would otherwise only build on its next start.
+    if 'users' in tables:
+        seed_super_user(db_creds)
+    if results.get('users'):
+        db_manager.rebuild_hierarchy_closure()
+    if results.get('exceptions'):
+        db_manager.backfill_exception_list_columns()
+        db_manager.backfill_exception_reason_links()
+
+    if args.no_validate:
+        return 1 if failed else 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        validation = list(executor.map(lambda t: validate_table(t, args.sqlite_path, db_creds, args.counts_only), tables))
+    all_ok = print_validation(validation)
+    return 0 if all_ok and not failed else 1
+
 
 if __name__ == "__main__":
-    migrate_data_final()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s [%(filename)s:%(lineno)d] - %(message)s')
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Memory profile of the upload pipeline, stage by stage.
+
+Runs the pipeline stages on a sample export and reports the peak resident set size (RSS)
+of this process during each stage, plus the size of the DataFrames each stage produces.
+With --compare-legacy it also replays the full-DataFrame copies the pipeline used to make
+(role-filter copy, pre-validation copy, .loc/.drop copies and the concat) so the
+difference can be read off the same report.
+
+Nothing is written to the database unless --persist is given, in which case the file is
+saved as a real validation run.
+
+Usage:
+    python profile_pipeline_memory.py big_export.xlsx --compare-legacy
+"""
+import argparse
+import gc
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+import pandas as pd
+
+import dashboard
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss_bytes():
+    """Current RSS from /proc on Linux; falls back to the lifetime peak elsewhere."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_kb * (1 if sys.platform == 'darwin' else 1024)
+
+
+class StageProfiler:
+    """Samples RSS on a background thread and records the peak seen during each stage."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stages = []
+        self._peak = 0
+        self._running = False
+
+    def _sample(self):
+        while self._running:
+            self._peak = max(self._peak, current_rss_bytes())
+            time.sleep(self.interval)
+
+    def run(self, name, func, *args, **kwargs):
+        gc.collect()
+        start_rss = current_rss_bytes()
+        self._peak = start_rss
+        self._running = True
+        sampler = threading.Thread(target=self._sample, daemon=True)
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            self._running = False
+            sampler.join()
+        elapsed = time.perf_counter() - started
+        end_rss = current_rss_bytes()
+        self.stages.append({
+            'stage': name, 'seconds': elapsed, 'start_mb': start_rss / 2**20,
+            'peak_mb': max(self._peak, end_rss) / 2**20, 'end_mb': end_rss / 2**20,
+            'frame_mb': _frame_mb(result),
+        })
+        return result
+
+    def report(self):
+        print(f"\n{'Stage':<34} {'Seconds':>8} {'Start MB':>9} {'Peak MB':>9} {'Delta MB':>9} {'End MB':>9} {'Frame MB':>9}")
+        print("-" * 94)
+        for s in self.stages:
+            frame = f"{s['frame_mb']:>9.1f}" if s['frame_mb'] is not None else f"{'-':>9}"
+            print(f"{s['stage']:<34} {s['seconds']:>8.2f} {s['start_mb']:>9.1f} {s['peak_mb']:>9.1f} "
+                  f"{s['peak_mb'] - s['start_mb']:>9.1f} {s['end_mb']:>9.1f} {frame}")
+        children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print("-" * 94)
+        print(f"Process peak RSS: {max(s['peak_mb'] for s in self.stages):.1f} MB | "
+              f"largest validation worker: {children_kb / 1024:.1f} MB")
+
+
+def _frame_mb(value):
+    frames = value if isinstance(value, tuple) else (value,)
+    sizes = [f.memory_usage(deep=True).sum() for f in frames if isinstance(f, pd.DataFrame)]
+    return sum(sizes) / 2**20 if sizes else None
+
+
+def legacy_copies(df_original, exceptions_index):
+    """Replays the full copies made by the pre-mask pipeline; returns the copies so they stay alive."""
+    df_to_process = df_original.copy()
+    validation_input = df_to_process.copy()
+    exceptions_to_process = df_to_process.loc[exceptions_index].copy()
+    clean_df = df_to_process.drop(index=exceptions_index).copy()
+    final_clean_df = pd.DataFrame([row for _, row in clean_df.iterrows()], columns=clean_df.columns)
+    final_df = pd.concat([exceptions_to_process, final_clean_df], ignore_index=True)
+    return df_to_process, validation_input, exceptions_to_process, clean_df, final_clean_df, final_df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report peak RSS per stage of the upload pipeline.")
+    parser.add_argument('file', help="Sample ledger export (xlsx, csv or parquet).")
+    parser.add_argument('--compare-legacy', action='store_true', help="Also replay the old full-copy chain.")
+    parser.add_argument('--persist', action='store_true', help="Save the run to the database (writes data).")
+    args = parser.parse_args(argv)
+
+    profiler = StageProfiler()
+    df_original = profiler.run("read file", dashboard.read_ledger_file, args.file)
+    df_to_process, _ = profiler.run("role filter (Super User)", dashboard.filter_records_for_user, df_original, 'Super User', None)
+    ctx = profiler.run("load fingerprints/rules", dashboard._build_pipeline_context)
+    keep_mask, fingerprints, exceptions_df, *_ = profiler.run(
+        "validate + de-duplicate", dashboard._validate_and_deduplicate, ctx, df_to_process
+    )
+    profiler.run("slim working view", lambda: df_to_process.loc[keep_mask, [c for c in dashboard.PIPELINE_WORKING_COLUMNS if c in df_to_process.columns]])
+    profiler.run("user/department stats", lambda: (
+        dashboard.compute_user_stats(df_to_process.loc[keep_mask, ['Created user']], exceptions_df),
+        dashboard.compute_department_stats(df_to_process.loc[keep_mask, ['Department.Name']], exceptions_df),
+    ))
+
+    if args.persist:
+        profiler.run("persist run (DB writes)", dashboard.run_validation_pipeline, df_to_process,
+                     os.path.basename(args.file), os.path.getsize(args.file), None, False)
+
+    if args.compare_legacy:
+        legacy = profiler.run("legacy full-copy chain (old code)", legacy_copies, df_original, exceptions_df.index)
+        legacy_bytes = sum(int(copy.memory_usage(deep=True).sum()) for copy in legacy)
+        del legacy
+        print(f"\nLegacy chain held {len(df_original.columns)}-column copies totalling {legacy_bytes / 2**20:,.1f} MiB "
+              f"({legacy_bytes / max(int(df_original.memory_usage(deep=True).sum()), 1):.1f}x the input frame).")
+
+    print(f"\n{os.path.basename(args.file)}: {len(df_original):,} rows x {len(df_original.columns)} columns, "
+          f"{int(keep_mask.sum()):,} kept, {len(exceptions_df):,} exceptions")
+    profiler.report()
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s [%(filename)s:%(lineno)d] - %(message)s')
+    sys.exit(main())
@@ -1,4 +1,4 @@
 #!/bin/bash
 
 cd /home/vnrfinance/validation_dashboard
-/home/vnrfinance/.local/bin/streamlit run dashboard.py
+/home/vnrfinance/.local/bin/streamlit run app.py